@@ -50,6 +50,7 @@ for directory in [
     'data/here_databases/',
     'data/lua_profiles/',
     'data/osm/',
+    'data/osrm_cache/',
     'data/server/locations/',
     'data/server/plans/',
     'data/results/',
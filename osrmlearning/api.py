@@ -14,22 +14,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import datetime
+import http.client
 import logging
 import schedule
 import sys
 import threading
 import time
 
-from flask import Flask, request
+from flask import Flask, jsonify, request
 
 from osrmlearning import config
-from osrmlearning.osrmclient import osrm_request
+from osrmlearning.asyncproxy import ProxyWorkers
+from osrmlearning.osrmclient import stream_osrm_request
+from osrmlearning.proxy import get_accept_encoding, get_balancer, get_batch_durations, is_streamed, normalize_query, \
+    parse_request, ReplicaBalancer, ResponseCache, SingleFlight
 from osrmlearning.run import get_osrm_containers_by_time_windows
-from osrmlearning.timewindow import get_time_windows, get_time_window_by_hour
+from osrmlearning.timewindow import get_time_window_by_timestamp
 
 app = Flask(__name__)
 learning_thread = None
+response_cache = ResponseCache() if config.rest_api.cache == '1' else None
+single_flight = SingleFlight()
 
 
 def init_osrm_containers():
@@ -62,35 +67,89 @@ def shutdown():
     return 'Server shutting down...'
 
 
+@app.route('/stats')
+def stats():
+    return jsonify(
+        cache=response_cache.statistics if response_cache else None,
+        coalesced=single_flight.coalesced,
+    )
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    try:
+        durations = get_batch_durations(request.get_json(force=True)['legs'])
+    except (ValueError, KeyError, TypeError) as e:
+        return app.response_class(response='Invalid batch: {}'.format(e), status=400)
+    except (OSError, http.client.HTTPException) as e:
+        logging.warning('Batch: {}'.format(e))
+        return app.response_class(response='OSRM instance not available', status=502)
+    return jsonify(code='Ok', durations=durations)
+
+
+def _osrm_replica_request(balancer: ReplicaBalancer, query: str, accept_encoding=None, retry=True) -> tuple:
+    """Return status, content encoding and body, the body is bytes or an iterator over chunks if it is streamed"""
+    port = balancer.acquire()
+    logging.debug('port={}'.format(port))
+    healthy = True
+    streamed = False
+    try:
+        response, chunks = stream_osrm_request(query, port=port, accept_encoding=accept_encoding)
+        healthy = response.status < 500
+        content_encoding = response.getheader('Content-Encoding')
+        if is_streamed(response.length):
+            # the replica is busy until the body is relayed, Flask closes the body at the end or on disconnect
+            chunks.on_close = lambda read_healthy: balancer.release(port, healthy=healthy and read_healthy)
+            streamed = True
+            return response.status, content_encoding, chunks
+        return response.status, content_encoding, b''.join(chunks)
+    except (http.client.HTTPException, ConnectionError):
+        healthy = False
+        if not retry or len(balancer.ports) < 2:
+            raise
+    finally:
+        if not streamed:
+            balancer.release(port, healthy=healthy)
+    # the replica is down and ejected now, so this goes to another one
+    return _osrm_replica_request(balancer, query, accept_encoding, retry=False)
+
+
 # http://flask.pocoo.org/snippets/57/
 @app.route('/', defaults=dict(path=''))
 @app.route('/<path:path>')
 def osrm_proxy_request(path):
-    timestamp = request.args.get('timestamp')
-    query = '/{}?{}'.format(path, request.query_string.decode())
-    logging.debug(query)
-    query = query.replace('timestamp={}'.format(timestamp), '')
-    query = query.replace('?&', '?')
-    query = query.replace('&&', '&')
-    query = query[:-1] if query.endswith('&') else query
-    query = query[:-1] if query.endswith('?') else query
-    date_format = config.rest_api.date_format
-    time_windows = get_time_windows()
-    if timestamp:
-        timestamp = datetime.datetime.strptime(timestamp, date_format)
-        time_window = get_time_window_by_hour(timestamp.hour)
-    else:
-        time_window = [time_window for time_window in time_windows if 'default' in time_window.name][0]
-    # port = osrm_containers[time_window].port
-    port = time_window.port
+    query, timestamp = parse_request(path, request.query_string.decode())
+    try:
+        time_window = get_time_window_by_timestamp(timestamp)
+    except ValueError:
+        return app.response_class(response='Invalid timestamp {}'.format(timestamp), status=400)
+    encoding = get_accept_encoding(request.headers.get('Accept-Encoding'))
     logging.debug(query)
     logging.debug('timestamp={}'.format(timestamp))
     logging.debug('time_window={}'.format(time_window))
-    logging.debug('port={}'.format(port))
+    status, content_encoding = 200, encoding
+    body = response_cache.get(query, time_window, encoding) if response_cache else None
+    if body is None:
+        leader = []
+
+        def fetch():
+            leader.append(True)
+            return _osrm_replica_request(get_balancer(time_window), query, encoding)
+
+        status, content_encoding, body = single_flight.do((normalize_query(query), time_window.name, encoding), fetch)
+        if not isinstance(body, bytes) and not leader:
+            # the response of the leader is streamed, it cannot be shared
+            status, content_encoding, body = fetch()
+        if response_cache and status == 200 and isinstance(body, bytes) and content_encoding == encoding:
+            response_cache.put(query, time_window, body, encoding)
+    headers = {'Vary': 'Accept-Encoding'}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
     return app.response_class(
-        response=osrm_request(query, port=port),
-        status=200,
+        response=body,
+        status=status,
         mimetype='application/json',
+        headers=headers,
     )
 
 
@@ -138,9 +197,16 @@ def schedule_updates():
 
 
 def main():
+    proxy_workers = None
+    if '--skip-api' not in sys.argv and config.rest_api.server == 'async':
+        # fork the proxy workers before the learning thread is started
+        proxy_workers = ProxyWorkers()
+        proxy_workers.start()
     if '--skip-init' not in sys.argv:
         init_osrm_containers()
-    if '--skip-api' not in sys.argv:
+    if proxy_workers:
+        proxy_workers.wait(learn=init_osrm_containers)
+    elif '--skip-api' not in sys.argv:
         serve_rest_api()
     if '--schedule' in sys.argv:
         schedule_updates()
@@ -0,0 +1,384 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Production mode of the OSRM proxy (config.rest_api.server = async)
+
+- Same URL contract as api.osrm_proxy_request(), including the timestamp parameter, /learn and /shutdown
+- Several worker processes share config.rest_api.port (SO_REUSEPORT), each one runs an asyncio event loop
+- Each worker keeps pooled keep-alive connections to the OSRM instances,
+  at most config.rest_api.connections_per_backend per time window port
+- /learn and /shutdown are passed on to the parent process, which runs the learning
+- Each worker has its own response cache, /stats shows the statistics of the worker that answers
+- Identical requests that arrive while the first one is in flight wait for and share its response
+- Requests are balanced over the replicas of a time window (see proxy.ReplicaBalancer), ejected replicas
+  are probed every config.rest_api.health_check_interval seconds
+- With config.rest_api.hedge_delay_ms > 0, a request that is not answered within this delay is also sent
+  to a second replica and the first response wins
+- Large responses are relayed in chunks and gzip responses are passed on compressed (see proxy.py)
+- POST /batch runs the blocking table requests (see proxy.get_batch_durations()) in a thread pool
+"""
+
+import asyncio
+import http.client
+import logging
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+
+from osrmlearning import config
+from osrmlearning.proxy import get_accept_encoding, get_balancer, get_balancers, get_batch_durations, is_streamed, \
+    normalize_query, parse_request, ReplicaBalancer, ResponseCache
+from osrmlearning.timewindow import get_time_window_by_timestamp
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class _UpstreamBody(object):
+    """Unread streamed response of a replica, which counts as outstanding until release()"""
+
+    def __init__(self, response: aiohttp.ClientResponse, balancer: ReplicaBalancer, port: int, healthy=True):
+        self.response = response
+        self.balancer = balancer
+        self.port = port
+        self.healthy = healthy
+        self.released = False
+
+    @property
+    def content_length(self):
+        return self.response.content_length
+
+    def iter_chunks(self):
+        return self.response.content.iter_chunked(_CHUNK_SIZE)
+
+    def release(self, healthy=True):
+        if self.released:
+            return
+        self.released = True
+        self.response.release()
+        self.balancer.release(self.port, healthy=self.healthy and healthy)
+
+
+class AsyncSingleFlight(object):
+    """Coalesce identical concurrent coroutine calls into one call"""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._tasks = {}
+
+    async def do(self, key, coroutine_function, discard=None):
+        """Return the result of coroutine_function() of the first caller of key
+
+        If the first caller is cancelled, discard(result) is called with the result that it does not consume.
+        """
+        task = self._tasks.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(coroutine_function())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.coalesced += 1
+        try:
+            # shield: a client that disconnects must not cancel the request for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if leader and discard:
+                task.add_done_callback(
+                    lambda _: None if task.cancelled() or task.exception() is not None else discard(task.result())
+                )
+            raise
+
+
+class AsyncProxy(object):
+    def __init__(self, learn_event=None, shutdown_event=None):
+        self.learn_event = learn_event
+        self.shutdown_event = shutdown_event
+        self.session = None
+        self.response_cache = ResponseCache() if config.rest_api.cache == '1' else None
+        self.single_flight = AsyncSingleFlight()
+        self.hedge_delay = float(config.rest_api.hedge_delay_ms) / 1000
+        self.hedged = 0
+        self._health_check = None
+        self.app = web.Application()
+        self.app.on_startup.append(self._start_session)
+        self.app.on_cleanup.append(self._close_session)
+        self.app.router.add_route('*', '/learn', self.learn)
+        self.app.router.add_route('*', '/shutdown', self.shutdown)
+        self.app.router.add_route('GET', '/stats', self.stats)
+        self.app.router.add_route('POST', '/batch', self.batch)
+        self.app.router.add_route('GET', '/{path:.*}', self.osrm_proxy_request)
+
+    async def _start_session(self, app):
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=int(config.rest_api.connections_per_backend),
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=float(config.rest_api.timeout)),
+            auto_decompress=False,
+        )
+        self._health_check = asyncio.ensure_future(self._check_health())
+
+    async def _close_session(self, app):
+        self._health_check.cancel()
+        await self.session.close()
+
+    async def _check_health(self):
+        interval = float(config.rest_api.health_check_interval)
+        while True:
+            await asyncio.sleep(interval)
+            for balancer in get_balancers():
+                for port in balancer.ejected_ports:
+                    url = 'http://{}:{}/nearest/v1/{}/0,0'.format(config.osrm.host, port, config.osrm.profile)
+                    try:
+                        async with self.session.get(url) as response:
+                            await response.read()
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        continue
+                    # any answer (OSRM returns 400 for coordinates far away from the map) means it is up again
+                    if response.status < 500:
+                        balancer.set_healthy(port)
+
+    async def learn(self, request):
+        if self.learn_event:
+            self.learn_event.set()
+        return web.Response(text='Re-starting learning...')
+
+    async def shutdown(self, request):
+        if self.shutdown_event:
+            self.shutdown_event.set()
+        return web.Response(text='Server shutting down...')
+
+    async def stats(self, request):
+        return web.json_response(dict(
+            cache=self.response_cache.statistics if self.response_cache else None,
+            coalesced=self.single_flight.coalesced,
+            hedged=self.hedged,
+            outstanding={balancer.ports[0]: balancer.outstanding for balancer in get_balancers()},
+        ))
+
+    async def batch(self, request):
+        try:
+            legs = (await request.json())['legs']
+            durations = await asyncio.get_event_loop().run_in_executor(None, get_batch_durations, legs)
+        except (ValueError, KeyError, TypeError) as e:
+            return web.Response(status=400, text='Invalid batch: {}'.format(e))
+        except (OSError, http.client.HTTPException) as e:
+            logging.warning('Batch: {}'.format(e))
+            return web.Response(status=502, text='OSRM instance not available')
+        return web.json_response(dict(code='Ok', durations=durations))
+
+    async def osrm_proxy_request(self, request):
+        query, timestamp = parse_request(request.match_info['path'], request.query_string)
+        try:
+            time_window = get_time_window_by_timestamp(timestamp)
+        except ValueError:
+            return web.Response(status=400, text='Invalid timestamp {}'.format(timestamp))
+        encoding = get_accept_encoding(request.headers.get('Accept-Encoding'))
+        if self.response_cache:
+            body = self.response_cache.get(query, time_window, encoding)
+            if body is not None:
+                return web.Response(body=body, content_type='application/json', headers=_get_headers(encoding))
+        leader = []
+
+        def fetch():
+            leader.append(True)
+            return self._fetch(get_balancer(time_window), query, encoding)
+
+        try:
+            status, content_encoding, body = await self.single_flight.do(
+                (normalize_query(query), time_window.name, encoding),
+                fetch,
+                discard=_release_body,
+            )
+            if not isinstance(body, bytes):
+                if not leader:
+                    # the response of the leader is streamed, it cannot be shared
+                    status, content_encoding, body = await fetch()
+                return await self._stream(request, status, content_encoding, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning('{}: {}'.format(query, e))
+            return web.Response(status=502, text='OSRM instance on port {} not available'.format(time_window.port))
+        if self.response_cache and status == 200 and content_encoding == encoding:
+            self.response_cache.put(query, time_window, body, encoding)
+        return web.Response(body=body, status=status, content_type='application/json',
+                            headers=_get_headers(content_encoding))
+
+    async def _stream(self, request, status: int, content_encoding, upstream) -> web.StreamResponse:
+        """Relay the body of an upstream response in chunks as it arrives
+
+        Once the headers are sent, a failure cannot be answered with 502 any more: if OSRM fails, the connection
+        to the client is aborted, so it does not take the truncated body for a complete one.
+        """
+        response = web.StreamResponse(status=status, headers=_get_headers(content_encoding))
+        response.content_type = 'application/json'
+        if upstream.content_length is not None:
+            response.content_length = upstream.content_length
+        healthy = True
+        try:
+            await response.prepare(request)
+            chunks = upstream.iter_chunks()
+            while True:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    healthy = False
+                    logging.warning('Streaming from OSRM replica on port {} failed: {}'.format(upstream.port, e))
+                    if request.transport is not None:
+                        request.transport.abort()
+                    return response
+                try:
+                    await response.write(chunk)
+                except ConnectionError:
+                    logging.debug('Client disconnected while streaming {}'.format(request.path_qs))
+                    return response
+            await response.write_eof()
+        finally:
+            upstream.release(healthy=healthy)
+        return response
+
+    async def _fetch(self, balancer: ReplicaBalancer, query: str, encoding=None) -> tuple:
+        try:
+            return await self._fetch_hedged(balancer, query, encoding)
+        except aiohttp.ClientConnectionError:
+            if len(balancer.ports) < 2:
+                raise
+            # the replica is down and ejected now, so this goes to another one
+            return await self._fetch_hedged(balancer, query, encoding)
+
+    async def _fetch_hedged(self, balancer: ReplicaBalancer, query: str, encoding=None) -> tuple:
+        port = balancer.acquire()
+        first = asyncio.ensure_future(self._fetch_from_replica(balancer, port, query, encoding))
+        if self.hedge_delay <= 0 or len(balancer.ports) < 2:
+            return await first
+        done, _ = await asyncio.wait([first], timeout=self.hedge_delay)
+        if first in done:
+            return first.result()
+        self.hedged += 1
+        second = asyncio.ensure_future(
+            self._fetch_from_replica(balancer, balancer.acquire(exclude=(port,)), query, encoding)
+        )
+        pending = {first, second}
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results = [task.result() for task in done if task.exception() is None]
+            if results:
+                for loser in pending:
+                    loser.cancel()
+                for result in results[1:]:
+                    _release_body(result)
+                return results[0]
+            if not pending:
+                # both failed
+                return done.pop().result()
+
+    async def _fetch_from_replica(self, balancer: ReplicaBalancer, port: int, query: str, encoding=None) -> tuple:
+        """Return status, content encoding and body, the body is the unread response if it is going to be streamed"""
+        url = 'http://{}:{}{}'.format(config.osrm.host, port, query)
+        healthy = True
+        streamed = False
+        try:
+            response = await self.session.get(url, headers={'Accept-Encoding': encoding or 'identity'})
+            healthy = response.status < 500
+            content_encoding = response.headers.get('Content-Encoding')
+            if is_streamed(response.content_length):
+                streamed = True
+                return response.status, content_encoding, _UpstreamBody(response, balancer, port, healthy)
+            async with response:
+                return response.status, content_encoding, await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+            raise
+        finally:
+            if not streamed:
+                balancer.release(port, healthy=healthy)
+
+
+def _release_body(result: tuple):
+    """Release the replica of a streamed result that is not relayed"""
+    _, _, body = result
+    if not isinstance(body, bytes):
+        body.release()
+
+
+def _get_headers(content_encoding) -> dict:
+    headers = {'Vary': 'Accept-Encoding'}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    return headers
+
+
+def _serve_worker(learn_event, shutdown_event):
+    proxy = AsyncProxy(learn_event, shutdown_event)
+    web.run_app(
+        proxy.app,
+        host=config.rest_api.host,
+        port=int(config.rest_api.port),
+        reuse_port=True,
+        access_log=None,
+        print=None,
+    )
+
+
+class ProxyWorkers(object):
+    """Worker processes of the async OSRM proxy, controlled by the parent process"""
+
+    def __init__(self, workers=None):
+        # fork rather than spawn: the workers need neither a fresh interpreter nor the main module
+        context = multiprocessing.get_context('fork')
+        self.learn_event = context.Event()
+        self.shutdown_event = context.Event()
+        self.processes = [
+            context.Process(target=_serve_worker, args=(self.learn_event, self.shutdown_event), daemon=True)
+            for _ in range(int(workers or config.rest_api.workers))
+        ]
+
+    def start(self):
+        """Start the workers, preferably before any other thread is running in this process"""
+        for process in self.processes:
+            process.start()
+        logging.info('Started {} OSRM proxy workers on {}:{}'.format(
+            len(self.processes),
+            config.rest_api.host,
+            config.rest_api.port,
+        ))
+
+    def wait(self, learn=None, poll_interval=1.0):
+        """Block until /shutdown is requested and call learn() whenever /learn is requested"""
+        while not self.shutdown_event.wait(poll_interval):
+            if self.learn_event.is_set():
+                self.learn_event.clear()
+                if learn:
+                    learn()
+        self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        logging.info('Stopped OSRM proxy workers')
+
+
+def serve(learn=None, workers=None):
+    proxy_workers = ProxyWorkers(workers)
+    proxy_workers.start()
+    proxy_workers.wait(learn=learn)
@@ -0,0 +1,116 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Predictions of a trained DNNRegressor with NumPy
+
+- The kernels and biases of the dense layers are read from the estimator after training
+  (dnn/hiddenlayer_<i>/kernel and bias, dnn/logits/kernel and bias).
+- The forward pass is a matrix multiplication per layer with ReLU (the default activation of DNNRegressor)
+  after each hidden layer, without the graph and session of estimator.predict().
+- Only the single numeric feature column of features.py is supported, its input layer passes the features through.
+- The weights can be saved to and loaded from a .npz file.
+- benchmark() compares the prediction times with TensorFlow.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+
+class NumpyDnn(object):
+    def __init__(self, kernels: list, biases: list):
+        if not kernels or len(kernels) != len(biases):
+            raise ValueError('Need one bias per kernel, got {} kernels and {} biases'.format(len(kernels), len(biases)))
+        self.kernels = [np.asarray(kernel, dtype=np.float32) for kernel in kernels]
+        self.biases = [np.asarray(bias, dtype=np.float32) for bias in biases]
+
+    @property
+    def input_size(self) -> int:
+        return self.kernels[0].shape[0]
+
+    @staticmethod
+    def from_estimator(estimator) -> 'NumpyDnn':
+        """Read the weights of the hidden layers and the logits layer of a trained DNNRegressor"""
+        names = set(estimator.get_variable_names())
+        layers = []
+        while 'dnn/hiddenlayer_{}/kernel'.format(len(layers)) in names:
+            layers.append('dnn/hiddenlayer_{}'.format(len(layers)))
+        layers.append('dnn/logits')
+        return NumpyDnn(
+            [estimator.get_variable_value('{}/kernel'.format(layer)) for layer in layers],
+            [estimator.get_variable_value('{}/bias'.format(layer)) for layer in layers],
+        )
+
+    @staticmethod
+    def load(path: str) -> 'NumpyDnn':
+        with np.load(path) as npz:
+            layer_count = len(npz.files) // 2
+            return NumpyDnn(
+                [npz['kernel_{}'.format(i)] for i in range(layer_count)],
+                [npz['bias_{}'.format(i)] for i in range(layer_count)],
+            )
+
+    def save(self, path: str):
+        arrays = {}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays['kernel_{}'.format(i)] = kernel
+            arrays['bias_{}'.format(i)] = bias
+        np.savez(path, **arrays)
+        logging.info('Saved {} layers to {}'.format(len(self.kernels), path))
+
+    def predict(self, features: np.ndarray, chunk_size=None) -> np.ndarray:
+        """Return the predictions of the rows of a float32 feature matrix (rows x tags) as float32 array"""
+        if features.shape[1] != self.input_size:
+            raise ValueError('Expected {} features, got {}'.format(self.input_size, features.shape[1]))
+        chunk_size = chunk_size or max(len(features), 1)
+        predictions = np.empty(len(features), dtype=np.float32)
+        for start in range(0, len(features), chunk_size):
+            outputs = features[start:start + chunk_size]
+            for kernel, bias in zip(self.kernels[:-1], self.biases[:-1]):
+                outputs = np.maximum(np.dot(outputs, kernel) + bias, 0)
+            predictions[start:start + chunk_size] = (np.dot(outputs, self.kernels[-1]) + self.biases[-1])[:, 0]
+        return predictions
+
+
+def benchmark(learning, features: np.ndarray) -> dict:
+    """Return the seconds of the TensorFlow and the NumPy predictions of a trained Learning and their max difference"""
+    t1 = time.time()
+    tensorflow_predictions = learning.predict_features(features, use_numpy=False)
+    tensorflow_seconds = time.time() - t1
+    t1 = time.time()
+    numpy_predictions = learning.predict_features(features, use_numpy=True)
+    numpy_seconds = time.time() - t1
+    results = dict(
+        rows=len(features),
+        tensorflow=tensorflow_seconds,
+        numpy=numpy_seconds,
+        max_difference=float(np.abs(tensorflow_predictions - numpy_predictions).max()) if len(features) else 0.0,
+    )
+    logging.info('Predicted {} rows with TensorFlow in {:.3f} s and with NumPy in {:.3f} s'.format(
+        len(features), tensorflow_seconds, numpy_seconds))
+    return results
+
+
+if __name__ == '__main__':
+    from osrmlearning.learning import Learning
+    from osrmlearning.route import get_random_example_routes
+    example_learning = Learning(get_random_example_routes(200), get_random_example_routes(50))
+    example_learning.learn()
+    example_features = np.random.rand(100000, example_learning.train_features.shape[1]).astype(np.float32)
+    example_features /= example_features.sum(axis=1, keepdims=True)
+    print(benchmark(example_learning, example_features))
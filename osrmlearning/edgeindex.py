@@ -0,0 +1,150 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-memory index from pairs of consecutive OSM nodes to ways
+
+- Built once from way_nodes, which is streamed out of the database with COPY in binary format
+  (or read from the store of a PbfOsmDatabase).
+- Node IDs are mapped to dense indices (position in the sorted array of all node IDs),
+  so that a pair of nodes fits into one uint64 key: first index << 32 | second index.
+- Keys (both directions of each edge) are sorted, lookups use binary search (numpy.searchsorted).
+- The arrays are saved as .npy files in config.osm.edge_index_dir and memory-mapped by later runs.
+  They are rebuilt when the fingerprint of way_nodes changes (see OsmDatabase.get_table_fingerprint()).
+- Only ways with a highway tag are indexed, buildings, land use or boundaries that share nodes with a road
+  do not take its edges.
+- If several highways share an edge, the lowest way ID is used.
+"""
+
+import logging
+import os
+import time
+
+import numpy as np
+
+from osrmlearning import config
+from osrmlearning.osmdatabase import OsmDatabase
+
+# increment when build() changes, so that existing indexes are rebuilt
+_INDEX_VERSION = 2
+
+
+class EdgeIndex(object):
+    _instance = None
+
+    def __init__(self, node_ids: np.ndarray, keys: np.ndarray, way_ids: np.ndarray):
+        self.node_ids = node_ids
+        self.keys = keys
+        self.way_ids = way_ids
+
+    @staticmethod
+    def get_instance():
+        if not EdgeIndex._instance:
+            EdgeIndex._instance = EdgeIndex.load_or_build()
+        return EdgeIndex._instance
+
+    @staticmethod
+    def load_or_build(directory=None):
+        directory = directory or config.osm.edge_index_dir
+        db = OsmDatabase.get_instance()
+        fingerprint = '{}:{}'.format(_INDEX_VERSION, db.get_table_fingerprint('way_nodes'))
+        fingerprint_file = os.path.join(directory, 'fingerprint.txt')
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                if f.read() == fingerprint:
+                    return EdgeIndex.load(directory)
+        edge_index = EdgeIndex.build(db)
+        edge_index.save(directory)
+        with open(fingerprint_file, 'w') as f:
+            f.write(fingerprint)
+        return edge_index
+
+    @staticmethod
+    def load(directory: str):
+        t1 = time.time()
+        edge_index = EdgeIndex(*(
+            np.load(os.path.join(directory, '{}.npy'.format(name)), mmap_mode='r')
+            for name in ('node_ids', 'keys', 'way_ids')
+        ))
+        logging.info('Loaded edge index with {} edges from {} in {:.3f} seconds'.format(
+            len(edge_index.keys), directory, time.time() - t1))
+        return edge_index
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for name in ('node_ids', 'keys', 'way_ids'):
+            np.save(os.path.join(directory, '{}.npy'.format(name)), getattr(self, name))
+
+    @staticmethod
+    def build(db: OsmDatabase):
+        t1 = time.time()
+        way_ids, nodes = db.get_way_node_arrays()
+        highway = np.isin(way_ids, db.get_highway_way_ids())
+        way_ids = way_ids[highway]
+        nodes = nodes[highway]
+        del highway
+        logging.info('Got {} way nodes of highways in {:.1f} seconds'.format(len(way_ids), time.time() - t1))
+
+        # way_nodes is ordered by way and sequence, so consecutive rows of the same way are edges
+        same_way = way_ids[1:] == way_ids[:-1]
+        edge_way_ids = way_ids[:-1][same_way]
+        node_ids, node_indices = np.unique(nodes, return_inverse=True)
+        del nodes
+        if len(node_ids) >= 2 ** 32:
+            raise RuntimeError('Too many nodes for the edge index: {}'.format(len(node_ids)))
+        first = node_indices[:-1][same_way].astype(np.uint64)
+        second = node_indices[1:][same_way].astype(np.uint64)
+        del node_indices
+        keys = np.concatenate((first << np.uint64(32) | second, second << np.uint64(32) | first))
+        edge_way_ids = np.concatenate((edge_way_ids, edge_way_ids))
+        order = np.lexsort((edge_way_ids, keys))
+        keys = keys[order]
+        edge_way_ids = edge_way_ids[order]
+        # keep the lowest way ID of edges that belong to several highways
+        unique = np.ones(len(keys), dtype=bool)
+        unique[1:] = keys[1:] != keys[:-1]
+        edge_index = EdgeIndex(node_ids, keys[unique], edge_way_ids[unique])
+        logging.info('Built edge index with {} edges of {} ways in {:.1f} seconds'.format(
+            len(edge_index.keys), len(np.unique(way_ids)), time.time() - t1))
+        return edge_index
+
+    def _get_node_indices(self, nodes) -> np.ndarray:
+        """Return the dense index of each node, -1 for unknown nodes"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        indices = np.searchsorted(self.node_ids, nodes)
+        indices[indices == len(self.node_ids)] = 0
+        known = len(self.node_ids) > 0 and self.node_ids[indices] == nodes
+        return np.where(known, indices, -1)
+
+    def get_ways(self, nodes) -> list:
+        """Return the IDs of the ways along a sequence of nodes, in route order and without duplicates"""
+        if len(nodes) < 2 or not len(self.keys):
+            return []
+        indices = self._get_node_indices(nodes)
+        first = indices[:-1]
+        second = indices[1:]
+        known = (first >= 0) & (second >= 0)
+        keys = first[known].astype(np.uint64) << np.uint64(32) | second[known].astype(np.uint64)
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        way_ids = self.way_ids[positions[self.keys[positions] == keys]]
+        _, first_occurrences = np.unique(way_ids, return_index=True)
+        return way_ids[np.sort(first_occurrences)].tolist()
+
+
+if __name__ == '__main__':
+    example_nodes = [1835029415, 2134103308, 1982053901, 26574106, 1146801017, 20958816, 26574106]
+    print(EdgeIndex.get_instance().get_ways(example_nodes))
@@ -14,12 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import defaultdict
 import datetime
 import json
 import logging
 import math
 import re
 import shutil
+import time
 from types import FunctionType
 from typing import Iterable
 
@@ -29,13 +31,14 @@ from progress.bar import Bar
 
 from osrmlearning import config, start_time
 # from osrmlearning.hereclient import get_travel_time_by_route
-from osrmlearning.route import get_random_example_routes
+from osrmlearning.route import get_random_example_routes, set_tf_final_osrm_travel_times
 from osrmlearning.timewindow import get_time_window_by_route
 
 
 def evaluate(iterate_routes: FunctionType):
-    count = 0
+    batch_requests = config.evaluation.batch_requests == '1'
     routes = []
+    routes_by_port = defaultdict(list)
     # noinspection PyArgumentList
     for route in iterate_routes():
         try:
@@ -46,10 +49,21 @@ def evaluate(iterate_routes: FunctionType):
             route.tf_scaled_osrm_travel_time = route.osrm_travel_time
         port = get_time_window_by_route(route).port
         # logging.debug('port={}'.format(port))
-        route.set_tf_final_osrm_travel_time(port)
+        if batch_requests:
+            routes_by_port[port].append(route)
+        else:
+            route.set_tf_final_osrm_travel_time(port)
         # route.here_travel_time = get_travel_time_by_route(route)
         # route.set_here_travel_time()
         routes.append(route)
+    for port, port_routes in routes_by_port.items():
+        t1 = time.time()
+        set_tf_final_osrm_travel_times(port_routes, port)
+        logging.info('Got TF final OSRM travel times for {} routes from port {} in {:.1f} seconds'.format(
+            len(port_routes), port, time.time() - t1))
+
+    count = 0
+    for route in routes:
         count += 1
         if count > int(config.evaluation.log_limit):
             continue
@@ -0,0 +1,55 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Input features of the TensorFlow model
+
+- All tags are one feature FEATURE_NAME of shape (number of tags,), the column of a tag is its tag ID
+  (see TagVocabulary).
+- The features of routes are built as one float32 matrix (routes x tags): the tag counts of all routes are
+  stacked and normalized at once, like Route.osm_tag_fractions of each route.
+- The features of ways are the rows of a WayFeatureMatrix.
+"""
+
+import numpy as np
+
+from osrmlearning import config
+from osrmlearning.tagvocabulary import TagVocabulary
+
+FEATURE_NAME = 'osm_tags'
+
+
+def get_route_features(routes: list, binary_tags=None) -> tuple:
+    """Return the tag fractions of the routes as float32 matrix (routes x tags) and their travel time ratios"""
+    if binary_tags is None:
+        binary_tags = config.tensorflow.binary_tags == '1'
+    features = np.zeros((len(routes), len(TagVocabulary.get_instance())), dtype=np.float32)
+    for row, route in enumerate(routes):
+        features[row] = route.osm_tag_counts
+    if binary_tags:
+        features = (features > 0).astype(np.float32)
+    else:
+        totals = features.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1  # don't divide by zero
+        features /= totals
+    labels = np.array([route.travel_time_ratio for route in routes], dtype=np.float32)
+    return features, labels
+
+
+if __name__ == '__main__':
+    from osrmlearning.route import get_random_example_routes
+    example_features, example_labels = get_route_features(get_random_example_routes())
+    print(example_features.shape, example_labels)
@@ -16,28 +16,24 @@
 
 import logging
 import random
+import time
 
+import numpy as np
 import tensorflow as tf
 from progress.bar import Bar
 
 from osrmlearning import config
+from osrmlearning.dnninference import NumpyDnn
+from osrmlearning.features import FEATURE_NAME, get_route_features
+from osrmlearning.modelstore import ModelStore
 from osrmlearning.osmdatabase import OsmDatabase
+from osrmlearning.tagvocabulary import TagVocabulary
+from osrmlearning.wayfeatures import WayFeatureMatrix
 
 
-def _escape_tag(tag: str) -> str:
-    return tag.replace(config.osm.separator, config.osm.escaped_separator)
-
-
-def _get_dataset(routes: list) -> tf.data.Dataset:
+def _get_dataset(features: np.ndarray, labels: np.ndarray) -> tf.data.Dataset:
     logging.info('Getting dataset...')
-    features = {
-        _escape_tag(tag): [
-            route.osm_tag_fractions[tag]
-            for route in routes
-        ] for tag in config.osm.tags
-    }
-    labels = [route.travel_time_ratio for route in routes]
-    dataset = tf.data.Dataset.from_tensor_slices((features, labels))
+    dataset = tf.data.Dataset.from_tensor_slices(({FEATURE_NAME: features}, labels))
     buffer_size = len(labels)
     # batch_size = len(labels)
     batch_size = int(config.tensorflow.batch_size)
@@ -45,6 +41,19 @@ def _get_dataset(routes: list) -> tf.data.Dataset:
     return dataset
 
 
+def _get_prediction_dataset(features: np.ndarray) -> tf.data.Dataset:
+    """Features in their original order, for predictions that are matched with routes or ways"""
+    dataset = tf.data.Dataset.from_tensor_slices({FEATURE_NAME: features})
+    return dataset.batch(int(config.tensorflow.batch_size))
+
+
+def get_prediction_chunk_size(tag_count: int, memory_mb=None) -> int:
+    """Number of ways whose dense float32 features fit into config.tensorflow.prediction_memory_mb"""
+    if memory_mb is None:
+        memory_mb = float(config.tensorflow.prediction_memory_mb)
+    return max(int(memory_mb * 1024 * 1024) // (np.dtype(np.float32).itemsize * max(tag_count, 1)), 1)
+
+
 def _get_hidden_units(size: int) -> list:  # no useful topology so far
     divisor = 2
     size //= divisor
@@ -59,33 +68,53 @@ def _get_hidden_units(size: int) -> list:  # no useful topology so far
 
 
 class Learning(object):
-    def __init__(self, train_routes: list, eval_routes: list):
+    def __init__(self, train_routes: list, eval_routes: list, model_store: ModelStore = None):
+        """With a model_store, the estimator continues from the saved model and trains only on new routes"""
         logging.info('Got {} train routes and {} eval routes'.format(
             len(train_routes),
             len(eval_routes),
         ))
         if not len(train_routes) or not len(eval_routes):
             raise RuntimeError('No train routes or eval routes')
-        self.train_routes = train_routes
+        self.model_store = model_store
+        self.full_training = model_store is None or not model_store.trained
+        self.train_routes = model_store.get_train_routes(train_routes) if model_store else train_routes
         self.eval_routes = eval_routes
         random.shuffle(self.train_routes)
         random.shuffle(self.eval_routes)
-        feature_columns = [tf.feature_column.numeric_column(_escape_tag(tag)) for tag in config.osm.tags]
+        self.train_features, self.train_labels = get_route_features(self.train_routes)
+        self.eval_features, self.eval_labels = get_route_features(self.eval_routes)
+        feature_columns = [
+            tf.feature_column.numeric_column(FEATURE_NAME, shape=(len(TagVocabulary.get_instance()),)),
+        ]
         hidden_units = config.tensorflow.hidden_units
         # hidden_units = _get_hidden_units(len(feature_columns))
-        # self.estimator = tf.estimator.DNNRegressor(hidden_units, feature_columns, model_dir='data/saved_models/')
-        self.estimator = tf.estimator.DNNRegressor(hidden_units, feature_columns)
+        model_dir = model_store.directory if model_store else None
+        self.estimator = tf.estimator.DNNRegressor(hidden_units, feature_columns, model_dir=model_dir)
         self.eval_predictions = None
+        self.numpy_dnn = None
 
     def learn(self):
-        logging.info('Begin training...')
-        train_steps = max(len(self.train_routes) * int(config.tensorflow.repetitions), int(config.tensorflow.min_steps))
-        self.estimator.train(lambda: _get_dataset(self.train_routes), steps=train_steps)
-        logging.info('Finished training')
-        eval_result = self.estimator.evaluate(lambda: _get_dataset(self.eval_routes), steps=len(self.eval_routes))
+        if len(self.train_routes):
+            logging.info('Begin training...')
+            train_steps = len(self.train_routes) * int(config.tensorflow.repetitions)
+            if self.full_training:
+                train_steps = max(train_steps, int(config.tensorflow.min_steps))
+            self.estimator.train(lambda: _get_dataset(self.train_features, self.train_labels), steps=train_steps)
+            if self.model_store:
+                self.model_store.save_manifest(self.train_routes, train_steps)
+            logging.info('Finished training')
+        else:
+            logging.info('No new train routes, using the saved model')
+        eval_result = self.estimator.evaluate(
+            lambda: _get_dataset(self.eval_features, self.eval_labels),
+            steps=len(self.eval_routes),
+        )
         logging.info('Quick evaluation: {}'.format(eval_result))
-        self.eval_predictions = self.estimator.predict(lambda: _get_dataset(self.eval_routes))
+        # not shuffled, the predictions are matched with the eval routes in iterate_eval_routes()
+        self.eval_predictions = self.estimator.predict(lambda: _get_prediction_dataset(self.eval_features))
         logging.info('Finished evaluation predictions')
+        self.numpy_dnn = NumpyDnn.from_estimator(self.estimator)
 
     def iterate_eval_routes(self):
         if not self.eval_predictions:
@@ -96,36 +125,82 @@ class Learning(object):
             except StopIteration:
                 raise
 
-    def predict_all_scaling_factors_by_way_ids(self) -> dict:
-        logging.info('Predicting all scaling factors of all OSM way IDs...')
-        scaling_factors_by_way_ids = {}
-        db = OsmDatabase.get_instance()
-        way_tag_ratios = db.get_all_way_tag_ratios()
-        way_ids = sorted(way_tag_ratios.keys())
+    def predict_features(self, features: np.ndarray, use_numpy=None) -> np.ndarray:
+        """Return the predicted scaling factors of the rows of a float32 feature matrix (rows x tags)
+
+        The rows are fed in chunks of get_prediction_chunk_size() rows, the predictions of each chunk are written
+        into one preallocated array. If config.tensorflow.numpy_inference, the weights of the trained
+        estimator are applied with NumPy (see NumpyDnn) instead of running estimator.predict().
+        """
+        if use_numpy is None:
+            use_numpy = config.tensorflow.numpy_inference == '1'
+        tag_count = features.shape[1]
+        chunk_size = get_prediction_chunk_size(tag_count)
+        logging.info('Predicting {} feature rows in chunks of {} rows with {}...'.format(
+            len(features), chunk_size, 'NumPy' if use_numpy else 'TensorFlow'))
+        if use_numpy:
+            if not self.numpy_dnn:
+                raise RuntimeError('No weights. Need to learn first.')
+            t1 = time.time()
+            scaling_factors = self.numpy_dnn.predict(features, chunk_size)
+            seconds = time.time() - t1
+            logging.info('Predicted {} scaling factors in {:.1f} seconds ({:.0f} rows/second)'.format(
+                len(features), seconds, len(features) / max(seconds, 1e-9)))
+            return scaling_factors
+
+        def generate_chunks():
+            for start in range(0, len(features), chunk_size):
+                yield {FEATURE_NAME: features[start:start + chunk_size]}
 
         def input_fn():
-            tag_ratios = {
-                _escape_tag(tag): [
-                    way_tag_ratios[way_id][tag]
-                    for way_id in way_ids
-                ] for tag in config.osm.tags
-            }
-            logging.info('Number of tag ratios: {}'.format(len(tag_ratios)))
-            dataset = tf.data.Dataset.from_tensor_slices((tag_ratios,))
-            return dataset.batch(len(tag_ratios))
-
-        logging.info('Preparing TensorFlow predictions...')
-        predictions = self.estimator.predict(input_fn)
-        logging.info('Finished predictions')
-        logging.info('Mapping the predictions to OSM way IDs...')
-        logging.info('The first iteration will take longer than the rest.')
-        bar = Bar('Predictions:', max=len(way_ids), suffix=config.progress.suffix)
-        for way_id in way_ids:
-            bar.next()
-            scaling_factors_by_way_ids[way_id] = next(predictions)['predictions'][0]
+            return tf.data.Dataset.from_generator(
+                generate_chunks,
+                {FEATURE_NAME: tf.float32},
+                {FEATURE_NAME: tf.TensorShape([None, tag_count])},
+            )
+
+        scaling_factors = np.empty(len(features), dtype=np.float32)
+        if not len(features):
+            return scaling_factors
+        t1 = time.time()
+        offset = 0
+        bar = Bar('Predictions:', max=len(features), suffix=config.progress.suffix)
+        # one result per chunk instead of one per row
+        for predictions in self.estimator.predict(input_fn, yield_single_examples=False):
+            chunk = predictions['predictions'][:, 0]
+            scaling_factors[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+            bar.next(len(chunk))
         bar.finish()
-        logging.info('Predicted {} scaling factors in {} seconds'.format(bar.index, bar.elapsed))
-        return scaling_factors_by_way_ids
+        if offset != len(features):
+            raise RuntimeError('Got {} predictions for {} feature rows'.format(offset, len(features)))
+        seconds = time.time() - t1
+        logging.info('Predicted {} scaling factors in {:.1f} seconds ({:.0f} rows/second)'.format(
+            offset, seconds, offset / max(seconds, 1e-9)))
+        return scaling_factors
+
+    def predict_way_features(self, way_features: WayFeatureMatrix) -> np.ndarray:
+        """Return the predicted scaling factors of the rows of way_features as float32 array
+
+        Ways with the same tags have the same features, so only the distinct rows are predicted
+        and their predictions are scattered back to the ways.
+        """
+        t1 = time.time()
+        unique_features, inverse = way_features.unique(get_prediction_chunk_size(len(way_features.tags)))
+        logging.info('Got {} distinct feature rows of {} ways ({:.1f} ways per row) in {:.1f} seconds'.format(
+            len(unique_features), len(way_features), len(way_features) / max(len(unique_features), 1),
+            time.time() - t1))
+        scaling_factors = self.predict_features(unique_features)[inverse]
+        seconds = time.time() - t1
+        logging.info('Predicted the scaling factors of {} ways in {:.1f} seconds ({:.0f} ways/second)'.format(
+            len(way_features), seconds, len(way_features) / max(seconds, 1e-9)))
+        return scaling_factors
+
+    def predict_all_scaling_factors(self) -> tuple:
+        """Return the sorted IDs of all ways with tags and their predicted scaling factors as arrays"""
+        logging.info('Predicting all scaling factors of all OSM way IDs...')
+        way_features = OsmDatabase.get_instance().get_all_way_features()
+        return way_features.way_ids, self.predict_way_features(way_features)
 
 
 # def main(argv):
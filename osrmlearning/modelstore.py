@@ -0,0 +1,129 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Saved models of the time windows for incremental training
+
+- Each time window has one model directory per feature set in config.tensorflow.model_dir:
+  <time window>--<feature hash>, the hash covers the TagVocabulary, binary_tags and hidden_units.
+- The estimator keeps its checkpoints there and continues training from the latest one.
+  With config.tensorflow.numpy_inference, run.py saves the weights of the trained model to weights.npz
+  (see dnninference.py).
+- The keys of the trained routes (Route.key) are appended to routes.txt after each training,
+  then manifest.json is written: the start timestamp of the newest trained route (routes without one are
+  not considered), the number of trained routes and steps. Nothing is written if there were no routes to train.
+- A later run trains only on the routes whose keys are not in routes.txt, including routes that arrived late
+  with older timestamps and routes that were left out by config.routes.max_count.
+- run.py splits train and eval routes by their keys, so a route that was trained on is never evaluated.
+- If the feature set changed, there is no model directory for the new hash yet and the model is trained
+  on all routes. A directory without manifest (interrupted training) is removed and trained from scratch.
+- With config.tensorflow.incremental_training = 0, every run trains from scratch on all routes.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from osrmlearning import config
+from osrmlearning.tagvocabulary import TagVocabulary
+
+_MODEL_VERSION = 2
+
+
+def get_feature_hash() -> str:
+    """Hash of everything that makes the checkpoints of a model incompatible with the current config"""
+    return hashlib.sha1('{}:{}:{}:{}'.format(
+        _MODEL_VERSION,
+        TagVocabulary.get_instance().hash,
+        config.tensorflow.binary_tags == '1',
+        ','.join(str(units) for units in config.tensorflow.hidden_units),
+    ).encode()).hexdigest()[:16]
+
+
+class ModelStore(object):
+    def __init__(self, name: str, directory=None):
+        self.name = name
+        self.feature_hash = get_feature_hash()
+        self.directory = os.path.join(
+            directory or config.tensorflow.model_dir,
+            '{}--{}'.format(name, self.feature_hash),
+        )
+        self.manifest_file = os.path.join(self.directory, 'manifest.json')
+        self.routes_file = os.path.join(self.directory, 'routes.txt')
+        self.weights_file = os.path.join(self.directory, 'weights.npz')
+        self.manifest = {}
+        self.route_keys = set()
+        if config.tensorflow.incremental_training == '1' and os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            with open(self.routes_file) as f:
+                self.route_keys = set(f.read().split())
+
+    @property
+    def trained(self) -> bool:
+        """Whether there is a saved model with a manifest"""
+        return bool(self.manifest)
+
+    @property
+    def trained_until(self):
+        """Start timestamp (POSIX seconds) of the newest trained route, None if no trained route had one"""
+        return self.manifest.get('trained_until')
+
+    def get_train_routes(self, routes: list) -> list:
+        """Return the routes that the saved model was not trained on, all routes if there is no saved model"""
+        if not self.trained:
+            if os.path.exists(self.directory):
+                logging.info('Removing model {} without manifest'.format(self.directory))
+                shutil.rmtree(self.directory)
+            logging.info('Training model {} from scratch on {} routes'.format(self.directory, len(routes)))
+            return routes
+        new_routes = [route for route in routes if route.key not in self.route_keys]
+        logging.info('Training model {} on {} out of {} routes, {} routes were trained until {}'.format(
+            self.directory, len(new_routes), len(routes), len(self.route_keys),
+            datetime.datetime.fromtimestamp(self.trained_until) if self.trained_until is not None else None))
+        return new_routes
+
+    def save_manifest(self, routes: list, steps: int):
+        """Record the trained routes after the checkpoint of the training was written"""
+        if not routes:
+            return
+        timestamps = [route.start_timestamp.timestamp() for route in routes if route.start_timestamp is not None]
+        if self.trained_until is not None:
+            timestamps.append(self.trained_until)
+        new_keys = [key for key in set(route.key for route in routes) if key not in self.route_keys]
+        # written before the manifest, keys of an interrupted save belong to the written checkpoint anyway
+        with open(self.routes_file, 'a') as f:
+            f.write(''.join('{}\n'.format(key) for key in sorted(new_keys)))
+        self.route_keys.update(new_keys)
+        self.manifest = dict(
+            name=self.name,
+            feature_hash=self.feature_hash,
+            trained_until=max(timestamps, default=None),
+            routes=len(self.route_keys),
+            steps=self.manifest.get('steps', 0) + steps,
+            updated=datetime.datetime.now().strftime('%Y-%m-%d--%H-%M-%S'),
+        )
+        with open(self.manifest_file + '.new', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.manifest_file + '.new', self.manifest_file)
+
+
+if __name__ == '__main__':
+    model_store = ModelStore('example')
+    print(model_store.directory, model_store.trained_until)
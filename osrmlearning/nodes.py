@@ -0,0 +1,68 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compact encoding of OSM node sequences
+
+- Consecutive nodes of a route usually have similar IDs, so only the difference to the previous node is stored.
+- Differences are zigzag-encoded (small negative numbers become small positive numbers)
+  and written as varints (7 bits per byte, high bit set if more bytes follow).
+- Uncompressed node sequences are kept as array('q') (8 bytes per node) instead of tuples of boxed ints.
+"""
+
+from array import array
+import sys
+
+
+def encode_nodes(nodes) -> bytes:
+    data = bytearray()
+    previous = 0
+    for node in nodes:
+        delta = node - previous
+        previous = node
+        value = delta << 1 if delta >= 0 else (-delta << 1) - 1
+        while value > 0x7f:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+    return bytes(data)
+
+
+def decode_nodes(data: bytes) -> array:
+    nodes = array('q')
+    node = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        node += (value >> 1) ^ -(value & 1)
+        nodes.append(node)
+        value = 0
+        shift = 0
+    return nodes
+
+
+def get_tuple_size(count: int) -> int:
+    """Return the approximate memory size of a tuple of count OSM node IDs (for comparison)"""
+    return sys.getsizeof(()) + count * (8 + sys.getsizeof(2 ** 32))
+
+
+if __name__ == '__main__':
+    example_nodes = (1835029415, 2134103308, 1982053901, 26574106, 1146801017, 20958816, 26574106)
+    print(len(encode_nodes(example_nodes)), decode_nodes(encode_nodes(example_nodes)))
@@ -14,12 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
 import logging
+import os
+import tempfile
+import time
 
+import numpy as np
 from postgres import Postgres
 
 from osrmlearning import config
+from osrmlearning.osmpbf import PbfOsmDatabase
+from osrmlearning.osmsqlite import SqliteOsmDatabase
+from osrmlearning.tagvocabulary import TagVocabulary
+from osrmlearning.wayfeatures import WayFeatureMatrix
+
+# increment when the query of get_way_features_table() changes, so that existing tables are rebuilt
+_WAY_FEATURES_VERSION = 2
+# tag IDs, keys and values of the TagVocabulary as a common table expression, see TagVocabulary.get_sql_params()
+_VOCABULARY = '''
+    vocabulary AS (
+        SELECT * FROM unnest(%(tag_ids)s::int[], %(keys)s::text[], %(values)s::text[]) AS vocabulary (tag_id, k, v)
+    )
+'''
+# PostgreSQL binary COPY format: 11 bytes signature, 4 bytes flags, 4 bytes header extension length
+_COPY_HEADER_SIZE = 19
+# per row: field count, then length and value of each field (way_id bigint, node_id bigint), all big-endian
+_COPY_ROW_DTYPE = np.dtype([
+    ('field_count', '>i2'),
+    ('way_id_size', '>i4'),
+    ('way_id', '>i8'),
+    ('node_id_size', '>i4'),
+    ('node_id', '>i8'),
+])
+# the file ends with a field count of -1
+_COPY_TRAILER_SIZE = 2
 
 
 # TODO init DB, import OSM data with osmosis (pgsimp)
@@ -29,22 +60,27 @@ from osrmlearning import config
 class OsmDatabase(Postgres):
     _instance = None
 
-    def __init__(self):
+    def __init__(self, **kwargs):
         # noinspection PyProtectedMember
         url = 'postgres://{}:{}@{}:{}/{}'.format(*config.postgres._asdict().values())
         # logging.debug(url)  # will log password!
-        super().__init__(url)
+        super().__init__(url, **kwargs)
 
     @staticmethod
     def get_instance():
+        """Return the database of config.osm.backend, PbfOsmDatabase and SqliteOsmDatabase have the same queries"""
         if not OsmDatabase._instance:
-            OsmDatabase._instance = OsmDatabase()
+            if config.osm.backend == 'pbf':
+                OsmDatabase._instance = PbfOsmDatabase.get_instance()
+            elif config.osm.backend == 'sqlite':
+                if not os.path.exists(config.osm.sqlite_file):
+                    source = PbfOsmDatabase.get_instance() if config.osm.sqlite_source == 'pbf' else OsmDatabase()
+                    SqliteOsmDatabase.build(source)
+                OsmDatabase._instance = SqliteOsmDatabase()
+            else:
+                OsmDatabase._instance = OsmDatabase()
         return OsmDatabase._instance
 
-    @staticmethod
-    def _format_tags(tags: list) -> dict:
-        return {tag.tag: tag.counter for tag in tags}
-
     # # deprecated
     # @staticmethod
     # def _format_tags_list(tags: list) -> list:
@@ -89,37 +125,105 @@ class OsmDatabase(Postgres):
     #     params = node_id,
     #     return self.all(sql, params)
 
-    def get_ways_by_nodes(self, node_ids: list) -> list:
+    def get_highway_way_ids(self) -> np.ndarray:
+        """Return the sorted IDs of all ways with a highway tag as int64 array"""
+        sql = 'SELECT DISTINCT way_id FROM way_tags WHERE k = \'highway\' ORDER BY way_id;'
+        return np.array(self.all(sql), dtype=np.int64)
+
+    def get_ways_by_nodes(self, node_ids) -> list:
         # logging.debug('get_ways_by_nodes({})'.format(node_ids))
         if not node_ids:
             return []
-        sql = 'SELECT way_id FROM way_nodes WHERE node_id IN %s GROUP BY way_id HAVING COUNT(*) > 1;'
-        params = tuple(node_ids),
+        sql = 'SELECT way_id FROM way_nodes WHERE node_id = ANY(%s) GROUP BY way_id HAVING COUNT(*) > 1;'
+        params = list(node_ids),
         return self.all(sql, params)
 
+    def copy_way_nodes(self, f):
+        """Write way_id and node_id of all way nodes, ordered by way and sequence, in binary COPY format to a file"""
+        sql = 'COPY (SELECT way_id, node_id FROM way_nodes ORDER BY way_id, sequence_id) TO STDOUT (FORMAT binary);'
+        with self.get_cursor() as cursor:
+            cursor.copy_expert(sql, f)
+
+    def get_way_node_arrays(self) -> tuple:
+        """Return the way ID and node ID of all way nodes, ordered by way and sequence, as two int64 arrays"""
+        with tempfile.TemporaryFile() as f:
+            self.copy_way_nodes(f)
+            row_count = (f.tell() - _COPY_HEADER_SIZE - _COPY_TRAILER_SIZE) // _COPY_ROW_DTYPE.itemsize
+            rows = np.memmap(f, dtype=_COPY_ROW_DTYPE, mode='r', offset=_COPY_HEADER_SIZE, shape=(row_count,))
+            if row_count and (rows[0]['way_id_size'] != 8 or rows[0]['node_id_size'] != 8):
+                raise RuntimeError('way_nodes.way_id and way_nodes.node_id must be bigint')
+            way_ids = rows['way_id'].astype(np.int64)
+            node_ids = rows['node_id'].astype(np.int64)
+            del rows
+        return way_ids, node_ids
+
+    def get_table_fingerprint(self, table: str) -> str:
+        """Return a string that changes whenever the table is re-created or modified (e.g. by a new OSM import)
+
+        Based on the statistics collector, which may lag a few seconds behind writes of open connections.
+        """
+        sql = '''
+            SELECT CONCAT_WS(':', current_database(), c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del)
+            FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.relname = %s;
+        '''
+        params = table,
+        return self.one(sql, params)
+
     # def get_distance_by_way(self, way_id: int) -> float:
     #     ...
 
-    def get_all_tags_by_nodes(self, node_ids: list) -> dict:
+    def get_all_tags_by_nodes(self, node_ids) -> dict:
+        """Return {tag_id: counter} of the tags of the TagVocabulary of the nodes and of the ways between them"""
         # logging.debug('get_all_tags_by_nodes({})'.format(node_ids))
         if not node_ids:
             return {}
         sql = '''
-            SELECT CONCAT(k, '=', v) AS tag, COUNT(*) AS counter FROM (
-                SELECT k, v FROM node_tags WHERE node_id IN %s
+            WITH {}
+            SELECT tag_id, COUNT(*) AS counter FROM (
+                SELECT k, v FROM node_tags WHERE node_id = ANY(%(node_ids)s)
                 UNION ALL
                 SELECT k, v FROM way_tags WHERE way_id IN (
-                    SELECT way_id FROM way_nodes WHERE node_id IN %s
+                    SELECT way_id FROM way_nodes WHERE node_id = ANY(%(node_ids)s)
                     GROUP BY way_id HAVING COUNT(*) > 1
                 )
-            ) AS tags GROUP BY k, v;
-        '''
-        #     ) AS tags WHERE CONCAT(k, '=', v) IN %s GROUP BY k, v;
-        # '''
-        # params = tuple(node_ids), tuple(node_ids), config.osm.tags
-        params = tuple(node_ids), tuple(node_ids)
-        tags = self.all(sql, params)
-        return self._format_tags(tags)
+            ) AS tags JOIN vocabulary USING (k, v) GROUP BY tag_id;
+        '''.format(_VOCABULARY)
+        params = dict(node_ids=list(node_ids), **TagVocabulary.get_instance().get_sql_params())
+        return {row.tag_id: row.counter for row in self.all(sql, params)}
+
+    def get_tag_counts_by_routes(self, node_ids_list: list) -> np.ndarray:
+        """Like get_all_tags_by_nodes(), but for the node sequences of many routes in one query
+
+        Returns the counts of the tags of the TagVocabulary as an array with one row per route in input order.
+        """
+        vocabulary = TagVocabulary.get_instance()
+        routes = []
+        node_ids = []
+        for route, route_node_ids in enumerate(node_ids_list):
+            routes.extend([route] * len(route_node_ids))
+            node_ids.extend(route_node_ids)
+        counts = np.zeros((len(node_ids_list), len(vocabulary)), dtype=np.int32)
+        if not node_ids:
+            return counts
+        sql = '''
+            WITH route_nodes AS (
+                SELECT DISTINCT route, node_id FROM unnest(%(routes)s::int[], %(node_ids)s::bigint[])
+                AS route_nodes (route, node_id)
+            ), route_ways AS (
+                SELECT route, way_id FROM route_nodes JOIN way_nodes USING (node_id)
+                GROUP BY route, way_id HAVING COUNT(*) > 1
+            ), {}
+            SELECT route, tag_id, COUNT(*) AS counter FROM (
+                SELECT route, k, v FROM route_nodes JOIN node_tags USING (node_id)
+                UNION ALL
+                SELECT route, k, v FROM route_ways JOIN way_tags USING (way_id)
+            ) AS tags JOIN vocabulary USING (k, v) GROUP BY route, tag_id;
+        '''.format(_VOCABULARY)
+        params = dict(routes=routes, node_ids=node_ids, **vocabulary.get_sql_params())
+        for row in self.all(sql, params):
+            counts[row.route, row.tag_id] = row.counter
+        return counts
 
     # def get_all_tags_by_way(self, way_id: int) -> dict:
     #     logging.debug('get_all_tags_by_way({})'.format(way_id))
@@ -140,19 +244,133 @@ class OsmDatabase(Postgres):
     #     return self._format_tags(tags)
 
     def get_all_tags_of_all_ways(self) -> list:
+        """Return (way_id, tag_id, counter) of the tags of the TagVocabulary of all ways and their nodes"""
         # logging.debug('get_all_tags_of_all_ways()')
         sql = '''
-            SELECT way_id, CONCAT(k, '=', v) AS tag, COUNT(*) AS counter FROM (
+            WITH {}
+            SELECT way_id, tag_id, COUNT(*) AS counter FROM (
                 SELECT way_id, k, v FROM
                     way_tags
                 UNION ALL
                 SELECT way_id, k, v FROM
                     way_nodes JOIN node_tags ON way_nodes.node_id = node_tags.node_id
-            ) AS tags WHERE CONCAT(k, '=', v) IN %s GROUP BY way_id, k, v;
-        '''
-        params = tuple(config.osm.tags),
+            ) AS tags JOIN vocabulary USING (k, v) GROUP BY way_id, tag_id;
+        '''.format(_VOCABULARY)
+        params = TagVocabulary.get_instance().get_sql_params()
         return self.all(sql, params)
 
+    def get_way_features_table(self) -> str:
+        """Return the name of the table with the tag counts of all ways for the configured tags
+
+        The table is keyed by a hash of the tags and rebuilt only if the OSM import changed since it was built
+        (see get_table_fingerprint()). The new table replaces the old one in the same transaction.
+        """
+        vocabulary = TagVocabulary.get_instance()
+        tags_hash = hashlib.sha1('{}:{}'.format(_WAY_FEATURES_VERSION, vocabulary.hash).encode()).hexdigest()[:16]
+        table = 'way_features_{}'.format(tags_hash)
+        fingerprint = ';'.join(self.get_table_fingerprint(t) for t in ('way_tags', 'way_nodes', 'node_tags'))
+        self.run('''
+            CREATE TABLE IF NOT EXISTS way_features_state (
+                tags_hash TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                created TIMESTAMP NOT NULL
+            );
+        ''')
+        state_sql = '''
+            SELECT fingerprint FROM way_features_state WHERE tags_hash = %s AND to_regclass(%s) IS NOT NULL;
+        '''
+        if self.one(state_sql, (tags_hash, table)) == fingerprint:
+            return table
+        with self.get_cursor() as cursor:
+            # several processes may ask for the table at the same time, only one of them builds it
+            cursor.run('SELECT pg_advisory_xact_lock(hashtext(%s));', (table,))
+            if cursor.one(state_sql, (tags_hash, table)) == fingerprint:
+                return table
+            logging.info('Building way feature table {}...'.format(table))
+            t1 = time.time()
+            cursor.run('DROP TABLE IF EXISTS {}_new;'.format(table))
+            cursor.run('''
+                CREATE TABLE {}_new AS
+                WITH {}
+                SELECT way_id, tag_id, COUNT(*) AS counter FROM (
+                    SELECT way_id, k, v FROM
+                        way_tags
+                    UNION ALL
+                    SELECT way_id, k, v FROM
+                        way_nodes JOIN node_tags ON way_nodes.node_id = node_tags.node_id
+                ) AS tags JOIN vocabulary USING (k, v) GROUP BY way_id, tag_id ORDER BY way_id, tag_id;
+            '''.format(table, _VOCABULARY), vocabulary.get_sql_params())
+            cursor.run('ALTER TABLE {0}_new ADD CONSTRAINT {0}_new_pkey PRIMARY KEY (way_id, tag_id);'.format(table))
+            cursor.run('DROP TABLE IF EXISTS {};'.format(table))
+            cursor.run('ALTER TABLE {0}_new RENAME TO {0};'.format(table))
+            cursor.run('ALTER INDEX {0}_new_pkey RENAME TO {0}_pkey;'.format(table))
+            cursor.run('ANALYZE {};'.format(table))
+            cursor.run('''
+                INSERT INTO way_features_state VALUES (%s, %s, now())
+                ON CONFLICT (tags_hash) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, created = EXCLUDED.created;
+            ''', (tags_hash, fingerprint))
+        logging.info('Built way feature table {} in {:.1f} seconds'.format(table, time.time() - t1))
+        return table
+
+    def iterate_all_tags_of_all_ways(self, itersize=None, way_id_range=(None, None)):
+        """Like get_all_tags_of_all_ways(), but ordered by way and streamed from a server-side cursor
+
+        way_id_range limits the ways to first <= way_id < last, None means unlimited.
+        """
+        range_condition = '''
+            (%(first)s::bigint IS NULL OR {0} >= %(first)s) AND (%(last)s::bigint IS NULL OR {0} < %(last)s)
+        '''
+        if config.postgres.way_features == '1':
+            sql = 'SELECT way_id, tag_id, counter FROM {} WHERE {} ORDER BY way_id;'.format(
+                self.get_way_features_table(),
+                range_condition.format('way_id'),
+            )
+        else:
+            sql = '''
+                WITH {}
+                SELECT way_id, tag_id, COUNT(*) AS counter FROM (
+                    SELECT way_id, k, v FROM
+                        way_tags
+                        WHERE {}
+                    UNION ALL
+                    SELECT way_id, k, v FROM
+                        way_nodes JOIN node_tags ON way_nodes.node_id = node_tags.node_id
+                        WHERE {}
+                ) AS tags JOIN vocabulary USING (k, v) GROUP BY way_id, tag_id ORDER BY way_id;
+            '''.format(
+                _VOCABULARY,
+                range_condition.format('way_tags.way_id'),
+                range_condition.format('way_nodes.way_id'),
+            )
+        params = dict(first=way_id_range[0], last=way_id_range[1], **TagVocabulary.get_instance().get_sql_params())
+        # a named cursor keeps the result on the server and fetches itersize rows at a time
+        with self.get_cursor(name='all_tags_of_all_ways') as cursor:
+            cursor.itersize = int(itersize or config.postgres.itersize)
+            cursor.run(sql, params)
+            yield from cursor
+
+    def _iterate_table(self, sql: str, itersize=None):
+        with self.get_cursor(name='iterate_table') as cursor:
+            cursor.itersize = int(itersize or config.postgres.itersize)
+            cursor.run(sql)
+            yield from cursor
+
+    def iterate_node_tags(self, itersize=None):
+        """Yield (node_id, k, v) of all node tags"""
+        return self._iterate_table('SELECT node_id, k, v FROM node_tags;', itersize)
+
+    def iterate_way_tags(self, itersize=None):
+        """Yield (way_id, k, v) of all way tags"""
+        return self._iterate_table('SELECT way_id, k, v FROM way_tags;', itersize)
+
+    def get_way_id_ranges(self, count: int) -> list:
+        """Split all way IDs into count ranges (first, last) with about the same number of ways"""
+        sql = 'SELECT percentile_disc(%s::float[]) WITHIN GROUP (ORDER BY id) FROM ways;'
+        params = [i / count for i in range(1, count)],
+        bounds = sorted(set(self.one(sql, params) or [])) if count > 1 else []
+        bounds = [None] + bounds + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
     # def get_tags_by_node(self, node_id: int) -> list:
     #     logging.debug('get_tags_by_node({})'.format(node_id))
     #     sql = 'SELECT k, v FROM node_tags WHERE node_id = %s;'
@@ -185,36 +403,63 @@ class OsmDatabase(Postgres):
     #     tags = self.all(sql, params)
     #     return self._format_tags_list(tags)
 
-    def get_all_way_tag_ratios(self) -> dict:
-        way_tag_counts = defaultdict(lambda: defaultdict(lambda: 0))
-        way_tag_ratios = defaultdict(lambda: defaultdict(lambda: 0.0))
+    def get_way_features(self, way_id_range=(None, None)) -> WayFeatureMatrix:
+        """Return the tag ratios (or binary tags if config.tensorflow.binary_tags) of the ways in a way ID range"""
+        return WayFeatureMatrix.from_rows(self.iterate_all_tags_of_all_ways(way_id_range=way_id_range)).normalize()
+
+    def get_tag_count_arrays(self, way_id_range=(None, None), itersize=None) -> tuple:
+        """Return the way IDs, tag IDs and counters of the tags of the ways in a way ID range as int64 arrays"""
+        itersize = int(itersize or config.postgres.itersize)
+        rows = self.iterate_all_tags_of_all_ways(itersize, way_id_range)
+        chunks = [np.zeros((0, 3), dtype=np.int64)]
+        while True:
+            chunk = list(itertools.islice(rows, itersize))
+            if not chunk:
+                break
+            chunks.append(np.array(chunk, dtype=np.int64))
+        return tuple(np.concatenate(chunks).T)
+
+    def get_all_way_features(self, partitions=None) -> WayFeatureMatrix:
+        """Like get_way_features() for all ways, split into way ID ranges that are queried in parallel
+
+        Each partition is queried by its own thread over its own connection, the server does the work in parallel.
+        No worker processes are forked, this may run while the threads of TensorFlow and the proxy are running.
+        """
+        partitions = int(partitions or config.postgres.partitions)
         logging.info('Get all tags of all ways from the database...')
-        result = self.get_all_tags_of_all_ways()
-        logging.info('Got all tags of all ways from the database')
-        for row in result:
-            # column is called 'counter' because 'count' is reserved by the database lib
-            way_tag_counts[row.way_id][row.tag] = row.counter
-        logging.debug('Finished way_tag_counts')
-        # if config.tensorflow.binary_tags != '0':
-        if config.tensorflow.binary_tags == '1':
-            for way in way_tag_counts.keys():
-                way_tag_counts[way].update({tag: 1 for tag, count in way_tag_counts[way].items() if count > 0})
-            logging.debug('Finished binary way_tag_counts')
-            return way_tag_counts
-        for way, tags in way_tag_counts.items():
-            total = sum(tags.values()) or 1  # avoid ZeroDivisionError
-            for tag, count in tags.items():
-                way_tag_ratios[way][tag] = count / total
-        logging.debug('Finished way_tag_ratios')
-        # # TODO improve persistence
-        # sep = config.route_data.outer_separator
-        # lines = [sep.join([str(row.way_id), row.tag, str(row.counter)]) + '\n' for row in result]
-        # logging.debug('Finished CSV lines')
-        # way_tags_file = 'data/osm/way_tags.csv'
-        # with open(way_tags_file, 'w') as f:
-        #     f.writelines(lines)
-        # logging.debug('Finished CSV file')
-        return way_tag_ratios
+        t1 = time.time()
+        if config.postgres.way_features == '1':
+            # build it once here rather than having all partitions wait for it
+            self.get_way_features_table()
+        way_id_ranges = self.get_way_id_ranges(partitions)
+        if len(way_id_ranges) < 2:
+            way_features = self.get_way_features()
+        else:
+            partial_way_features = []
+            # fresh connections, one per partition, closed afterwards
+            db = OsmDatabase(minconn=1, maxconn=len(way_id_ranges))
+            try:
+                with ThreadPoolExecutor(len(way_id_ranges)) as executor:
+                    for way_id_range, arrays, seconds in executor.map(
+                            lambda way_id_range: _get_tag_counts_of_partition(db, way_id_range),
+                            way_id_ranges,
+                    ):
+                        partial = WayFeatureMatrix.from_arrays(*arrays)
+                        logging.info('Got tags of {} ways with IDs from {} to {} in {:.1f} seconds'.format(
+                            len(partial), way_id_range[0], way_id_range[1], seconds))
+                        partial_way_features.append(partial)
+            finally:
+                db.pool.closeall()
+            way_features = WayFeatureMatrix.concatenate(partial_way_features).normalize()
+        logging.info('Got all tags of {} ways ({:.1f} MB) from the database in {} partitions in {:.1f} seconds'.format(
+            len(way_features), way_features.nbytes / 1024 / 1024, len(way_id_ranges), time.time() - t1))
+        return way_features
+
+
+def _get_tag_counts_of_partition(db: OsmDatabase, way_id_range: tuple) -> tuple:
+    t1 = time.time()
+    arrays = db.get_tag_count_arrays(way_id_range)
+    return way_id_range, arrays, time.time() - t1
 
 
 # 150186847  # name=Fahrenheitstraße
@@ -227,4 +472,4 @@ class OsmDatabase(Postgres):
 
 if __name__ == '__main__':
     db = OsmDatabase.get_instance()
-    db.get_all_way_tag_ratios()
+    db.get_all_way_features()
@@ -0,0 +1,526 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+OSM data read directly from an .osm.pbf file instead of a PostgreSQL import (config.osm.backend = pbf)
+
+- The file is split into blobs, which are decompressed and decoded by spawned worker processes.
+  The protobuf messages are decoded here (packed fields with numpy), no protobuf library is needed.
+- Only ways with a highway tag in config.osm.highway_tags_whitelist are kept
+  (or all ways with a highway tag if config.osm.pbf_all_highways = 1),
+  and of the tags of ways and nodes only those in config.osm.tags.
+- The result is saved as .npy files in config.osm.pbf_store_dir and memory-mapped by later runs.
+  It is rebuilt when the file, the tags or the whitelist change.
+- PbfOsmDatabase has the query methods of OsmDatabase, tags that are not in config.osm.tags are not counted.
+  Tag IDs of the store are those of the TagVocabulary.
+"""
+
+from collections import defaultdict
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from osrmlearning import config
+from osrmlearning.tagvocabulary import TagVocabulary
+from osrmlearning.wayfeatures import WayFeatureMatrix
+
+# increment when the store format or the filter changes, so that existing stores are rebuilt
+_STORE_VERSION = 1
+_ARRAYS = (
+    'way_ids',  # sorted
+    'way_indptr',  # the nodes of way i are way_node_ids[way_indptr[i]:way_indptr[i + 1]]
+    'way_node_ids',
+    'way_tag_indptr',  # the tags of way i are way_tag_ids[way_tag_indptr[i]:way_tag_indptr[i + 1]]
+    'way_tag_ids',  # ID in the TagVocabulary
+    'node_tag_node_ids',  # sorted, one entry per tag of a node
+    'node_tag_ids',
+    'node_way_node_ids',  # way_node_ids sorted
+    'node_way_rows',  # index of the way of each entry of node_way_node_ids
+)
+# number of ways of which the tags are counted at once by get_way_features()
+_FEATURE_CHUNK_SIZE = 1000000
+
+
+def decode_varints(data) -> np.ndarray:
+    """Decode a packed field of varints (7 bits per byte, high bit set if more bytes follow) to uint64"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    values = (data & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def decode_zigzag(values: np.ndarray) -> np.ndarray:
+    """Decode zigzag-encoded signed integers (sint64)"""
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _read_varint(data, position: int) -> tuple:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _iterate_fields(data):
+    """Yield field number and value of each field of a protobuf message, length-delimited values as memoryview"""
+    data = memoryview(data)
+    position = 0
+    while position < len(data):
+        key, position = _read_varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _read_varint(data, position)
+        elif wire_type == 2:
+            size, position = _read_varint(data, position)
+            value = data[position:position + size]
+            position += size
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield field, value
+
+
+def _expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Return the concatenation of range(start, start + count) for all starts and counts"""
+    total = int(counts.sum())
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + (np.arange(total) - offsets)
+
+
+def iterate_blobs(path: str):
+    """Yield offset and size of the OSMData blobs of a .osm.pbf file"""
+    with open(path, 'rb') as f:
+        while True:
+            header_size = f.read(4)
+            if not header_size:
+                return
+            blob_type = None
+            blob_size = 0
+            for field, value in _iterate_fields(f.read(struct.unpack('>I', header_size)[0])):
+                if field == 1:
+                    blob_type = bytes(value).decode()
+                elif field == 3:
+                    blob_size = value
+            if blob_type == 'OSMData':
+                yield f.tell(), blob_size
+            f.seek(blob_size, os.SEEK_CUR)
+
+
+def _read_blob(path: str, offset: int, size: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        blob = f.read(size)
+    for field, value in _iterate_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+    raise ValueError('Unsupported compression of the blob at offset {} of {}'.format(offset, path))
+
+
+class _BlockDecoder(object):
+    """Filter the nodes and ways of one PrimitiveBlock"""
+
+    def __init__(self, strings: list, keys: list, values: list, highway_values):
+        self.strings = strings
+        positions = defaultdict(list)
+        for index, string in enumerate(strings):
+            positions[string].append(index)
+        # tags are looked up by key index * number of strings + value index
+        lookup = {}
+        for tag_id, (key, value) in enumerate(zip(keys, values)):
+            for key_index in positions.get(key, ()):
+                for value_index in positions.get(value, ()):
+                    lookup[key_index * len(strings) + value_index] = tag_id
+        self.pairs = np.array(sorted(lookup), dtype=np.int64)
+        self.pair_tag_ids = np.array([lookup[pair] for pair in self.pairs.tolist()], dtype=np.int32)
+        self.highway_keys = np.array(positions.get('highway', []), dtype=np.int64)
+        self.highway_values = None if highway_values is None else np.array(
+            [index for value in highway_values for index in positions.get(value, ())], dtype=np.int64)
+
+    def get_tag_ids(self, keys: np.ndarray, values: np.ndarray) -> tuple:
+        """Return the positions of the configured tags among keys and values and their tag IDs"""
+        pairs = keys.astype(np.int64) * len(self.strings) + values.astype(np.int64)
+        positions = np.searchsorted(self.pairs, pairs)
+        positions[positions == len(self.pairs)] = 0
+        found = np.flatnonzero(self.pairs[positions] == pairs) if len(self.pairs) else np.zeros(0, dtype=np.int64)
+        return found, self.pair_tag_ids[positions[found]]
+
+    def is_highway(self, keys: np.ndarray, values: np.ndarray) -> bool:
+        highway = values[np.isin(keys, self.highway_keys)]
+        if self.highway_values is None:
+            return len(highway) > 0
+        return bool(np.isin(highway, self.highway_values).any())
+
+
+def _decode_blob(blob: tuple) -> dict:
+    """Decode one blob, return the configured tags of its nodes and the whitelisted ways"""
+    path, offset, size, keys, values, highway_values = blob
+    strings = []
+    groups = []
+    for field, value in _iterate_fields(_read_blob(path, offset, size)):
+        if field == 1:
+            strings = [bytes(string).decode('utf-8') for string_field, string in _iterate_fields(value)
+                       if string_field == 1]
+        elif field == 2:
+            groups.append(value)
+    decoder = _BlockDecoder(strings, keys, values, highway_values)
+    node_ids = []
+    node_tag_ids = []
+    way_ids = []
+    way_node_counts = []
+    way_node_ids = []
+    way_tag_counts = []
+    way_tag_ids = []
+    empty = np.zeros(0, dtype=np.uint64)
+    for group in groups:
+        for field, value in _iterate_fields(group):
+            if field == 1:
+                # Node
+                node_id, keys, values = 0, empty, empty
+                for node_field, node_value in _iterate_fields(value):
+                    if node_field == 1:
+                        node_id = (node_value >> 1) ^ -(node_value & 1)
+                    elif node_field == 2:
+                        keys = decode_varints(node_value)
+                    elif node_field == 3:
+                        values = decode_varints(node_value)
+                _, ids = decoder.get_tag_ids(keys, values)
+                node_ids.append(np.full(len(ids), node_id, dtype=np.int64))
+                node_tag_ids.append(ids)
+            elif field == 2:
+                # DenseNodes: delta-coded IDs, keys and values of all nodes in one array, 0 after each node
+                ids, keys_values = empty, empty
+                for dense_field, dense_value in _iterate_fields(value):
+                    if dense_field == 1:
+                        ids = np.cumsum(decode_zigzag(decode_varints(dense_value)))
+                    elif dense_field == 10:
+                        keys_values = decode_varints(dense_value)
+                delimiters = keys_values == 0
+                node_indices = np.cumsum(delimiters) - delimiters
+                key_positions = np.flatnonzero(~delimiters)[0::2]
+                found, ids_of_tags = decoder.get_tag_ids(keys_values[key_positions], keys_values[key_positions + 1])
+                node_ids.append(ids[node_indices[key_positions[found]]])
+                node_tag_ids.append(ids_of_tags)
+            elif field == 3:
+                # Way
+                way_id, keys, values, refs = 0, empty, empty, None
+                for way_field, way_value in _iterate_fields(value):
+                    if way_field == 1:
+                        way_id = way_value
+                    elif way_field == 2:
+                        keys = decode_varints(way_value)
+                    elif way_field == 3:
+                        values = decode_varints(way_value)
+                    elif way_field == 8:
+                        refs = way_value
+                if refs is None or not decoder.is_highway(keys, values):
+                    continue
+                nodes = np.cumsum(decode_zigzag(decode_varints(refs)))
+                _, ids = decoder.get_tag_ids(keys, values)
+                way_ids.append(way_id)
+                way_node_counts.append(len(nodes))
+                way_node_ids.append(nodes)
+                way_tag_counts.append(len(ids))
+                way_tag_ids.append(ids)
+    return dict(
+        node_ids=np.concatenate(node_ids or [empty]).astype(np.int64),
+        node_tag_ids=np.concatenate(node_tag_ids or [empty]).astype(np.int32),
+        way_ids=np.array(way_ids, dtype=np.int64),
+        way_node_counts=np.array(way_node_counts, dtype=np.int64),
+        way_node_ids=np.concatenate(way_node_ids or [empty]).astype(np.int64),
+        way_tag_counts=np.array(way_tag_counts, dtype=np.int64),
+        way_tag_ids=np.concatenate(way_tag_ids or [empty]).astype(np.int32),
+    )
+
+
+class PbfOsmDatabase(object):
+    _instance = None
+
+    def __init__(self, arrays: dict, tags: list, fingerprint: str):
+        for name in _ARRAYS:
+            setattr(self, name, arrays[name])
+        self.tags = tags
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def get_instance():
+        if not PbfOsmDatabase._instance:
+            PbfOsmDatabase._instance = PbfOsmDatabase.load_or_build()
+        return PbfOsmDatabase._instance
+
+    @staticmethod
+    def get_fingerprint(path: str) -> str:
+        """Return a string that changes whenever the file, the tags or the highway whitelist change"""
+        stat = os.stat(path)
+        options = '\n'.join([str(_STORE_VERSION), config.osm.pbf_all_highways] +
+                            sorted(config.osm.highway_tags_whitelist) + [TagVocabulary.get_instance().hash])
+        return '{}:{}:{}:{}'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime),
+                                    hashlib.sha1(options.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def load_or_build(path=None, directory=None):
+        path = path or config.osm.pbf_file
+        directory = directory or config.osm.pbf_store_dir
+        fingerprint = PbfOsmDatabase.get_fingerprint(path)
+        fingerprint_file = os.path.join(directory, 'fingerprint.txt')
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                if f.read() == fingerprint:
+                    return PbfOsmDatabase.load(directory)
+        db = PbfOsmDatabase.build(path)
+        db.save(directory)
+        return db
+
+    @staticmethod
+    def load(directory: str):
+        t1 = time.time()
+        arrays = {name: np.load(os.path.join(directory, '{}.npy'.format(name)), mmap_mode='r') for name in _ARRAYS}
+        with open(os.path.join(directory, 'tags.txt')) as f:
+            tags = f.read().splitlines()
+        with open(os.path.join(directory, 'fingerprint.txt')) as f:
+            fingerprint = f.read()
+        db = PbfOsmDatabase(arrays, tags, fingerprint)
+        logging.info('Loaded {} ways with {} nodes from {} in {:.3f} seconds'.format(
+            len(db.way_ids), len(db.way_node_ids), directory, time.time() - t1))
+        return db
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        # the fingerprint is written last, an interrupted save is rebuilt
+        fingerprint_file = os.path.join(directory, 'fingerprint.txt')
+        if os.path.exists(fingerprint_file):
+            os.remove(fingerprint_file)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, '{}.npy'.format(name)), getattr(self, name))
+        with open(os.path.join(directory, 'tags.txt'), 'w') as f:
+            f.write('\n'.join(self.tags))
+        with open(fingerprint_file, 'w') as f:
+            f.write(self.fingerprint)
+
+    @staticmethod
+    def build(path: str, workers=None):
+        t1 = time.time()
+        vocabulary = TagVocabulary.get_instance()
+        highway_values = None if config.osm.pbf_all_highways == '1' else config.osm.highway_tags_whitelist
+        blobs = [
+            (path, offset, size, vocabulary.keys, vocabulary.values, highway_values)
+            for offset, size in iterate_blobs(path)
+        ]
+        logging.info('Decoding {} blobs of {}...'.format(len(blobs), path))
+        parts = defaultdict(list)
+        # spawn: the process may already run learning and proxy threads, whose locks a forked child could inherit
+        with multiprocessing.get_context('spawn').Pool(int(workers or config.osm.pbf_workers) or None) as pool:
+            for part in pool.imap(_decode_blob, blobs):
+                for name, values in part.items():
+                    parts[name].append(values)
+        part_names = ('node_ids', 'node_tag_ids', 'way_ids', 'way_node_counts', 'way_node_ids', 'way_tag_counts',
+                      'way_tag_ids')
+        node_ids, node_tag_ids, way_ids, way_node_counts, way_node_ids, way_tag_counts, way_tag_ids = (
+            np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=np.int64) for name in part_names)
+        del parts
+        logging.info('Decoded {} ways and {} node tags in {:.1f} seconds'.format(
+            len(way_ids), len(node_ids), time.time() - t1))
+
+        way_indptr = np.concatenate(([0], np.cumsum(way_node_counts))).astype(np.int64)
+        way_tag_indptr = np.concatenate(([0], np.cumsum(way_tag_counts))).astype(np.int64)
+        if np.any(way_ids[1:] < way_ids[:-1]):
+            # files are usually sorted by ID, but it is not required
+            order = np.argsort(way_ids, kind='mergesort')
+            way_ids = way_ids[order]
+            way_node_ids = way_node_ids[_expand_ranges(way_indptr[:-1][order], way_node_counts[order])]
+            way_tag_ids = way_tag_ids[_expand_ranges(way_tag_indptr[:-1][order], way_tag_counts[order])]
+            way_indptr = np.concatenate(([0], np.cumsum(way_node_counts[order]))).astype(np.int64)
+            way_tag_indptr = np.concatenate(([0], np.cumsum(way_tag_counts[order]))).astype(np.int64)
+        order = np.argsort(node_ids, kind='mergesort')
+        node_rows = np.repeat(np.arange(len(way_ids), dtype=np.int32), np.diff(way_indptr))
+        node_way_order = np.argsort(way_node_ids, kind='mergesort')
+        db = PbfOsmDatabase(dict(
+            way_ids=way_ids,
+            way_indptr=way_indptr,
+            way_node_ids=way_node_ids,
+            way_tag_indptr=way_tag_indptr,
+            way_tag_ids=way_tag_ids.astype(np.int32),
+            node_tag_node_ids=node_ids[order],
+            node_tag_ids=node_tag_ids[order].astype(np.int32),
+            node_way_node_ids=way_node_ids[node_way_order],
+            node_way_rows=node_rows[node_way_order],
+        ), vocabulary.tags, PbfOsmDatabase.get_fingerprint(path))
+        logging.info('Built OSM store of {} ways with {} nodes from {} in {:.1f} seconds'.format(
+            len(way_ids), len(way_node_ids), path, time.time() - t1))
+        return db
+
+    @staticmethod
+    def _find(sorted_values: np.ndarray, values: np.ndarray) -> tuple:
+        """Return the index of each match of values in sorted_values and the index of the matching value"""
+        values = np.asarray(values, dtype=np.int64)
+        starts = np.searchsorted(sorted_values, values, side='left')
+        counts = np.searchsorted(sorted_values, values, side='right') - starts
+        return _expand_ranges(starts, counts), np.repeat(np.arange(len(values)), counts)
+
+    def _get_way_rows_by_nodes(self, node_ids) -> np.ndarray:
+        """Return the sorted rows of the ways that contain more than one of the nodes"""
+        positions, _ = self._find(self.node_way_node_ids, np.unique(np.asarray(node_ids, dtype=np.int64)))
+        rows, counts = np.unique(self.node_way_rows[positions], return_counts=True)
+        return rows[counts > 1]
+
+    def _count_tags(self, tag_ids: np.ndarray) -> np.ndarray:
+        return np.bincount(tag_ids, minlength=len(self.tags)).astype(np.int32)
+
+    def get_all_way_ids(self) -> list:
+        return self.way_ids.tolist()
+
+    def get_highway_way_ids(self) -> np.ndarray:
+        """Return the sorted IDs of all ways with a highway tag, the store keeps no other ways"""
+        return np.asarray(self.way_ids)
+
+    def get_ways_by_nodes(self, node_ids) -> list:
+        if not len(node_ids):
+            return []
+        return self.way_ids[self._get_way_rows_by_nodes(node_ids)].tolist()
+
+    def get_way_node_arrays(self) -> tuple:
+        """Return the way ID and node ID of all way nodes, ordered by way and sequence"""
+        return np.repeat(self.way_ids, np.diff(self.way_indptr)), np.asarray(self.way_node_ids)
+
+    def _iterate_tags(self, ids: np.ndarray, tag_ids: np.ndarray):
+        vocabulary = TagVocabulary(self.tags, separator=config.osm.separator)
+        key_values = list(zip(vocabulary.keys, vocabulary.values))
+        for start in range(0, len(ids), _FEATURE_CHUNK_SIZE):
+            for osm_id, tag_id in zip(ids[start:start + _FEATURE_CHUNK_SIZE].tolist(),
+                                      tag_ids[start:start + _FEATURE_CHUNK_SIZE].tolist()):
+                yield (osm_id,) + key_values[tag_id]
+
+    def iterate_node_tags(self, itersize=None):
+        """Yield (node_id, k, v) of all node tags in the store"""
+        return self._iterate_tags(self.node_tag_node_ids, self.node_tag_ids)
+
+    def iterate_way_tags(self, itersize=None):
+        """Yield (way_id, k, v) of all way tags in the store"""
+        return self._iterate_tags(np.repeat(self.way_ids, np.diff(self.way_tag_indptr)), self.way_tag_ids)
+
+    def get_table_fingerprint(self, table: str) -> str:
+        return '{}:{}'.format(table, self.fingerprint)
+
+    def _get_tag_ids_by_nodes(self, node_ids) -> np.ndarray:
+        node_tag_positions, _ = self._find(self.node_tag_node_ids, np.unique(np.asarray(node_ids, dtype=np.int64)))
+        rows = self._get_way_rows_by_nodes(node_ids)
+        way_tag_positions = _expand_ranges(self.way_tag_indptr[rows], np.diff(self.way_tag_indptr)[rows])
+        return np.concatenate((self.node_tag_ids[node_tag_positions], self.way_tag_ids[way_tag_positions]))
+
+    def get_all_tags_by_nodes(self, node_ids) -> dict:
+        """Return {tag_id: counter} of the tags of the nodes and of the ways between them"""
+        if not len(node_ids):
+            return {}
+        counts = self._count_tags(self._get_tag_ids_by_nodes(node_ids))
+        return {tag_id.item(): counts[tag_id].item() for tag_id in np.flatnonzero(counts)}
+
+    def get_tag_counts_by_routes(self, node_ids_list: list) -> np.ndarray:
+        counts = np.zeros((len(node_ids_list), len(self.tags)), dtype=np.int32)
+        for route, node_ids in enumerate(node_ids_list):
+            if len(node_ids):
+                counts[route] = self._count_tags(self._get_tag_ids_by_nodes(node_ids))
+        return counts
+
+    def get_way_id_ranges(self, count: int) -> list:
+        """Split all way IDs into count ranges (first, last) with about the same number of ways"""
+        bounds = sorted(set(
+            int(self.way_ids[len(self.way_ids) * i // count]) for i in range(1, count)
+        )) if count > 1 and len(self.way_ids) else []
+        bounds = [None] + bounds + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _get_tag_counts(self, first_row: int, last_row: int) -> tuple:
+        """Return way rows, tag IDs and counters of the tags of the ways and of their nodes, ordered by way and tag"""
+        rows = np.arange(first_row, last_row)
+        way_tag_rows = np.repeat(rows, np.diff(self.way_tag_indptr[first_row:last_row + 1]))
+        way_tag_ids = self.way_tag_ids[self.way_tag_indptr[first_row]:self.way_tag_indptr[last_row]]
+        # node tags are counted once for each occurrence of the node in the way
+        way_node_rows = np.repeat(rows, np.diff(self.way_indptr[first_row:last_row + 1]))
+        positions, way_nodes = self._find(
+            self.node_tag_node_ids,
+            self.way_node_ids[self.way_indptr[first_row]:self.way_indptr[last_row]],
+        )
+        keys = np.concatenate((way_tag_rows, way_node_rows[way_nodes])) * len(self.tags) + np.concatenate(
+            (way_tag_ids, self.node_tag_ids[positions]))
+        keys, counters = np.unique(keys, return_counts=True)
+        return keys // len(self.tags), keys % len(self.tags), counters
+
+    def iterate_all_tags_of_all_ways(self, itersize=None, way_id_range=(None, None)):
+        """Yield (way_id, tag_id, counter) of the configured tags of all ways, ordered by way"""
+        first_row, last_row = self._get_rows(way_id_range)
+        for start in range(first_row, last_row, _FEATURE_CHUNK_SIZE):
+            rows, tag_ids, counters = self._get_tag_counts(start, min(start + _FEATURE_CHUNK_SIZE, last_row))
+            for row, tag_id, counter in zip(rows.tolist(), tag_ids.tolist(), counters.tolist()):
+                yield int(self.way_ids[row]), tag_id, counter
+
+    def get_all_tags_of_all_ways(self) -> list:
+        return list(self.iterate_all_tags_of_all_ways())
+
+    def _get_rows(self, way_id_range: tuple) -> tuple:
+        first, last = way_id_range
+        first_row = np.searchsorted(self.way_ids, first) if first is not None else 0
+        last_row = np.searchsorted(self.way_ids, last) if last is not None else len(self.way_ids)
+        return int(first_row), int(last_row)
+
+    def get_way_features(self, way_id_range=(None, None)) -> WayFeatureMatrix:
+        """Return the tag ratios (or binary tags if config.tensorflow.binary_tags) of the ways in a way ID range"""
+        first_row, last_row = self._get_rows(way_id_range)
+        matrices = []
+        for start in range(first_row, last_row, _FEATURE_CHUNK_SIZE):
+            rows, tag_ids, counters = self._get_tag_counts(start, min(start + _FEATURE_CHUNK_SIZE, last_row))
+            way_rows, starts = np.unique(rows, return_index=True)
+            matrices.append(WayFeatureMatrix(
+                np.asarray(self.way_ids[way_rows]),
+                np.concatenate((starts, [len(rows)])).astype(np.int64),
+                tag_ids.astype(np.int32),
+                counters.astype(np.float32),
+                self.tags,
+            ))
+        return WayFeatureMatrix.concatenate(matrices).normalize()
+
+    def get_all_way_features(self, partitions=None) -> WayFeatureMatrix:
+        t1 = time.time()
+        way_features = self.get_way_features()
+        logging.info('Got all tags of {} ways ({:.1f} MB) from {} in {:.1f} seconds'.format(
+            len(way_features), way_features.nbytes / 1024 / 1024, config.osm.pbf_file, time.time() - t1))
+        return way_features
+
+
+if __name__ == '__main__':
+    db = PbfOsmDatabase.get_instance()
+    example_nodes = [1835029415, 2134103308, 1982053901, 26574106, 1146801017, 20958816, 26574106]
+    print(db.get_ways_by_nodes(example_nodes), db.get_all_tags_by_nodes(example_nodes))
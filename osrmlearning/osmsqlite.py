@@ -0,0 +1,303 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+OSM data in a single SQLite file (config.osm.backend = sqlite)
+
+- For machines without a PostgreSQL server, queries run in-process without network round trips.
+- Same tables as the PostgreSQL import (ways, way_nodes, node_tags, way_tags),
+  copied from PostgreSQL or from a PbfOsmDatabase (config.osm.sqlite_source) into config.osm.sqlite_file.
+- The file is built once, delete it to rebuild it after a new OSM import.
+- Tags are joined by (k, v) with the TagVocabulary in a temporary table, which is filled once.
+- Node IDs of queries are written to temporary tables, which are joined with the indexes of the tables
+  (CROSS JOIN makes SQLite start with the temporary table, it has no statistics about it).
+- The tags of all ways are streamed from a separate connection with its own vocabulary table.
+- benchmark() compares the query times with another backend on the same data.
+"""
+
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from osrmlearning import config
+from osrmlearning.tagvocabulary import TagVocabulary
+from osrmlearning.wayfeatures import WayFeatureMatrix
+
+_INSERT_CHUNK_SIZE = 1000000
+_CREATE_VOCABULARY = 'CREATE TEMP TABLE vocabulary (k TEXT, v TEXT, tag_id INTEGER, PRIMARY KEY (k, v)) WITHOUT ROWID;'
+
+
+def _insert_vocabulary(connection, vocabulary: TagVocabulary):
+    connection.executemany('INSERT INTO vocabulary VALUES (?, ?, ?);', zip(
+        vocabulary.keys, vocabulary.values, range(len(vocabulary))))
+
+
+class SqliteOsmDatabase(object):
+    def __init__(self, path=None):
+        self.path = path or config.osm.sqlite_file
+        if not os.path.exists(self.path):
+            raise FileNotFoundError('No OSM database {}, see SqliteOsmDatabase.build()'.format(self.path))
+        # autocommit, the temporary tables of the queries are not worth a transaction
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA temp_store = MEMORY;')
+        self.connection.executescript('''
+            CREATE TEMP TABLE query_nodes (node_id INTEGER PRIMARY KEY);
+            CREATE TEMP TABLE query_route_nodes (route INTEGER, node_id INTEGER, PRIMARY KEY (route, node_id))
+                WITHOUT ROWID;
+        ''')
+        self.connection.execute(_CREATE_VOCABULARY)
+        self.created = self.connection.execute('SELECT value FROM meta WHERE key = \'created\';').fetchone()[0]
+        # the temporary tables belong to the connection, which may be shared by several threads
+        self._lock = threading.Lock()
+        self._vocabulary = None
+
+    @staticmethod
+    def build(source, path=None):
+        """Copy the OSM data of an OsmDatabase or PbfOsmDatabase into a new SQLite file"""
+        path = path or config.osm.sqlite_file
+        t1 = time.time()
+        logging.info('Building {} from {}...'.format(path, type(source).__name__))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_path = '{}.new'.format(path)
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        connection = sqlite3.connect(new_path, isolation_level=None)
+        connection.executescript('''
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE ways (id INTEGER PRIMARY KEY);
+            CREATE TABLE way_nodes (way_id INTEGER, node_id INTEGER, sequence_id INTEGER,
+                PRIMARY KEY (way_id, sequence_id)) WITHOUT ROWID;
+            CREATE TABLE node_tags (node_id INTEGER, k TEXT, v TEXT);
+            CREATE TABLE way_tags (way_id INTEGER, k TEXT, v TEXT);
+        ''')
+        connection.execute('BEGIN;')
+        connection.executemany('INSERT INTO ways VALUES (?);', ((way_id,) for way_id in source.get_all_way_ids()))
+        way_ids, node_ids = source.get_way_node_arrays()
+        way_starts = np.flatnonzero(np.concatenate(([True], way_ids[1:] != way_ids[:-1])))
+        sequence_ids = np.arange(len(way_ids)) - np.repeat(way_starts, np.diff(np.append(way_starts, len(way_ids))))
+        for start in range(0, len(way_ids), _INSERT_CHUNK_SIZE):
+            stop = start + _INSERT_CHUNK_SIZE
+            connection.executemany('INSERT INTO way_nodes VALUES (?, ?, ?);', zip(
+                way_ids[start:stop].tolist(), node_ids[start:stop].tolist(), sequence_ids[start:stop].tolist()))
+        del way_ids, node_ids, sequence_ids
+        connection.executemany('INSERT INTO node_tags VALUES (?, ?, ?);', source.iterate_node_tags())
+        connection.executemany('INSERT INTO way_tags VALUES (?, ?, ?);', source.iterate_way_tags())
+        connection.execute('CREATE INDEX way_nodes_node_id_idx ON way_nodes (node_id, way_id);')
+        connection.execute('CREATE INDEX node_tags_node_id_idx ON node_tags (node_id);')
+        connection.execute('CREATE INDEX way_tags_way_id_idx ON way_tags (way_id);')
+        connection.execute('INSERT INTO meta VALUES (\'created\', ?);', (str(time.time()),))
+        connection.execute('COMMIT;')
+        connection.execute('ANALYZE;')
+        connection.close()
+        os.replace(new_path, path)
+        logging.info('Built {} in {:.1f} seconds'.format(path, time.time() - t1))
+
+    def _set_query_nodes(self, node_ids):
+        self.connection.execute('DELETE FROM query_nodes;')
+        self.connection.executemany('INSERT OR IGNORE INTO query_nodes VALUES (?);', ((n,) for n in node_ids))
+
+    def _set_vocabulary(self) -> TagVocabulary:
+        vocabulary = TagVocabulary.get_instance()
+        if vocabulary is not self._vocabulary:
+            self.connection.execute('DELETE FROM vocabulary;')
+            _insert_vocabulary(self.connection, vocabulary)
+            self._vocabulary = vocabulary
+        return vocabulary
+
+    def get_all_way_ids(self) -> list:
+        return [way_id for way_id, in self.connection.execute('SELECT id FROM ways ORDER BY id;')]
+
+    def get_highway_way_ids(self) -> np.ndarray:
+        """Return the sorted IDs of all ways with a highway tag as int64 array"""
+        sql = 'SELECT DISTINCT way_id FROM way_tags WHERE k = \'highway\' ORDER BY way_id;'
+        return np.array([way_id for way_id, in self.connection.execute(sql)], dtype=np.int64)
+
+    def get_ways_by_nodes(self, node_ids) -> list:
+        if not len(node_ids):
+            return []
+        sql = '''
+            SELECT way_id FROM query_nodes CROSS JOIN way_nodes USING (node_id) GROUP BY way_id HAVING COUNT(*) > 1;
+        '''
+        with self._lock:
+            self._set_query_nodes(node_ids)
+            return [way_id for way_id, in self.connection.execute(sql)]
+
+    def get_way_node_arrays(self) -> tuple:
+        """Return the way ID and node ID of all way nodes, ordered by way and sequence, as two int64 arrays"""
+        cursor = self.connection.execute('SELECT way_id, node_id FROM way_nodes ORDER BY way_id, sequence_id;')
+        chunks = [np.zeros((0, 2), dtype=np.int64)]
+        while True:
+            rows = cursor.fetchmany(_INSERT_CHUNK_SIZE)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64))
+        way_nodes = np.concatenate(chunks)
+        return way_nodes[:, 0].copy(), way_nodes[:, 1].copy()
+
+    def get_table_fingerprint(self, table: str) -> str:
+        return '{}:{}:{}'.format(os.path.basename(self.path), self.created, table)
+
+    def get_all_tags_by_nodes(self, node_ids) -> dict:
+        """Return {tag_id: counter} of the tags of the TagVocabulary of the nodes and of the ways between them"""
+        if not len(node_ids):
+            return {}
+        sql = '''
+            SELECT tag_id, COUNT(*) AS counter FROM (
+                SELECT k, v FROM query_nodes CROSS JOIN node_tags USING (node_id)
+                UNION ALL
+                SELECT k, v FROM way_tags WHERE way_id IN (
+                    SELECT way_id FROM query_nodes CROSS JOIN way_nodes USING (node_id)
+                    GROUP BY way_id HAVING COUNT(*) > 1
+                )
+            ) JOIN vocabulary USING (k, v) GROUP BY tag_id;
+        '''
+        with self._lock:
+            self._set_vocabulary()
+            self._set_query_nodes(node_ids)
+            return dict(self.connection.execute(sql))
+
+    def get_tag_counts_by_routes(self, node_ids_list: list) -> np.ndarray:
+        sql = '''
+            WITH route_ways AS (
+                SELECT route, way_id FROM query_route_nodes CROSS JOIN way_nodes USING (node_id)
+                GROUP BY route, way_id HAVING COUNT(*) > 1
+            )
+            SELECT route, tag_id, COUNT(*) AS counter FROM (
+                SELECT route, k, v FROM query_route_nodes CROSS JOIN node_tags USING (node_id)
+                UNION ALL
+                SELECT route, k, v FROM route_ways CROSS JOIN way_tags USING (way_id)
+            ) JOIN vocabulary USING (k, v) GROUP BY route, tag_id;
+        '''
+        with self._lock:
+            vocabulary = self._set_vocabulary()
+            counts = np.zeros((len(node_ids_list), len(vocabulary)), dtype=np.int32)
+            self.connection.execute('DELETE FROM query_route_nodes;')
+            self.connection.executemany('INSERT OR IGNORE INTO query_route_nodes VALUES (?, ?);', (
+                (route, node_id) for route, node_ids in enumerate(node_ids_list) for node_id in node_ids))
+            for route, tag_id, counter in self.connection.execute(sql):
+                counts[route, tag_id] = counter
+        return counts
+
+    def iterate_all_tags_of_all_ways(self, itersize=None, way_id_range=(None, None)):
+        """Yield (way_id, tag_id, counter) of the tags of the TagVocabulary of all ways, ordered by way
+
+        The rows are streamed from a connection of their own, itersize rows at a time, so the queries of other threads
+        neither wait for the iteration nor replace its vocabulary.
+        """
+        range_condition = '(:first IS NULL OR {0} >= :first) AND (:last IS NULL OR {0} < :last)'
+        sql = '''
+            SELECT way_id, tag_id, COUNT(*) AS counter FROM (
+                SELECT way_id, k, v FROM way_tags WHERE {}
+                UNION ALL
+                SELECT way_id, k, v FROM way_nodes JOIN node_tags USING (node_id) WHERE {}
+            ) JOIN vocabulary USING (k, v) GROUP BY way_id, tag_id ORDER BY way_id;
+        '''.format(range_condition.format('way_tags.way_id'), range_condition.format('way_nodes.way_id'))
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        try:
+            connection.execute('PRAGMA temp_store = MEMORY;')
+            connection.execute(_CREATE_VOCABULARY)
+            _insert_vocabulary(connection, TagVocabulary.get_instance())
+            cursor = connection.execute(sql, dict(first=way_id_range[0], last=way_id_range[1]))
+            itersize = int(itersize or config.postgres.itersize)
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            connection.close()
+
+    def get_all_tags_of_all_ways(self) -> list:
+        return list(self.iterate_all_tags_of_all_ways())
+
+    def get_way_id_ranges(self, count: int) -> list:
+        """Split all way IDs into count ranges (first, last) with about the same number of ways"""
+        way_count = self.connection.execute('SELECT COUNT(*) FROM ways;').fetchone()[0]
+        sql = 'SELECT id FROM ways ORDER BY id LIMIT 1 OFFSET ?;'
+        bounds = sorted(set(
+            self.connection.execute(sql, (way_count * i // count,)).fetchone()[0] for i in range(1, count)
+        )) if count > 1 and way_count else []
+        bounds = [None] + bounds + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def get_way_features(self, way_id_range=(None, None)) -> WayFeatureMatrix:
+        """Return the tag ratios (or binary tags if config.tensorflow.binary_tags) of the ways in a way ID range"""
+        return WayFeatureMatrix.from_rows(self.iterate_all_tags_of_all_ways(way_id_range=way_id_range)).normalize()
+
+    def get_all_way_features(self, partitions=None) -> WayFeatureMatrix:
+        t1 = time.time()
+        way_features = self.get_way_features()
+        logging.info('Got all tags of {} ways ({:.1f} MB) from {} in {:.1f} seconds'.format(
+            len(way_features), way_features.nbytes / 1024 / 1024, self.path, time.time() - t1))
+        return way_features
+
+
+def _get_example_routes(db, count: int, ways_per_route=20) -> list:
+    """Return node sequences of random ways joined together, like the nodes of OSRM routes"""
+    way_ids, node_ids = db.get_way_node_arrays()
+    way_starts = np.flatnonzero(np.concatenate(([True], way_ids[1:] != way_ids[:-1])))
+    way_stops = np.append(way_starts[1:], len(way_ids))
+    r = random.Random(0)
+    routes = []
+    for _ in range(count):
+        routes.append([])
+        for way in r.sample(range(len(way_starts)), min(ways_per_route, len(way_starts))):
+            routes[-1].extend(node_ids[way_starts[way]:way_stops[way]].tolist())
+    return routes
+
+
+def benchmark(other_db, db=None, route_count=1000) -> dict:
+    """Return the seconds of each query on this database and on another one (e.g. PostgreSQL) with the same data"""
+    db = db or SqliteOsmDatabase()
+    routes = _get_example_routes(db, route_count)
+    results = {}
+    for name, database in (('sqlite', db), (type(other_db).__name__, other_db)):
+        times = {}
+        t1 = time.time()
+        for route in routes:
+            database.get_ways_by_nodes(route)
+        times['get_ways_by_nodes'] = time.time() - t1
+        t1 = time.time()
+        for route in routes:
+            database.get_all_tags_by_nodes(route)
+        times['get_all_tags_by_nodes'] = time.time() - t1
+        t1 = time.time()
+        database.get_tag_counts_by_routes(routes)
+        times['get_tag_counts_by_routes'] = time.time() - t1
+        t1 = time.time()
+        database.get_way_features()
+        times['get_way_features'] = time.time() - t1
+        results[name] = times
+        logging.info('{}: {} routes: {}'.format(name, route_count, ', '.join(
+            '{} {:.3f} s'.format(query, seconds) for query, seconds in times.items())))
+    return results
+
+
+if __name__ == '__main__':
+    from osrmlearning.osmdatabase import OsmDatabase
+    postgres_db = OsmDatabase()
+    if not os.path.exists(config.osm.sqlite_file):
+        SqliteOsmDatabase.build(postgres_db)
+    print(benchmark(postgres_db))
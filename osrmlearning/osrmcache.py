@@ -0,0 +1,156 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent cache for OSRM routes
+
+- Entries are keyed by the OSRM dataset fingerprint, the profile and the coordinates.
+  A new OSRM image or OSM file changes the fingerprint, so old entries are never returned.
+- Travel time is stored as a number, the OSM nodes are delta/varint-encoded (see osrmlearning.nodes).
+- When the cache exceeds config.osrm.cache_max_size_mb, the least recently used entries are evicted.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from osrmlearning import config
+from osrmlearning.nodes import decode_nodes, encode_nodes
+
+# size of everything except the nodes blob, roughly
+_ENTRY_OVERHEAD = 64
+
+
+class OsrmRouteCache(object):
+    def __init__(self, fingerprint: str, filename=None, max_size_mb=None, commit_interval=1000):
+        self.fingerprint = fingerprint
+        self.filename = filename or config.osrm.cache_file
+        self.max_size = int(float(max_size_mb or config.osrm.cache_max_size_mb) * 1024 * 1024)
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL;')
+        self._connection.execute('PRAGMA synchronous = OFF;')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS routes (
+                fingerprint TEXT NOT NULL,
+                profile TEXT NOT NULL,
+                coordinates TEXT NOT NULL,
+                travel_time REAL NOT NULL,
+                nodes BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (fingerprint, profile, coordinates)
+            );
+        ''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used);')
+        self.size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM routes;').fetchone()[0]
+        logging.debug('Opened OSRM route cache {} ({:.1f} MB, fingerprint {})'.format(
+            self.filename, self.size / 1024 / 1024, fingerprint))
+
+    def get(self, coordinates: str, profile=None):
+        """Return the cached (travel_time, nodes) tuple or None"""
+        key = self.fingerprint, profile or config.osrm.profile, coordinates
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT travel_time, nodes FROM routes WHERE fingerprint = ? AND profile = ? AND coordinates = ?;',
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute(
+                'UPDATE routes SET last_used = ? WHERE fingerprint = ? AND profile = ? AND coordinates = ?;',
+                (time.time(),) + key,
+            )
+            self._count_write()
+        return row[0], decode_nodes(row[1])
+
+    def contains(self, coordinates: str, profile=None) -> bool:
+        """Check for an entry without touching the statistics or the LRU order"""
+        key = self.fingerprint, profile or config.osrm.profile, coordinates
+        with self._lock:
+            return self._connection.execute(
+                'SELECT 1 FROM routes WHERE fingerprint = ? AND profile = ? AND coordinates = ?;',
+                key,
+            ).fetchone() is not None
+
+    def put(self, coordinates: str, travel_time: float, nodes, profile=None):
+        key = self.fingerprint, profile or config.osrm.profile, coordinates
+        nodes = encode_nodes(nodes)
+        size = len(nodes) + len(coordinates) + _ENTRY_OVERHEAD
+        with self._lock:
+            previous = self._connection.execute(
+                'SELECT size FROM routes WHERE fingerprint = ? AND profile = ? AND coordinates = ?;',
+                key,
+            ).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?);',
+                key + (travel_time, nodes, size, time.time()),
+            )
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self._evict()
+            self._count_write()
+
+    def _evict(self, batch_size=1000):
+        # evict down to 90 % so that the next insert does not immediately evict again
+        target_size = 0.9 * self.max_size
+        while self.size > target_size:
+            rows = self._connection.execute(
+                'SELECT rowid, size FROM routes ORDER BY last_used LIMIT ?;',
+                (batch_size,),
+            ).fetchall()
+            if not rows:
+                break
+            rowids = []
+            for rowid, size in rows:
+                if self.size <= target_size:
+                    break
+                rowids.append((rowid,))
+                self.size -= size
+            self._connection.executemany('DELETE FROM routes WHERE rowid = ?;', rowids)
+            self.evictions += len(rowids)
+
+    def _count_write(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self._connection.commit()
+            self._uncommitted = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def log_statistics(self):
+        logging.info('OSRM route cache: {} hits, {} misses ({:.1f} % hit ratio), {} evictions, {:.1f} MB'.format(
+            self.hits,
+            self.misses,
+            100 * self.hit_ratio,
+            self.evictions,
+            self.size / 1024 / 1024,
+        ))
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
@@ -14,49 +14,241 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from array import array
 import collections
+from concurrent.futures import ThreadPoolExecutor
+import http.client
 import json
 import logging
+import threading
 import urllib.error
-import urllib.request
 
 from osrmlearning import config
 
+_connections = threading.local()
+
+OsrmRoute = collections.namedtuple('OsrmRoute', ['travel_time', 'osm_nodes'])
+
 # url = 'http://localhost:5000/route/v1/car/8.8473,53.1080;8.7859,53.0524?overview=false'
 
 
-def get_osrm_route(coordinates: str, host=None, port=None, profile=None) -> collections.namedtuple:
-    """Return an object containing the OSRM travel time and OSM nodes for given coordinates"""
-    # logging.debug('get_osrm_route({})'.format(coordinates))  # function is called in a loop, so don't fill up the log
-    route = ';'.join(','.join(reversed(lat_lon.split(','))) for lat_lon in coordinates.split(';'))
-    url_root = 'http://{}:{}'.format(host or config.osrm.host, port or config.osrm.port)
-    url = '{}/route/v1/{}/{}?overview=false&annotations=true'.format(url_root, profile or config.osrm.profile, route)
-    # logging.debug(url)
+def _get_connection(host: str, port: int) -> http.client.HTTPConnection:
+    """Return a keep-alive connection to host+port, one per thread so the connections can be reused safely"""
+    if not hasattr(_connections, 'pool'):
+        _connections.pool = {}
+    if (host, port) not in _connections.pool:
+        _connections.pool[host, port] = http.client.HTTPConnection(host, port)
+    return _connections.pool[host, port]
+
+
+def _request(query: str, host: str, port: int, headers=None) -> tuple:
+    """Send a GET request over a pooled keep-alive connection and return the connection and the unread response"""
+    for retry in (False, True):
+        connection = _get_connection(host, port)
+        try:
+            connection.request('GET', query, headers=headers or {})
+            return connection, connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            # the server may have closed an idle keep-alive connection, so reconnect once
+            connection.close()
+            del _connections.pool[host, port]
+            if retry:
+                logging.warning('http://{}:{}{}'.format(host, port, query))
+                raise
+
+
+def _get(query: str, host=None, port=None) -> bytes:
+    """Send a GET request over a pooled keep-alive connection and return the raw response body"""
+    host = host or config.osrm.host
+    port = int(port or config.osrm.port)
+    url = 'http://{}:{}{}'.format(host, port, query)
+    connection, response = _request(query, host, port)
     try:
-        response = json.loads(urllib.request.urlopen(url).read().decode())
-    except urllib.error.HTTPError:
+        body = response.read()
+    except (http.client.HTTPException, ConnectionError):
+        connection.close()
         logging.warning(url)
         raise
+    if response.status != 200:
+        logging.warning(url)
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    return body
+
+
+def get_osrm_route(coordinates: str, host=None, port=None, profile=None, cache=None) -> OsrmRoute:
+    """Return an object containing the OSRM travel time and OSM nodes for given coordinates
+
+    If an OsrmRouteCache is given, it is asked first and filled with the response.
+    """
+    # logging.debug('get_osrm_route({})'.format(coordinates))  # function is called in a loop, so don't fill up the log
+    profile = profile or config.osrm.profile
+    if cache is not None:
+        cached_route = cache.get(coordinates, profile=profile)
+        if cached_route is not None:
+            return OsrmRoute(*cached_route)
+    route = ';'.join(','.join(reversed(lat_lon.split(','))) for lat_lon in coordinates.split(';'))
+    query = '/route/v1/{}/{}?overview=false&annotations=true'.format(profile, route)
+    # logging.debug(query)
+    response = json.loads(_get(query, host=host, port=port).decode())
     # logging.debug(response)
     data = response['routes'][0]['legs'][0]
-    nodes = tuple(data['annotation']['nodes'])
+    nodes = array('q', data['annotation']['nodes'])
     duration = data['duration']
     # distance = data['distance']
     # logging.debug('duration={}, nodes={}'.format(duration, nodes))
-    return collections.namedtuple('OsrmRoute', ['travel_time', 'osm_nodes'])(duration, nodes)
+    if cache is not None:
+        cache.put(coordinates, duration, nodes, profile=profile)
+    return OsrmRoute(duration, nodes)
 
 
-def osrm_request(query: str, host=None, port=None) -> str:
-    """Forward a request to an OSRM instance running on a specified host+port and return the plain response"""
-    url = 'http://{}:{}{}'.format(host or config.osrm.host, port or config.osrm.port, query)
-    logging.debug(url)
-    try:
-        response = urllib.request.urlopen(url).read().decode()
-    except urllib.error.HTTPError:
-        logging.warning(url)
-        raise
-    logging.debug(response)
-    return response
+def iterate_osrm_routes(coordinates_list: list, host=None, port=None, profile=None, parallelism=None, cache=None):
+    """Yield the OSRM routes for many coordinates in input order, requested concurrently by a thread pool"""
+    parallelism = int(parallelism or config.osrm.parallelism)
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        yield from executor.map(
+            lambda coordinates: get_osrm_route(coordinates, host=host, port=port, profile=profile, cache=cache),
+            coordinates_list,
+        )
+
+
+def _get_table_durations(legs: list, host=None, port=None, profile=None) -> list:
+    """Return the durations of (source, destination) legs of "lon,lat" locations from one table request"""
+    locations = []
+    location_indices = {}
+    for location in (location for leg in legs for location in leg):
+        if location not in location_indices:
+            location_indices[location] = len(locations)
+            locations.append(location)
+    sources = sorted({location_indices[source] for source, _ in legs})
+    destinations = sorted({location_indices[destination] for _, destination in legs})
+    query = '/table/v1/{}/{}?sources={}&destinations={}'.format(
+        profile or config.osrm.profile,
+        ';'.join(locations),
+        ';'.join(str(source) for source in sources),
+        ';'.join(str(destination) for destination in destinations),
+    )
+    durations = json.loads(_get(query, host=host, port=port).decode())['durations']
+    rows = {source: row for row, source in enumerate(sources)}
+    columns = {destination: column for column, destination in enumerate(destinations)}
+    return [
+        durations[rows[location_indices[source]]][columns[location_indices[destination]]]
+        for source, destination in legs
+    ]
+
+
+def _get_table_chunks(legs: list, max_legs: int, max_cells: int) -> list:
+    """Split legs into lists of leg indices whose table (sources x destinations) has at most max_cells cells
+
+    The legs of a source are kept together, they share a row of the table.
+    """
+    legs_by_source = collections.OrderedDict()
+    for index, (source, _) in enumerate(legs):
+        legs_by_source.setdefault(source, []).append(index)
+    chunks = []
+    chunk = []
+    sources = set()
+    destinations = set()
+    for source, indices in legs_by_source.items():
+        for index in indices:
+            destination = legs[index][1]
+            cells = (len(sources) + (source not in sources)) * (len(destinations) + (destination not in destinations))
+            if chunk and (len(chunk) >= max_legs or cells > max_cells):
+                chunks.append(chunk)
+                chunk = []
+                sources = set()
+                destinations = set()
+            chunk.append(index)
+            sources.add(source)
+            destinations.add(destination)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def get_osrm_table_durations(coordinates_list: list, host=None, port=None, profile=None, chunk_size=None,
+                             max_cells=None) -> list:
+    """Return the OSRM travel time for each of many coordinates, using table requests for chunks of routes
+
+    A chunk has at most chunk_size routes and its table at most max_cells sources x destinations,
+    so the table follows the routes that are needed. Unreachable routes get NaN.
+    Chunks are requested concurrently like in iterate_osrm_routes().
+    """
+    chunk_size = int(chunk_size or config.osrm.table_chunk_size)
+    max_cells = int(max_cells or config.osrm.table_max_cells)
+    legs = [
+        tuple(','.join(reversed(lat_lon.split(','))) for lat_lon in coordinates.split(';'))
+        for coordinates in coordinates_list
+    ]
+    chunks = _get_table_chunks(legs, chunk_size, max_cells)
+    durations = [float('nan')] * len(legs)
+
+    def get_chunk_durations(chunk: list) -> list:
+        return _get_table_durations([legs[index] for index in chunk], host=host, port=port, profile=profile)
+
+    with ThreadPoolExecutor(max_workers=int(config.osrm.parallelism)) as executor:
+        for chunk, chunk_durations in zip(chunks, executor.map(get_chunk_durations, chunks)):
+            for index, duration in zip(chunk, chunk_durations):
+                if duration is not None:
+                    durations[index] = duration
+    return durations
+
+
+class ResponseBody(object):
+    """Iterator over the chunks of a response body, which has to be consumed or closed
+
+    close() is called at the end of the body or by the consumer (e.g. if the client disconnected). An unread body
+    closes the connection. on_close(healthy) is called once, healthy is False if reading from OSRM failed.
+    """
+
+    def __init__(self, connection: http.client.HTTPConnection, response: http.client.HTTPResponse, chunk_size: int):
+        self.connection = connection
+        self.response = response
+        self.chunk_size = chunk_size
+        self.on_close = None
+        self.completed = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self.closed:
+            raise StopIteration
+        try:
+            chunk = self.response.read(self.chunk_size)
+        except (http.client.HTTPException, ConnectionError):
+            self.close(healthy=False)
+            raise
+        if not chunk:
+            self.completed = True
+            self.close()
+            raise StopIteration
+        return chunk
+
+    def close(self, healthy=True):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.completed:
+            # unread bytes would corrupt the next response on this keep-alive connection
+            self.connection.close()
+        if self.on_close:
+            self.on_close(healthy)
+
+
+def stream_osrm_request(query: str, host=None, port=None, accept_encoding=None, chunk_size=64 * 1024) -> tuple:
+    """Forward a request to an OSRM instance and return the response (status, headers) and its ResponseBody
+
+    The body is passed on as it is, compressed if OSRM accepted accept_encoding. It has to be consumed or closed
+    before the next request of this thread.
+    """
+    host = host or config.osrm.host
+    port = int(port or config.osrm.port)
+    connection, response = _request(
+        query, host, port,
+        headers={'Accept-Encoding': accept_encoding} if accept_encoding else None,
+    )
+    return response, ResponseBody(connection, response, chunk_size)
 
 
 if __name__ == '__main__':
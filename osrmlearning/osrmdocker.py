@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
 import os
 import re
@@ -50,6 +51,22 @@ def _run_commands(*commands, log=True) -> list:
     return [_run_command(command, log=log) for command in commands]
 
 
+_file_checksums = {}
+
+
+def _file_checksum(filename: str, chunk_size=1024 * 1024) -> str:
+    """Return the MD5 checksum of a (large) file, remembered as long as its size and mtime do not change"""
+    stat = os.stat(filename)
+    key = filename, stat.st_size, stat.st_mtime
+    if key not in _file_checksums:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+        _file_checksums[key] = md5.hexdigest()
+    return _file_checksums[key]
+
+
 class OsrmContainer(object):
     instances = []
 
@@ -61,8 +78,10 @@ class OsrmContainer(object):
             base_image_name='xtl/osrm-v5:distances',
             port=5000,
             plain=False,
+            replicas=1,
     ):
         self.plain = plain
+        self.replicas = replicas
         if plain:
             self.base_image_name = config.docker.registry + 'xtl/osrm-v5-de-car:distances'
             self.container_name = 'xtl-osrm-run'
@@ -101,6 +120,23 @@ class OsrmContainer(object):
         OsrmContainer.instances.append(self)
         logging.debug('OSRM docker image ready')
 
+    @property
+    def fingerprint(self) -> str:
+        """Identify the routing dataset by the docker image name and ID plus the checksum of the OSM file"""
+        image_id = _run_command(['docker', 'images', '--no-trunc', '--quiet', self.base_image_name], log=False)
+        osm_file = os.path.join('data/osm/', '{}-latest.osm.pbf'.format(self.region))
+        osm_checksum = _file_checksum(osm_file) if os.path.isfile(osm_file) else ''
+        return hashlib.sha1(';'.join([self.base_image_name, image_id.strip(), osm_checksum]).encode()).hexdigest()
+
+    @property
+    def ports(self) -> range:
+        """Each replica runs osrm-routed on its own port, starting at self.port"""
+        return range(self.port, self.port + self.replicas)
+
+    @property
+    def container_names(self) -> list:
+        return [self.container_name] + ['{}-{}'.format(self.container_name, i) for i in range(1, self.replicas)]
+
     def _image_ready(self) -> bool:
         docker_images = ['docker', 'images']
         return self.base_image_name.split(':')[0] in _run_command(docker_images, log=False)
@@ -212,37 +248,38 @@ class OsrmContainer(object):
     def stop(self):
         docker_remove = [
             'docker', 'rm',  '-f',
-            self.container_name,
-        ]
+        ] + self.container_names
         _run_command(docker_remove)
         self.timeout(run=False)
 
     def start(self):
         for instance in OsrmContainer.instances:
-            if instance.port == self.port:
+            if set(instance.ports) & set(self.ports):
                 instance.stop()
         # self.stop_all(self.port)
-        osrm_routed = [
-            'docker', 'run', '-d',
-            '-v', self.volume,
-            '-p', '{}:5000'.format(self.port),
-            # '--network', config.docker.network,
-            '--name', self.container_name,
-            self.base_image_name,
-            'osrm-routed',
-            '--max-viaroute-size', '2500',
-            '--max-table-size', '10000',
-            '/data/{}-latest.osrm'.format(self.region),
-        ]
-        if self.plain:
+        # all replicas serve the same dataset that was built once by build_container()
+        for container_name, port in zip(self.container_names, self.ports):
             osrm_routed = [
                 'docker', 'run', '-d',
-                '-p', '{}:5000'.format(self.port),
+                '-v', self.volume,
+                '-p', '{}:5000'.format(port),
                 # '--network', config.docker.network,
-                '--name', self.container_name,
+                '--name', container_name,
                 self.base_image_name,
+                'osrm-routed',
+                '--max-viaroute-size', '2500',
+                '--max-table-size', '10000',
+                '/data/{}-latest.osrm'.format(self.region),
             ]
-        _run_command(osrm_routed)
+            if self.plain:
+                osrm_routed = [
+                    'docker', 'run', '-d',
+                    '-p', '{}:5000'.format(port),
+                    # '--network', config.docker.network,
+                    '--name', container_name,
+                    self.base_image_name,
+                ]
+            _run_command(osrm_routed)
         self.timeout(run=True)
 
 
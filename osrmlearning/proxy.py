@@ -0,0 +1,315 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Request handling shared by both OSRM proxy servers (api.py and asyncproxy.py)
+
+Response cache
+
+- Responses are cached by normalized query (parameters sorted, without timestamp), resolved time window
+  and content encoding.
+- The cache is bounded by config.rest_api.cache_max_size_mb (least recently used entries are evicted)
+  and entries expire after config.rest_api.cache_ttl seconds.
+- Each time window has a generation counter in shared memory. invalidate_time_window() increments it
+  when a new OSRM container is started, which invalidates the cached responses of that window in all processes.
+
+Streaming
+
+- Response bodies are passed on as raw bytes. If config.rest_api.gzip is 1 and the client accepts gzip,
+  OSRM is asked for a gzip response, which is passed on compressed.
+- Responses larger than config.rest_api.stream_threshold_kb (or without Content-Length) are relayed in chunks
+  as they arrive and are neither cached nor shared with coalesced requests.
+
+Request coalescing
+
+- Identical requests (same cache key) that arrive while the first one is still waiting for OSRM
+  share its response instead of being forwarded again.
+
+Replicas
+
+- A time window may be served by several OSRM instances (config.time_windows.replicas).
+- Requests go to the replica with the fewest outstanding requests of this process.
+  A streamed response counts as outstanding until its body is relayed or the client disconnected.
+- A replica that fails (connection error or 5xx) is skipped for config.rest_api.eject_seconds
+  or until a health check succeeds. If all replicas are ejected, all of them are used again.
+
+Batch requests
+
+- POST /batch takes many legs with timestamps, groups them by time window
+  and requests each group with OSRM table requests instead of one route request per leg.
+"""
+
+from collections import defaultdict, OrderedDict
+import http.client
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+from osrmlearning import config
+from osrmlearning.osrmclient import get_osrm_table_durations
+from osrmlearning.timewindow import get_time_window_by_timestamp, get_time_windows, TimeWindow
+
+# shared with forked worker processes, one counter per time window (at most 24 regular + default)
+_generations = multiprocessing.RawArray('L', 32)
+
+_balancers = {}
+
+
+def parse_request(path: str, query_string: str) -> tuple:
+    """Split a proxied request into the OSRM query (without the timestamp parameter) and the timestamp or None"""
+    parameters = []
+    timestamp = None
+    for parameter in query_string.split('&'):
+        if parameter.startswith('timestamp='):
+            timestamp = urllib.parse.unquote_plus(parameter[len('timestamp='):])
+        elif parameter:
+            parameters.append(parameter)
+    query = '/' + path
+    if parameters:
+        query += '?' + '&'.join(parameters)
+    return query, timestamp
+
+
+def normalize_query(query: str) -> str:
+    path, _, query_string = query.partition('?')
+    if not query_string:
+        return path
+    return '{}?{}'.format(path, '&'.join(sorted(query_string.split('&'))))
+
+
+def _get_generation(time_window: TimeWindow) -> int:
+    return _generations[get_time_windows().index(time_window)]
+
+
+def invalidate_time_window(time_window: TimeWindow):
+    """Invalidate the cached responses of a time window (in all processes)"""
+    _generations[get_time_windows().index(time_window)] += 1
+
+
+class ResponseCache(object):
+    def __init__(self, max_size_mb=None, ttl=None):
+        self.max_size = int(float(max_size_mb or config.rest_api.cache_max_size_mb) * 1024 * 1024)
+        self.ttl = float(ttl or config.rest_api.cache_ttl)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str, time_window: TimeWindow, encoding=None):
+        key = normalize_query(query), time_window.name, encoding
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, generation, body = entry
+                if expires > time.time() and generation == _get_generation(time_window):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.bytes_saved += len(body)
+                    return body
+                del self._entries[key]
+                self.size -= len(body)
+            self.misses += 1
+            return None
+
+    def put(self, query: str, time_window: TimeWindow, body, encoding=None):
+        if len(body) > self.max_size:
+            return
+        key = normalize_query(query), time_window.name, encoding
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)[2])
+            self._entries[key] = time.time() + self.ttl, _get_generation(time_window), body
+            self.size += len(body)
+            while self.size > self.max_size:
+                self.size -= len(self._entries.popitem(last=False)[1][2])
+
+    @property
+    def statistics(self) -> dict:
+        return dict(
+            pid=os.getpid(),
+            entries=len(self._entries),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            bytes_saved=self.bytes_saved,
+        )
+
+
+class SingleFlight(object):
+    """Coalesce identical concurrent calls from several threads into one call"""
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class ReplicaBalancer(object):
+    """Choose the OSRM replica of a time window with the least outstanding requests"""
+
+    def __init__(self, ports, eject_seconds=None):
+        self.ports = list(ports)
+        self.eject_seconds = float(eject_seconds or config.rest_api.eject_seconds)
+        self.outstanding = {port: 0 for port in self.ports}
+        self._ejected_until = {port: 0.0 for port in self.ports}
+        self._lock = threading.Lock()
+
+    @property
+    def ejected_ports(self) -> list:
+        now = time.time()
+        return [port for port in self.ports if self._ejected_until[port] > now]
+
+    def acquire(self, exclude=()) -> int:
+        """Return the port to send the next request to, release() it when the request is done"""
+        with self._lock:
+            ejected = self.ejected_ports
+            candidates = [port for port in self.ports if port not in exclude and port not in ejected] \
+                or [port for port in self.ports if port not in exclude] \
+                or self.ports
+            port = min(candidates, key=self.outstanding.get)
+            self.outstanding[port] += 1
+        return port
+
+    def release(self, port: int, healthy=True):
+        with self._lock:
+            self.outstanding[port] -= 1
+            if not healthy:
+                if self._ejected_until[port] <= time.time():
+                    logging.warning('Ejecting OSRM replica on port {} for {} s'.format(port, self.eject_seconds))
+                self._ejected_until[port] = time.time() + self.eject_seconds
+
+    def set_healthy(self, port: int):
+        with self._lock:
+            if self._ejected_until[port] > time.time():
+                logging.info('OSRM replica on port {} is healthy again'.format(port))
+            self._ejected_until[port] = 0.0
+
+
+def get_balancer(time_window: TimeWindow) -> ReplicaBalancer:
+    balancer = _balancers.get(time_window.name)
+    if balancer is None or balancer.ports != list(time_window.ports):
+        balancer = _balancers[time_window.name] = ReplicaBalancer(time_window.ports)
+    return balancer
+
+
+def get_balancers() -> list:
+    return list(_balancers.values())
+
+
+def get_accept_encoding(accept_encoding: str):
+    """Return the encoding to ask OSRM for, given the Accept-Encoding header of the client"""
+    if config.rest_api.gzip == '1' and 'gzip' in (accept_encoding or ''):
+        return 'gzip'
+    return None
+
+
+def is_streamed(content_length) -> bool:
+    return content_length is None or content_length > float(config.rest_api.stream_threshold_kb) * 1024
+
+
+def get_batch_durations(legs: list) -> list:
+    """Return the OSRM travel time of each leg in input order, None if there is no route
+
+    A leg is a dict with coordinates in OSRM order ('lon,lat;lon,lat') and an optional timestamp.
+    Raises ValueError for invalid legs or timestamps and for legs that OSRM rejects (4xx).
+    The replica is only ejected if OSRM is not reachable or answers 5xx.
+    """
+    if len(legs) > int(config.rest_api.batch_max_legs):
+        raise ValueError('At most {} legs per batch'.format(config.rest_api.batch_max_legs))
+    time_windows = {}
+    coordinates_by_time_window = defaultdict(list)
+    indices_by_time_window = defaultdict(list)
+    for index, leg in enumerate(legs):
+        try:
+            lon_lats = leg['coordinates'].split(';')
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Leg {} has no coordinates'.format(index))
+        if len(lon_lats) != 2:
+            raise ValueError('Leg {} must have exactly 2 coordinates'.format(index))
+        for lon_lat in lon_lats:
+            try:
+                lon, lat = (float(value) for value in lon_lat.split(','))
+            except ValueError:
+                raise ValueError('Leg {} has invalid coordinates {}'.format(index, lon_lat))
+            if not (math.isfinite(lon) and math.isfinite(lat)):
+                raise ValueError('Leg {} has invalid coordinates {}'.format(index, lon_lat))
+        time_window = get_time_window_by_timestamp(leg.get('timestamp'))
+        time_windows[time_window.name] = time_window
+        # osrmclient expects 'lat,lon;lat,lon' like Route.coordinates
+        coordinates_by_time_window[time_window.name].append(
+            ';'.join(','.join(reversed(lon_lat.split(','))) for lon_lat in lon_lats)
+        )
+        indices_by_time_window[time_window.name].append(index)
+    durations = [None] * len(legs)
+    for name, time_window in time_windows.items():
+        balancer = get_balancer(time_window)
+        port = balancer.acquire()
+        healthy = True
+        try:
+            window_durations = get_osrm_table_durations(coordinates_by_time_window[name], port=port)
+        except urllib.error.HTTPError as e:
+            # OSRM answers 4xx for legs it cannot route (e.g. coordinates far away from the map)
+            healthy = e.code < 500
+            if healthy:
+                raise ValueError('OSRM rejected the legs of time window {}: {} {}'.format(name, e.code, e.reason))
+            raise
+        except (OSError, http.client.HTTPException):
+            healthy = False
+            raise
+        finally:
+            balancer.release(port, healthy=healthy)
+        for index, duration in zip(indices_by_time_window[name], window_durations):
+            durations[index] = None if math.isnan(duration) else duration
+    logging.debug('Batch of {} legs in {} time windows'.format(len(legs), len(time_windows)))
+    return durations
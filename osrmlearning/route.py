@@ -14,15 +14,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from array import array
 import datetime
+import hashlib
 import math
 import random
+import sys
+
+import numpy as np
 
 from osrmlearning import config
+from osrmlearning.edgeindex import EdgeIndex
 # from osrmlearning.hereclient import get_travel_time_by_route  # avoid invalid cyclic import
 import osrmlearning.hereclient
+from osrmlearning.nodes import decode_nodes, encode_nodes
 from osrmlearning.osmdatabase import OsmDatabase
-from osrmlearning.osrmclient import get_osrm_route
+from osrmlearning.osrmclient import get_osrm_route, get_osrm_table_durations, iterate_osrm_routes
+from osrmlearning.tagvocabulary import TagVocabulary
 
 
 # FIXME routes from here db break (as train source) because they do not have timestamps
@@ -34,7 +42,7 @@ class Route(object):
             end_timestamp: datetime.datetime = None,
             reference_travel_time: float = None,
             osrm_travel_time: float = None,
-            osm_tag_counts: dict = None,
+            osm_tag_counts: np.ndarray = None,
             input_count=1,
     ):
         # if start_timestamp is None or end_timestamp is None:
@@ -44,14 +52,41 @@ class Route(object):
         self.end_timestamp = end_timestamp
         self._reference_travel_time = reference_travel_time
         self.osrm_travel_time = osrm_travel_time
+        # counts by tag ID of the TagVocabulary
         self.osm_tag_counts = osm_tag_counts
         self.tf_scaled_osrm_travel_time = None
         self.tf_final_osrm_travel_time = None
         self.here_travel_time = None
-        self.nodes = None
+        self._nodes = None
         self.ways = None
         self.input_count = input_count
 
+    @property
+    def key(self) -> str:
+        """Identify the route across runs by its coordinates and start timestamp"""
+        return hashlib.sha1('{}|{}'.format(self.coordinates, self.start_timestamp).encode()).hexdigest()[:16]
+
+    @property
+    def nodes(self) -> array:
+        """The OSM nodes, stored as array('q') or delta/varint-encoded if config.osrm.compress_nodes is set"""
+        if type(self._nodes) is bytes:
+            return decode_nodes(self._nodes)
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        if nodes is None:
+            self._nodes = None
+        elif config.osrm.compress_nodes == '1':
+            self._nodes = encode_nodes(nodes)
+        else:
+            self._nodes = nodes if type(nodes) is array else array('q', nodes)
+
+    @property
+    def nodes_size(self) -> int:
+        """Memory size of the stored OSM nodes in bytes"""
+        return sys.getsizeof(self._nodes) if self._nodes is not None else 0
+
     def set_osrm_travel_time(self):
         self.osrm_travel_time, self.nodes = get_osrm_route(self.coordinates)
 
@@ -59,12 +94,14 @@ class Route(object):
         if self.nodes is None:
             raise RuntimeError('First initialize nodes by calling set_osrm_travel_time()')
         db = OsmDatabase.get_instance()
-        osm_tag_counts = db.get_all_tags_by_nodes(self.nodes)
-        self.osm_tag_counts = {tag: osm_tag_counts.get(tag, 0) for tag in config.osm.tags}
+        self.osm_tag_counts = db.get_tag_counts_by_routes([self.nodes])[0]
 
     def set_ways(self):
         if self.nodes is None:
             raise RuntimeError('First initialize nodes by calling set_osrm_travel_time()')
+        if config.osm.edge_index == '1':
+            self.ways = EdgeIndex.get_instance().get_ways(self.nodes)
+            return
         db = OsmDatabase.get_instance()
         self.ways = db.get_ways_by_nodes(self.nodes)
 
@@ -144,20 +181,15 @@ class Route(object):
         return abs(self.plain_osrm_error) - abs(self.tf_final_osrm_error)
 
     @property
-    def osm_tag_fractions(self) -> dict:
+    def osm_tag_fractions(self) -> np.ndarray:
+        """Fractions of the tag counts by tag ID, or 1 for each counted tag if config.tensorflow.binary_tags"""
         # if config.tensorflow.binary_tags != '0':
         if config.tensorflow.binary_tags == '1':
-            binary_tags = self.osm_tag_counts.copy()
-            binary_tags.update({tag: 1 for tag, count in binary_tags.items() if count > 0})
-            return binary_tags
-        counts = self.osm_tag_counts
-        fractions = dict.fromkeys(counts, 0.0)
-        total = sum(counts.values())
+            return (self.osm_tag_counts > 0).astype(np.float32)
+        total = self.osm_tag_counts.sum()
         if not total:
-            return fractions  # don't divide by zero
-        for tag in fractions:
-            fractions[tag] = counts[tag] / total
-        return fractions
+            return np.zeros(len(self.osm_tag_counts), dtype=np.float32)  # don't divide by zero
+        return (self.osm_tag_counts / total).astype(np.float32)
 
     def __str__(self):
         return 'Route({}, {})'.format(
@@ -177,6 +209,38 @@ class Route(object):
     #     return self.coordinates == o.coordinates
 
 
+def iterate_osrm_travel_times(routes: list, parallelism=None, cache=None):
+    """Set the OSRM travel times and nodes of all routes concurrently and yield each route once it is done"""
+    osrm_routes = iterate_osrm_routes([route.coordinates for route in routes], parallelism=parallelism, cache=cache)
+    for route, osrm_route in zip(routes, osrm_routes):
+        route.osrm_travel_time, route.nodes = osrm_route
+        yield route
+
+
+def iterate_osm_tag_counts(routes: list, chunk_size=None):
+    """Like Route.set_osm_tag_counts(), but with one database query per chunk of routes
+
+    Yields each route once its tag counts are set.
+    """
+    chunk_size = int(chunk_size or config.postgres.tag_counts_chunk_size)
+    db = OsmDatabase.get_instance()
+    for i in range(0, len(routes), chunk_size):
+        chunk = routes[i:i + chunk_size]
+        if any(route.nodes is None for route in chunk):
+            raise RuntimeError('First initialize nodes by calling set_osrm_travel_time()')
+        tag_counts = db.get_tag_counts_by_routes([route.nodes for route in chunk])
+        for route, osm_tag_counts in zip(chunk, tag_counts):
+            route.osm_tag_counts = osm_tag_counts
+            yield route
+
+
+def set_tf_final_osrm_travel_times(routes: list, port: int):
+    """Like Route.set_tf_final_osrm_travel_time(), but for many routes at once with the OSRM table service"""
+    durations = get_osrm_table_durations([route.coordinates for route in routes], port=port)
+    for route, duration in zip(routes, durations):
+        route.tf_final_osrm_travel_time = duration
+
+
 # for testing only, TODO remove later
 def get_random_example_routes(route_count=3, max_occurrences_per_tag=3, max_travel_time=600) -> list:
     routes = []
@@ -184,9 +248,9 @@ def get_random_example_routes(route_count=3, max_occurrences_per_tag=3, max_trav
         coordinates = '8.8473,53.1080;8.7859,53.0524'
         reference_travel_time = random.random() * max_travel_time
         osrm_travel_time = random.random() * max_travel_time
-        osm_tag_counts = {}
-        for tag in config.osm.tags:
-            osm_tag_counts[tag] = random.randint(0, max_occurrences_per_tag)
+        osm_tag_counts = np.array([
+            random.randint(0, max_occurrences_per_tag) for _ in range(len(TagVocabulary.get_instance()))
+        ], dtype=np.int32)
         routes.append(Route(
             coordinates=coordinates,
             reference_travel_time=reference_travel_time,
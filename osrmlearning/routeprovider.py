@@ -116,5 +116,15 @@ def randomize(routes: list) -> list:
     return routes
 
 
+def split_by_key(routes: list, train_ratio: float) -> tuple:
+    """Split routes into train and eval routes by the hash of their key, each route stays on its side in every run"""
+    threshold = float(train_ratio) * 16 ** 8
+    train_routes = []
+    eval_routes = []
+    for route in routes:
+        (train_routes if int(route.key[:8], 16) < threshold else eval_routes).append(route)
+    return train_routes, eval_routes
+
+
 if __name__ == '__main__':
     print(get_routes(Source.PLANS))
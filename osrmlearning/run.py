@@ -17,14 +17,21 @@
 import gc
 import itertools
 import logging
+import time
 
+import numpy as np
 from progress.bar import Bar
 
 from osrmlearning import config, init, start_time
 from osrmlearning.evaluation import evaluate
 from osrmlearning.learning import Learning
+from osrmlearning.modelstore import ModelStore
+from osrmlearning.nodes import get_tuple_size
 from osrmlearning.osmdatabase import OsmDatabase
+from osrmlearning.osrmcache import OsrmRouteCache
 from osrmlearning.osrmdocker import OsrmContainer
+from osrmlearning.proxy import invalidate_time_window
+from osrmlearning.route import iterate_osm_tag_counts, iterate_osrm_travel_times
 from osrmlearning.routeprovider import (
     get_routes,
     # reject_outliers,
@@ -32,6 +39,7 @@ from osrmlearning.routeprovider import (
     remove_non_moving_routes,
     enforce_max_count,
     randomize,
+    split_by_key,
     Source,
 )
 from osrmlearning.timewindow import get_time_windows, TimeWindow
@@ -52,9 +60,8 @@ def get_osrm_containers_by_time_windows() -> dict:
     cross_validation = cross_validation == '1' and cross_validation != '0'
     if train_source == eval_source and cross_validation:
         routes = train_routes
-        sep = int(float(config.tensorflow.train_eval_ratio) * len(routes))
-        train_routes = routes[:sep]
-        eval_routes = routes[sep:]
+        # the same split in every run, incrementally trained models never evaluate on their train routes
+        train_routes, eval_routes = split_by_key(routes, config.tensorflow.train_eval_ratio)
     else:
         routes = train_routes + eval_routes
 
@@ -66,14 +73,41 @@ def get_osrm_containers_by_time_windows() -> dict:
     logging.info('Got Here travel times for {} routes in {} seconds'.format(bar.index, bar.elapsed))
 
     osrm_container = OsrmContainer(plain=True)
-    osrm_container.start()
+    cache = None
+    uncached_routes = routes
+    if config.osrm.cache == '1':
+        cache = OsrmRouteCache(osrm_container.fingerprint)
+        uncached_routes = [route for route in routes if not cache.contains(route.coordinates)]
+        logging.info('Found {} out of {} routes in the OSRM route cache'.format(
+            len(routes) - len(uncached_routes),
+            len(routes),
+        ))
+    if uncached_routes:
+        osrm_container.start()
     bar = Bar('Getting OSRM travel times:', max=len(routes), suffix=config.progress.suffix)
-    for route in routes:
-        route.set_osrm_travel_time()
+    t1 = time.time()
+    for _ in iterate_osrm_travel_times(routes, cache=cache):
         bar.next()
     bar.finish()
-    logging.info('Got OSRM travel times for {} routes in {} seconds'.format(bar.index, bar.elapsed))
-    osrm_container.stop()
+    t2 = time.time()
+    logging.info('Got OSRM travel times for {} routes in {} seconds ({:.1f} routes per second, parallelism {})'.format(
+        bar.index,
+        bar.elapsed,
+        bar.index / max(t2 - t1, 1e-9),
+        config.osrm.parallelism,
+    ))
+    if cache is not None:
+        cache.log_statistics()
+        cache.close()
+    if uncached_routes:
+        osrm_container.stop()
+    nodes_size = sum(route.nodes_size for route in routes)
+    tuple_size = sum(get_tuple_size(len(route.nodes)) for route in routes)
+    logging.info('Node sequences take {:.1f} MB instead of {:.1f} MB as tuples of ints, saving {:.1f} MB'.format(
+        nodes_size / 1024 / 1024,
+        tuple_size / 1024 / 1024,
+        (tuple_size - nodes_size) / 1024 / 1024,
+    ))
 
     original_routes_count = len(routes)
     routes = [
@@ -91,8 +125,7 @@ def get_osrm_containers_by_time_windows() -> dict:
     ))
 
     bar = Bar('Getting OSM tag counts:', max=len(routes), suffix=config.progress.suffix)
-    for route in routes:
-        route.set_osm_tag_counts()
+    for _ in iterate_osm_tag_counts(routes):
         bar.next()
     bar.finish()
     logging.info('Got OSM tag counts for {} routes in {} seconds'.format(bar.index, bar.elapsed))
@@ -110,8 +143,9 @@ def get_osrm_containers_by_time_windows() -> dict:
         osrm_containers_by_time_windows[time_window] = osrm_container
         iterators.append(iterate_eval_routes())
 
-    for osrm_container in osrm_containers_by_time_windows.values():
+    for time_window, osrm_container in osrm_containers_by_time_windows.items():
         osrm_container.start()
+        invalidate_time_window(time_window)
     evaluate(lambda: itertools.chain(*iterators))
     return osrm_containers_by_time_windows
 
@@ -133,7 +167,7 @@ def create_osrm_container(train_routes: list, eval_routes: list, time_window: Ti
             return
             yield
 
-        return OsrmContainer(plain=True), empty_iterator
+        return OsrmContainer(plain=True, port=time_window.port, replicas=time_window.replicas), empty_iterator
     # routes = train_routes + eval_routes
 
     travel_time_ratios_by_way_ids = {}
@@ -159,38 +193,43 @@ def create_osrm_container(train_routes: list, eval_routes: list, time_window: Ti
     # eval_routes = set(eval_routes) -= set(train_routes)
 
     tensorflow_enabled = config.tensorflow.enabled == '1' or config.tensorflow.enabled != '0'
+    direct_way_ids = np.fromiter(travel_time_ratios_by_way_ids.keys(), dtype=np.int64,
+                                 count=len(travel_time_ratios_by_way_ids))
+    direct_scaling_factors = np.fromiter(travel_time_ratios_by_way_ids.values(), dtype=np.float64,
+                                         count=len(travel_time_ratios_by_way_ids))
     if tensorflow_enabled:
-        learning = Learning(train_routes, eval_routes)
+        model_store = ModelStore(time_window.name)
+        learning = Learning(train_routes, eval_routes, model_store)
         # del routes
         # del train_routes
         # del eval_routes
         # gc.collect()
         learning.learn()
-        scaling_factors_by_way_ids = learning.predict_all_scaling_factors_by_way_ids()
-        scaling_factors_by_way_ids.update(travel_time_ratios_by_way_ids)
+        if config.tensorflow.numpy_inference == '1':
+            # next to the checkpoint of the same model
+            learning.numpy_dnn.save(model_store.weights_file)
+        learned_way_ids, learned_scaling_factors = learning.predict_all_scaling_factors()
+        # direct scaling factors replace learned ones of the same ways
+        learned = ~np.isin(learned_way_ids, direct_way_ids)
+        way_ids = np.concatenate([learned_way_ids[learned], direct_way_ids])
+        scaling_factors = np.concatenate([learned_scaling_factors[learned], direct_scaling_factors])
+        del learned_way_ids, learned_scaling_factors, learned
         logging.info('Using {} learned scaling factors and {} direct scaling factors'.format(
-            len(scaling_factors_by_way_ids) - len(travel_time_ratios_by_way_ids), len(travel_time_ratios_by_way_ids)))
+            len(way_ids) - len(direct_way_ids), len(direct_way_ids)))
     else:
-        scaling_factors_by_way_ids = travel_time_ratios_by_way_ids
-        logging.info('Using {} direct scaling factors'.format(len(scaling_factors_by_way_ids)))
+        way_ids, scaling_factors = direct_way_ids, direct_scaling_factors
+        logging.info('Using {} direct scaling factors'.format(len(way_ids)))
     del travel_time_ratios_by_way_ids
     gc.collect()
 
     max_scaling_factor = float(config.tensorflow.max_scaling_factor)
-    exceeding_scaling_factors = 0
-    missing_scaling_factors = 0
+    exceeding_scaling_factors = np.count_nonzero(
+        (scaling_factors > max_scaling_factor) | (scaling_factors < 1 / max_scaling_factor))
+    scaling_factors = np.clip(scaling_factors, 1 / max_scaling_factor, max_scaling_factor)
     db = OsmDatabase.get_instance()
-    for way in db.get_all_way_ids():
-        if way in scaling_factors_by_way_ids:
-            if scaling_factors_by_way_ids[way] > max_scaling_factor:
-                scaling_factors_by_way_ids[way] = max_scaling_factor
-                exceeding_scaling_factors += 1
-            elif scaling_factors_by_way_ids[way] < 1 / max_scaling_factor:
-                scaling_factors_by_way_ids[way] = 1 / max_scaling_factor
-                exceeding_scaling_factors += 1
-        else:
-            # scaling_factors_by_way_ids[way] = max_scaling_factor
-            missing_scaling_factors += 1
+    all_way_ids = np.array(db.get_all_way_ids(), dtype=np.int64)
+    missing_scaling_factors = np.count_nonzero(~np.isin(all_way_ids, way_ids))
+    del all_way_ids
     logging.info('Maximum allowed scaling factor {} was set for {} ways where the original was above the max'.format(
         max_scaling_factor,
         exceeding_scaling_factors,
@@ -200,9 +239,9 @@ def create_osrm_container(train_routes: list, eval_routes: list, time_window: Ti
 
     csv_file = 'data/results/scaling_factors/{}--{}.csv'.format(start_time, time_window)
     with open(csv_file, 'w') as f:
-        bar = Bar('Writing scaling factors:', max=len(scaling_factors_by_way_ids), suffix=config.progress.suffix)
-        for way_id, scaling_factor in scaling_factors_by_way_ids.items():
-            scaling_factor = 1 / scaling_factor  # In the lua profile, we scale speed rather than travel time!
+        bar = Bar('Writing scaling factors:', max=len(way_ids), suffix=config.progress.suffix)
+        # In the lua profile, we scale speed rather than travel time!
+        for way_id, scaling_factor in zip(way_ids.tolist(), (1 / scaling_factors).tolist()):
             f.write('{};{}\n'.format(way_id, scaling_factor))
             bar.next()
         bar.finish()
@@ -210,7 +249,12 @@ def create_osrm_container(train_routes: list, eval_routes: list, time_window: Ti
     # del scaling_factors_by_way_ids
     # gc.collect()
 
-    osrm_container = OsrmContainer(time_window=time_window.name, port=time_window.port, region_path=config.osrm.region)
+    osrm_container = OsrmContainer(
+        time_window=time_window.name,
+        port=time_window.port,
+        region_path=config.osrm.region,
+        replicas=time_window.replicas,
+    )
     osrm_container.build_container()
     if tensorflow_enabled:
         # osrm_container.start()
@@ -219,6 +263,8 @@ def create_osrm_container(train_routes: list, eval_routes: list, time_window: Ti
         # noinspection PyUnboundLocalVariable
         return osrm_container, learning.iterate_eval_routes
     else:
+        scaling_factors_by_way_ids = dict(zip(way_ids.tolist(), scaling_factors.tolist()))
+
         def iterate_eval_routes():
             for route in eval_routes:
                 yield route, scale_route(route, scaling_factors_by_way_ids)
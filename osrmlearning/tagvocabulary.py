@@ -0,0 +1,79 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Integer IDs of the configured OSM tags
+
+- Built once from config.osm.tags (see osmtags.get_osm_tags()), the tags are sorted,
+  so a tag has the same ID in every run with the same tags file.
+- Tag counts of routes are int32 arrays indexed by tag ID, columns of WayFeatureMatrix are tag IDs.
+- Databases join (k, v) with the keys and values of the vocabulary and return tag IDs
+  instead of concatenating and comparing 'k=v' strings for every row.
+"""
+
+import hashlib
+
+import numpy as np
+
+from osrmlearning import config
+
+
+class TagVocabulary(object):
+    _instance = None
+
+    def __init__(self, tags, separator='='):
+        self.source = tags
+        self.tags = sorted(set(tags))
+        self.ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+        key_values = [tag.split(separator, 1) for tag in self.tags]
+        self.keys = [key for key, _ in key_values]
+        self.values = [value for _, value in key_values]
+        self.hash = hashlib.sha1('\n'.join(self.tags).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def get_instance():
+        # config.osm.tags is a new list whenever the config is re-initialized
+        if not TagVocabulary._instance or TagVocabulary._instance.source is not config.osm.tags:
+            TagVocabulary._instance = TagVocabulary(
+                config.osm.tags,
+                separator=config.osm.separator,
+            )
+        return TagVocabulary._instance
+
+    def __len__(self):
+        return len(self.tags)
+
+    def get_sql_params(self) -> dict:
+        """Return tag IDs, keys and values as lists, to be joined as unnest(tag_ids, keys, values)"""
+        return dict(tag_ids=list(range(len(self))), keys=self.keys, values=self.values)
+
+    def to_counts(self, tag_counts: dict) -> np.ndarray:
+        """Turn {tag: count} into an array of counts by tag ID, tags that are not in the vocabulary are skipped"""
+        counts = np.zeros(len(self), dtype=np.int32)
+        for tag, count in tag_counts.items():
+            tag_id = self.ids.get(tag)
+            if tag_id is not None:
+                counts[tag_id] = count
+        return counts
+
+    def to_dict(self, counts: np.ndarray) -> dict:
+        """Turn an array of counts by tag ID into {tag: count} of the tags that occur"""
+        return {self.tags[tag_id]: counts[tag_id].item() for tag_id in np.flatnonzero(counts)}
+
+
+if __name__ == '__main__':
+    vocabulary = TagVocabulary.get_instance()
+    print(len(vocabulary), vocabulary.hash, vocabulary.to_counts({'highway=primary': 2, 'name=x': 1}).sum())
@@ -20,15 +20,22 @@ import logging
 from osrmlearning import config
 from osrmlearning.route import Route
 
+# (time windows, lookup table by hour, default time window), replaced as a whole so that lookups never see a mix
 _time_windows = None
 
 
 # TODO support for hour AND minute?
 class TimeWindow(object):
-    def __init__(self, start_hour: int, end_hour: int, port: int):
+    def __init__(self, start_hour: int, end_hour: int, port: int, replicas=1):
         self.start_hour = start_hour
         self.end_hour = end_hour
         self.port = port
+        self.replicas = replicas
+
+    @property
+    def ports(self) -> range:
+        """Ports of the OSRM replicas of this time window (see OsrmContainer.ports)"""
+        return range(self.port, self.port + self.replicas)
 
     @property
     def is_default(self):
@@ -49,19 +56,18 @@ class TimeWindow(object):
 
     __hash__ = object.__hash__
 
+    def contains_hour(self, hour: int) -> bool:
+        if self.start_hour < self.end_hour:  # regular time window
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour  # default time window for all remaining hours
+
     def filter_routes(self, routes: list, log=True) -> list:
-        filtered_routes = [  # regular time window
+        filtered_routes = [
             route for route in routes
-            if self.start_hour <= route.start_timestamp.hour < self.end_hour
-            or self.start_hour <= route.end_timestamp.hour < self.end_hour
-            # and self.start_hour <= route.end_timestamp.hour < self.end_hour
+            if self.contains_hour(route.start_timestamp.hour)
+            or self.contains_hour(route.end_timestamp.hour)
+            # and self.contains_hour(route.end_timestamp.hour)
             # TODO and/or?
-        ] if self.start_hour < self.end_hour else [  # default time window for all remaining routes
-            route for route in routes
-            if route.start_timestamp.hour >= self.start_hour
-            or route.start_timestamp.hour < self.end_hour
-            or route.end_timestamp.hour >= self.start_hour
-            or route.end_timestamp.hour < self.end_hour
         ]
         if log:
             logging.debug('Time window {} filter: Got {} routes, kept {} routes'.format(
@@ -72,41 +78,77 @@ class TimeWindow(object):
         return filtered_routes
 
 
+def _get_time_window_table() -> tuple:
+    if _time_windows is None:
+        get_time_windows()
+    return _time_windows[1]
+
+
 def get_time_window_by_route(route: Route) -> TimeWindow:
-    return [
-        time_window
-        for time_window in get_time_windows()
-        if len(time_window.filter_routes({route}, log=False))
-    ][0]
+    """Return the first time window that filter_routes() would keep the route in"""
+    table = _get_time_window_table()
+    start_position, start_time_window = table[route.start_timestamp.hour]
+    end_position, end_time_window = table[route.end_timestamp.hour]
+    if start_time_window is None and end_time_window is None:
+        raise IndexError('No time window for route {}'.format(route))
+    if end_time_window is None or start_time_window is not None and start_position <= end_position:
+        return start_time_window
+    return end_time_window
 
 
 def get_time_window_by_hour(hour: int) -> TimeWindow:
-    timestamp = datetime.datetime(year=2018, month=1, day=1, hour=hour)
-    return [
-        time_window
-        for time_window in get_time_windows()
-        if len(time_window.filter_routes({Route(
-            coordinates='temp', start_timestamp=timestamp, end_timestamp=timestamp)}, log=False))
-    ][0]
+    time_window = _get_time_window_table()[hour][1]
+    if time_window is None:
+        raise IndexError('No time window for hour {}'.format(hour))
+    return time_window
 
 
-def get_time_windows() -> list:
+def get_default_time_window() -> TimeWindow:
+    if _time_windows is None:
+        get_time_windows()
+    return _time_windows[2]
+
+
+def get_time_window_by_timestamp(timestamp: str = None) -> TimeWindow:
+    """Return the time window of a timestamp formatted like config.rest_api.date_format, or the default window"""
+    if not timestamp:
+        return get_default_time_window()
+    return get_time_window_by_hour(datetime.datetime.strptime(timestamp, config.rest_api.date_format).hour)
+
+
+def set_time_windows(time_windows: list):
+    """Replace the time windows and rebuild their lookup table (position and first matching window by hour)"""
     global _time_windows
+    table = []
+    for hour in range(24):
+        matching = [
+            (position, time_window)
+            for position, time_window in enumerate(time_windows)
+            if time_window.contains_hour(hour)
+        ]
+        table.append(matching[0] if matching else (None, None))
+    default_time_window = next((time_window for time_window in time_windows if time_window.is_default), None)
+    _time_windows = time_windows, tuple(table), default_time_window
+
+
+def get_time_windows() -> list:
     if _time_windows is not None:
-        return _time_windows
+        return _time_windows[0]
     first_window = int(config.time_windows.first_window)
     last_window = int(config.time_windows.last_window)
     window_step = int(config.time_windows.window_step)
     first_port = int(config.time_windows.first_port)
-    last_port = int(first_port + (last_window - first_window) / window_step)
-    _time_windows = []
+    replicas = int(config.time_windows.replicas)
+    window_count = int((last_window - first_window) / window_step)
+    time_windows = []
     for time_window, port in zip(
             range(first_window, last_window + 1, window_step),
-            range(first_port + 1, last_port + 1),
+            range(first_port + replicas, first_port + replicas * (window_count + 1), replicas),
     ):
-        _time_windows.append(TimeWindow(time_window, time_window + window_step, port))
-    _time_windows.append(TimeWindow(last_window, first_window, first_port))
-    return _time_windows
+        time_windows.append(TimeWindow(time_window, time_window + window_step, port, replicas))
+    time_windows.append(TimeWindow(last_window, first_window, first_port, replicas))
+    set_time_windows(time_windows)
+    return time_windows
 
 
 def test():
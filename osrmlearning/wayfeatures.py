@@ -0,0 +1,164 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Tag features of all ways as a sparse matrix
+
+- One row per way (way_ids is sorted), one column per tag of the TagVocabulary (column = tag ID).
+- Stored in CSR format: the values of row i are data[indptr[i]:indptr[i + 1]],
+  their columns are indices[indptr[i]:indptr[i + 1]]. Tags that a way does not have are 0.
+- Dense float32 rows are only created for chunks of ways (to_dense()).
+- Many ways have the same tags, unique() returns the distinct rows and the row of each way.
+"""
+
+from array import array
+
+import numpy as np
+
+from osrmlearning import config
+from osrmlearning.tagvocabulary import TagVocabulary
+
+
+class WayFeatureMatrix(object):
+    def __init__(self, way_ids: np.ndarray, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, tags=None):
+        self.way_ids = way_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.tags = list(tags or TagVocabulary.get_instance().tags)
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.way_ids.nbytes + self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @staticmethod
+    def from_rows(rows, tags=None) -> 'WayFeatureMatrix':
+        """Build the matrix from (way_id, tag_id, counter) rows ordered by way"""
+        way_ids = array('q')
+        indptr = array('q', [0])
+        indices = array('i')
+        data = array('f')
+        for way_id, tag_id, counter in rows:
+            if not way_ids or way_ids[-1] != way_id:
+                if way_ids:
+                    indptr.append(len(indices))
+                way_ids.append(way_id)
+            indices.append(tag_id)
+            data.append(counter)
+        if way_ids:
+            indptr.append(len(indices))
+        return WayFeatureMatrix(
+            np.frombuffer(way_ids, dtype=np.int64),
+            np.frombuffer(indptr, dtype=np.int64),
+            np.frombuffer(indices, dtype=np.int32),
+            np.frombuffer(data, dtype=np.float32),
+            tags,
+        )
+
+    @staticmethod
+    def from_arrays(way_ids: np.ndarray, tag_ids: np.ndarray, counters: np.ndarray, tags=None) -> 'WayFeatureMatrix':
+        """Build the matrix from the way IDs, tag IDs and counters of rows ordered by way"""
+        way_ids, starts = np.unique(way_ids, return_index=True)
+        return WayFeatureMatrix(
+            way_ids.astype(np.int64),
+            np.append(starts, len(tag_ids)).astype(np.int64),
+            np.asarray(tag_ids, dtype=np.int32),
+            np.asarray(counters, dtype=np.float32),
+            tags,
+        )
+
+    @staticmethod
+    def concatenate(matrices: list) -> 'WayFeatureMatrix':
+        """Join matrices of the same tags with disjoint way ID ranges"""
+        matrices = sorted((matrix for matrix in matrices if len(matrix)), key=lambda matrix: matrix.way_ids[0])
+        if not matrices:
+            return WayFeatureMatrix.from_rows([])
+        offsets = np.cumsum([0] + [len(matrix.data) for matrix in matrices])
+        return WayFeatureMatrix(
+            np.concatenate([matrix.way_ids for matrix in matrices]),
+            np.concatenate([[0]] + [matrix.indptr[1:] + offset for matrix, offset in zip(matrices, offsets)]),
+            np.concatenate([matrix.indices for matrix in matrices]),
+            np.concatenate([matrix.data for matrix in matrices]),
+            matrices[0].tags,
+        )
+
+    def _get_rows(self) -> np.ndarray:
+        """Row index of each stored value"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def normalize(self, binary_tags=None):
+        """Turn tag counts into ratios of all counted tags of a way, or into 1 if config.tensorflow.binary_tags"""
+        if binary_tags is None:
+            binary_tags = config.tensorflow.binary_tags == '1'
+        if binary_tags:
+            self.data = (self.data > 0).astype(np.float32)
+            return self
+        rows = self._get_rows()
+        totals = np.bincount(rows, weights=self.data, minlength=len(self))
+        totals[totals == 0] = 1  # avoid ZeroDivisionError
+        self.data = (self.data / totals[rows]).astype(np.float32)
+        return self
+
+    def to_dense(self, start=0, stop=None) -> np.ndarray:
+        """Return the rows start to stop as a float32 array of shape (ways, tags)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        dense = np.zeros((max(stop - start, 0), len(self.tags)), dtype=np.float32)
+        begin, end = self.indptr[start], self.indptr[stop]
+        rows = np.repeat(np.arange(stop - start, dtype=np.int64), np.diff(self.indptr[start:stop + 1]))
+        dense[rows, self.indices[begin:end]] = self.data[begin:end]
+        return dense
+
+    def unique(self, chunk_size=None) -> tuple:
+        """Return the distinct rows as float32 array (rows x tags) and the index of the distinct row of each way
+
+        Dense rows are only created for chunk_size ways at a time, the distinct rows of all chunks are merged by
+        their bytes.
+        """
+        chunk_size = chunk_size or max(len(self), 1)
+        row_ids_by_bytes = {}
+        inverse = np.empty(len(self), dtype=np.int64)
+        for start in range(0, len(self), chunk_size):
+            chunk_rows, chunk_inverse = np.unique(self.to_dense(start, start + chunk_size), axis=0,
+                                                  return_inverse=True)
+            row_ids = np.array([
+                row_ids_by_bytes.setdefault(row.tobytes(), len(row_ids_by_bytes)) for row in chunk_rows
+            ], dtype=np.int64)
+            inverse[start:start + chunk_size] = row_ids[chunk_inverse.reshape(-1)]
+        # the keys are in the order of the row IDs
+        rows = np.frombuffer(b''.join(row_ids_by_bytes), dtype=np.float32).reshape(-1, len(self.tags))
+        return rows, inverse
+
+    def get(self, way_id: int) -> dict:
+        """Return {tag: value} of the tags of one way"""
+        row = np.searchsorted(self.way_ids, way_id)
+        if row == len(self) or self.way_ids[row] != way_id:
+            return {}
+        begin, end = self.indptr[row], self.indptr[row + 1]
+        return {self.tags[column]: float(value) for column, value in zip(self.indices[begin:end], self.data[begin:end])}
+
+
+if __name__ == '__main__':
+    example_tags = ['highway=primary', 'highway=residential', 'maxspeed=30']
+    example_rows = [
+        (24554411, 1, 1),
+        (24554411, 2, 3),
+        (150186847, 0, 2),
+    ]
+    matrix = WayFeatureMatrix.from_rows(example_rows, example_tags).normalize()
+    print(matrix.get(24554411), matrix.to_dense().shape, matrix.nbytes)
@@ -0,0 +1,57 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from osrmlearning.dnninference import NumpyDnn
+from osrmlearning.features import FEATURE_NAME
+
+TAG_COUNT = 6
+
+
+def _get_features(count: int, seed: int) -> np.ndarray:
+    features = np.random.RandomState(seed).rand(count, TAG_COUNT).astype(np.float32)
+    return features / features.sum(axis=1, keepdims=True)
+
+
+def _get_estimator() -> tf.estimator.DNNRegressor:
+    features = _get_features(100, 1)
+    labels = (1 + features[:, 0] - features[:, 1]).astype(np.float32)
+    estimator = tf.estimator.DNNRegressor([5, 4], [tf.feature_column.numeric_column(FEATURE_NAME, shape=(TAG_COUNT,))])
+    estimator.train(
+        lambda: tf.data.Dataset.from_tensor_slices(({FEATURE_NAME: features}, labels)).repeat().batch(20),
+        steps=50,
+    )
+    return estimator
+
+
+def test_parity_with_tensorflow():
+    estimator = _get_estimator()
+    features = _get_features(250, 2)
+    expected = np.array([prediction['predictions'][0] for prediction in estimator.predict(
+        lambda: tf.data.Dataset.from_tensor_slices({FEATURE_NAME: features}).batch(64))])
+    numpy_dnn = NumpyDnn.from_estimator(estimator)
+    assert len(numpy_dnn.kernels) == 3
+    assert np.allclose(numpy_dnn.predict(features), expected, atol=1e-5)
+    assert np.allclose(numpy_dnn.predict(features, chunk_size=7), expected, atol=1e-5)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.npz')
+        numpy_dnn.save(path)
+        assert np.array_equal(NumpyDnn.load(path).predict(features), numpy_dnn.predict(features))
@@ -0,0 +1,97 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+
+import numpy as np
+
+from osrmlearning import edgeindex
+from osrmlearning.edgeindex import EdgeIndex
+
+# way ID: nodes in sequence
+WAYS = {
+    3: [2, 1, 11],  # a building that shares the edge 1-2 with way 10
+    5: [7, 8],
+    10: [1, 2, 3],
+    20: [3, 4, 5],
+    30: [4, 5, 9],  # shares the edge 4-5 with way 20
+    40: [8, 7, 6],  # shares the edge 7-8 with way 5 in the other direction
+}
+HIGHWAYS = [5, 10, 20, 30, 40]
+
+
+class _FakeDb(object):
+    def __init__(self):
+        self.fingerprint = 'way_nodes:1'
+        self.copies = 0
+
+    def get_way_node_arrays(self) -> tuple:
+        self.copies += 1
+        way_ids = [way_id for way_id in sorted(WAYS) for _ in WAYS[way_id]]
+        nodes = [node for way_id in sorted(WAYS) for node in WAYS[way_id]]
+        return np.array(way_ids, dtype=np.int64), np.array(nodes, dtype=np.int64)
+
+    @staticmethod
+    def get_highway_way_ids() -> np.ndarray:
+        return np.array(HIGHWAYS, dtype=np.int64)
+
+    def get_table_fingerprint(self, table: str) -> str:
+        return self.fingerprint
+
+    @staticmethod
+    def get_ways_by_nodes(node_ids) -> list:
+        """Like the SQL of OsmDatabase: ways with more than one of the nodes"""
+        return [way_id for way_id, nodes in WAYS.items() if len(set(nodes) & set(node_ids)) > 1]
+
+
+def _check(edge_index: EdgeIndex):
+    db = _FakeDb()
+    for route, expected in (
+            ([1, 2, 3, 4, 5], [10, 20]),
+            ([11, 1, 2], [10]),
+            ([5, 4, 3, 2, 1], [20, 10]),
+            ([3, 4, 5, 9], [20, 30]),
+            ([9, 5, 4], [30, 20]),
+            ([6, 7, 8], [40, 5]),
+            ([8, 7], [5]),
+            ([2, 3, 100, 4], [10]),
+            ([1, 3], []),
+            ([1], []),
+    ):
+        ways = edge_index.get_ways(route)
+        assert ways == expected, route
+        assert set(ways) <= set(db.get_ways_by_nodes(route))
+
+
+def test_build():
+    _check(EdgeIndex.build(_FakeDb()))
+
+
+def test_save_load(monkeypatch):
+    db = _FakeDb()
+    monkeypatch.setattr(edgeindex.OsmDatabase, 'get_instance', staticmethod(lambda: db))
+    with tempfile.TemporaryDirectory() as directory:
+        built = EdgeIndex.load_or_build(directory)
+        loaded = EdgeIndex.load_or_build(directory)
+        assert db.copies == 1
+        assert isinstance(loaded.keys, np.memmap)
+        for name in ('node_ids', 'keys', 'way_ids'):
+            assert np.array_equal(getattr(built, name), getattr(loaded, name))
+        _check(loaded)
+        # a new import of way_nodes
+        db.fingerprint = 'way_nodes:2'
+        EdgeIndex.load_or_build(directory)
+        assert db.copies == 2
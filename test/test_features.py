@@ -0,0 +1,48 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from osrmlearning.features import get_route_features
+from osrmlearning.route import Route
+from osrmlearning.tagvocabulary import TagVocabulary
+
+# counts of the first three tags of the vocabulary
+COUNTS = [[2, 0, 2], [0, 0, 0], [1, 3, 0]]
+
+
+def _get_routes() -> list:
+    routes = []
+    for i, counts in enumerate(COUNTS):
+        osm_tag_counts = np.zeros(len(TagVocabulary.get_instance()), dtype=np.int32)
+        osm_tag_counts[:3] = counts
+        routes.append(Route('', reference_travel_time=60.0 * (i + 1), osrm_travel_time=60.0,
+                            osm_tag_counts=osm_tag_counts))
+    return routes
+
+
+def test_fractions():
+    features, labels = get_route_features(_get_routes(), binary_tags=False)
+    assert features.dtype == np.float32
+    assert np.allclose(features[:, :3], [[0.5, 0, 0.5], [0, 0, 0], [0.25, 0.75, 0]])
+    assert not features[:, 3:].any()
+    assert labels.tolist() == [1, 2, 3]
+    assert np.allclose(features, [route.osm_tag_fractions for route in _get_routes()])
+
+
+def test_binary_tags():
+    features, _ = get_route_features(_get_routes(), binary_tags=True)
+    assert np.array_equal(features[:, :3], [[1, 0, 1], [0, 0, 0], [1, 1, 0]])
@@ -0,0 +1,103 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import tempfile
+
+from osrmlearning.modelstore import ModelStore
+from osrmlearning.route import Route
+from osrmlearning.routeprovider import split_by_key
+
+
+def _get_routes(day: int, count=3, coordinates='') -> list:
+    return [Route(coordinates, start_timestamp=datetime.datetime(2020, 1, day, hour)) for hour in range(count)]
+
+
+def test_incremental_routes():
+    with tempfile.TemporaryDirectory() as directory:
+        model_store = ModelStore('morning', directory)
+        old_routes = _get_routes(1)
+        # interrupted training without manifest
+        os.makedirs(model_store.directory)
+        assert model_store.get_train_routes(old_routes) == old_routes
+        assert not os.path.exists(model_store.directory)
+        os.makedirs(model_store.directory)
+        model_store.save_manifest(old_routes, 100)
+
+        model_store = ModelStore('morning', directory)
+        new_routes = _get_routes(2, 2)
+        assert model_store.get_train_routes(old_routes) == []
+        assert model_store.get_train_routes(old_routes + new_routes) == new_routes
+        model_store.save_manifest(new_routes, 10)
+        assert model_store.manifest['routes'] == 5
+        assert model_store.manifest['steps'] == 110
+        assert ModelStore('morning', directory).trained_until == new_routes[-1].start_timestamp.timestamp()
+        assert ModelStore('evening', directory).trained_until is None
+
+
+def test_late_routes():
+    with tempfile.TemporaryDirectory() as directory:
+        model_store = ModelStore('morning', directory)
+        routes = _get_routes(2)
+        model_store.get_train_routes(routes)
+        os.makedirs(model_store.directory)
+        model_store.save_manifest(routes, 100)
+
+        # a route that arrived after the training, but started before the newest trained route
+        late_routes = _get_routes(1, 1, '8.4,49.0;8.5,49.1')
+        model_store = ModelStore('morning', directory)
+        assert model_store.get_train_routes(routes + late_routes) == late_routes
+        model_store.save_manifest(late_routes, 10)
+        model_store.save_manifest(late_routes, 10)
+        model_store = ModelStore('morning', directory)
+        assert model_store.get_train_routes(routes + late_routes) == []
+        assert model_store.manifest['routes'] == 4
+        assert model_store.trained_until == routes[-1].start_timestamp.timestamp()
+
+
+def test_split_by_key():
+    routes = [Route('8.{},49.0;8.5,49.1'.format(i), start_timestamp=datetime.datetime(2020, 1, 1)) for i in range(1000)]
+    train_routes, eval_routes = split_by_key(routes, 0.8)
+    assert 700 < len(train_routes) < 900
+    assert len(train_routes) + len(eval_routes) == len(routes)
+    # the same routes in another order and with others are split the same way
+    other_train_routes, other_eval_routes = split_by_key(list(reversed(routes)) + _get_routes(2), '0.8')
+    assert set(train_routes) <= set(other_train_routes)
+    assert set(eval_routes) <= set(other_eval_routes)
+
+
+def test_routes_without_timestamps():
+    with tempfile.TemporaryDirectory() as directory:
+        model_store = ModelStore('morning', directory)
+        routes = [Route('8.4,49.0;8.5,49.1'), Route('8.5,49.1;8.4,49.0')]
+        model_store.get_train_routes(routes)
+        os.makedirs(model_store.directory)
+        # every route was trained already
+        model_store.save_manifest([], 0)
+        assert not os.path.exists(model_store.manifest_file)
+        assert not os.path.exists(model_store.routes_file)
+        model_store.save_manifest(routes, 10)
+
+        model_store = ModelStore('morning', directory)
+        assert model_store.trained
+        assert model_store.trained_until is None
+        new_routes = _get_routes(1, 1)
+        assert model_store.get_train_routes(routes + new_routes) == new_routes
+        assert os.path.exists(model_store.directory)
+        model_store.save_manifest(new_routes, 10)
+        assert model_store.trained_until == new_routes[0].start_timestamp.timestamp()
+        assert model_store.manifest['routes'] == 3
@@ -0,0 +1,35 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from array import array
+
+from osrmlearning.nodes import decode_nodes, encode_nodes
+
+
+def test_encode_decode_nodes():
+    for nodes in (
+            (),
+            (0,),
+            (1835029415, 2134103308, 1982053901, 26574106, 1146801017, 20958816, 26574106),
+            (5, 4, 3, 2, 1, 0),
+            (2 ** 62, 1, 2 ** 62),
+    ):
+        assert decode_nodes(encode_nodes(nodes)) == array('q', nodes)
+
+
+def test_encode_nodes_is_compact():
+    nodes = tuple(range(1835029415, 1835029415 + 100))
+    assert len(encode_nodes(nodes)) < 8 + len(nodes)
@@ -0,0 +1,154 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+import pytest
+
+from osrmlearning import osmpbf
+from osrmlearning.nodes import encode_nodes
+from osrmlearning.osmpbf import PbfOsmDatabase, decode_varints, decode_zigzag
+from osrmlearning.tagvocabulary import TagVocabulary
+
+# node ID: tags, node 4 has a tag that is not in the vocabulary
+NODE_TAGS = {
+    1: [('highway', 'traffic_signals')],
+    3: [('highway', 'traffic_signals')],
+    4: [('name', 'x')],
+    6: [('maxspeed', '50')],
+}
+# way ID, nodes in sequence, tags; way 15 is out of order, way 30 is not whitelisted and way 40 is no highway
+WAYS = [
+    (10, [1, 2, 3], [('highway', 'primary'), ('maxspeed', '50')]),
+    (20, [3, 4, 5], [('highway', 'secondary'), ('oneway', 'yes')]),
+    (15, [2, 1], [('highway', 'primary')]),
+    (30, [5, 6], [('highway', 'residential')]),
+    (40, [7, 8], [('name', 'x')]),
+]
+
+
+def test_decode_varints():
+    assert decode_varints(b'\x00\x7f\x80\x01\xac\x02').tolist() == [0, 127, 128, 300]
+    assert decode_varints(b'\xff' * 9 + b'\x01').tolist() == [2 ** 64 - 1]
+    assert decode_varints(b'').tolist() == []
+
+
+def test_decode_delta_coded_ids():
+    # nodes.encode_nodes() uses the same encoding as the packed sint64 IDs of an .osm.pbf file
+    nodes = [1835029415, 2134103308, 1982053901, 26574106, 2 ** 40, 1, 1]
+    assert np.cumsum(decode_zigzag(decode_varints(encode_nodes(nodes)))).tolist() == nodes
+
+
+def _varint(value: int) -> bytes:
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _field(number: int, value) -> bytes:
+    """Encode a varint (int) or length-delimited (bytes) protobuf field"""
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed(values) -> bytes:
+    return b''.join(_varint(value) for value in values)
+
+
+def _delta(values) -> list:
+    """Delta and zigzag encode signed integers"""
+    return [delta << 1 if delta >= 0 else (-delta << 1) - 1 for delta in np.diff([0] + list(values)).tolist()]
+
+
+def _block(strings: list, groups: list) -> bytes:
+    string_table = b''.join(_field(1, string.encode()) for string in strings)
+    return _field(1, string_table) + b''.join(_field(2, group) for group in groups)
+
+
+def _write_pbf(path: str):
+    """Write NODE_TAGS and WAYS as .osm.pbf file with a Node, DenseNodes, Ways and raw and zlib blobs"""
+    # the string table starts with '' and has a duplicate 'highway'
+    strings = ['', 'highway'] + sorted({string for tags in NODE_TAGS.values() for tag in tags for string in tag})
+    index = {string: position for position, string in reversed(list(enumerate(strings)))}
+    node = _field(1, _delta([1])[0]) + _field(2, _packed([strings.index('highway', 2)])) + _field(
+        3, _packed([index['traffic_signals']]))
+    dense_ids = sorted(NODE_TAGS)[1:] + [2]
+    keys_values = []
+    for node_id in dense_ids:
+        for key, value in NODE_TAGS.get(node_id, []):
+            keys_values += [index[key], index[value]]
+        keys_values.append(0)
+    dense = _field(1, _packed(_delta(dense_ids))) + _field(8, _packed(_delta([0] * len(dense_ids)))) + _field(
+        9, _packed(_delta([0] * len(dense_ids)))) + _field(10, _packed(keys_values))
+    blocks = [_block(strings, [_field(1, node), _field(2, dense)])]
+    for ways in (WAYS[:2], WAYS[2:]):
+        strings = [''] + sorted({string for _, _, tags in ways for tag in tags for string in tag})
+        index = {string: position for position, string in enumerate(strings)}
+        group = b''.join(_field(3, _field(1, way_id) + _field(2, _packed([index[key] for key, _ in tags])) + _field(
+            3, _packed([index[value] for _, value in tags])) + _field(8, _packed(_delta(nodes))))
+            for way_id, nodes, tags in ways)
+        blocks.append(_block(strings, [group]))
+    with open(path, 'wb') as f:
+        for blob_type, blob in [('OSMHeader', _field(1, _field(4, b'OsmSchema-V0.6')))] + [
+                ('OSMData', _field(1, block) if i % 2 else _field(2, len(block)) + _field(3, zlib.compress(block)))
+                for i, block in enumerate(blocks)]:
+            header = _field(1, blob_type.encode()) + _field(3, len(blob))
+            f.write(struct.pack('>I', len(header)) + header + blob)
+
+
+@pytest.mark.parametrize('all_highways', ['0', '1'])
+def test_build(monkeypatch, all_highways):
+    config = osmpbf.config._replace(osm=osmpbf.config.osm._replace(pbf_all_highways=all_highways))
+    monkeypatch.setattr(osmpbf, 'config', config)
+    vocabulary = TagVocabulary.get_instance()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.osm.pbf')
+        _write_pbf(path)
+        db = PbfOsmDatabase.build(path, workers=1)
+        db.save(os.path.join(directory, 'store'))
+        assert PbfOsmDatabase.load_or_build(path, os.path.join(directory, 'store')).fingerprint == db.fingerprint
+        for db in (db, PbfOsmDatabase.load(os.path.join(directory, 'store'))):
+            assert db.get_all_way_ids() == ([10, 15, 20, 30] if all_highways == '1' else [10, 15, 20])
+            assert db.get_highway_way_ids().tolist() == db.get_all_way_ids()
+            assert db.get_ways_by_nodes([1, 2, 3]) == [10, 15]
+            assert db.get_ways_by_nodes([3, 4, 100]) == [20]
+            assert db.get_ways_by_nodes([5, 6]) == ([30] if all_highways == '1' else [])
+            assert db.get_ways_by_nodes([7, 8]) == []
+            counts = db.get_tag_counts_by_routes([[1, 2, 3], [3, 4, 5], []])
+            assert [vocabulary.to_dict(route_counts) for route_counts in counts] == [
+                {'highway=traffic_signals': 2, 'highway=primary': 2, 'maxspeed=50': 1},
+                {'highway=traffic_signals': 1, 'highway=secondary': 1, 'oneway=yes': 1},
+                {},
+            ]
+            assert db.get_all_tags_by_nodes([5, 6]) == (
+                {vocabulary.ids['maxspeed=50']: 1, vocabulary.ids['highway=residential']: 1} if all_highways == '1'
+                else {vocabulary.ids['maxspeed=50']: 1})
+            # node tags count once for each node of a way
+            way_features = db.get_way_features()
+            assert way_features.get(10) == {
+                'highway=primary': 0.25, 'maxspeed=50': 0.25, 'highway=traffic_signals': 0.5}
+            assert way_features.get(15) == {'highway=primary': 0.5, 'highway=traffic_signals': 0.5}
+            assert way_features.get(20) == pytest.approx(
+                {'highway=secondary': 1 / 3, 'oneway=yes': 1 / 3, 'highway=traffic_signals': 1 / 3})
+            assert way_features.to_dense().sum(axis=1) == pytest.approx([1] * len(way_features))
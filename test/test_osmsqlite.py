@@ -0,0 +1,117 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from osrmlearning.osmsqlite import SqliteOsmDatabase
+from osrmlearning.tagvocabulary import TagVocabulary
+
+NODE_TAGS = [
+    (1, 'highway', 'traffic_signals'),
+    (3, 'highway', 'traffic_signals'),
+    (4, 'name', 'x'),
+    (6, 'maxspeed', '50'),
+]
+# way ID: nodes in sequence
+WAYS = {
+    10: [1, 2, 3],
+    15: [2, 1],
+    20: [3, 4, 5],
+    30: [5, 6],
+    50: [7, 8],
+}
+WAY_TAGS = [
+    (10, 'highway', 'primary'),
+    (10, 'maxspeed', '50'),
+    (15, 'highway', 'primary'),
+    (20, 'highway', 'secondary'),
+    (20, 'oneway', 'yes'),
+    (30, 'highway', 'residential'),
+    (30, 'name', 'x'),
+    (50, 'building', 'yes'),
+]
+
+
+class _FakeSource(object):
+    @staticmethod
+    def get_all_way_ids() -> list:
+        return sorted(WAYS)
+
+    @staticmethod
+    def get_way_node_arrays() -> tuple:
+        way_ids = [way_id for way_id in sorted(WAYS) for _ in WAYS[way_id]]
+        nodes = [node for way_id in sorted(WAYS) for node in WAYS[way_id]]
+        return np.array(way_ids, dtype=np.int64), np.array(nodes, dtype=np.int64)
+
+    @staticmethod
+    def iterate_node_tags(itersize=None):
+        return iter(NODE_TAGS)
+
+    @staticmethod
+    def iterate_way_tags(itersize=None):
+        return iter(WAY_TAGS)
+
+
+def test_build():
+    vocabulary = TagVocabulary.get_instance()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'osm.sqlite')
+        SqliteOsmDatabase.build(_FakeSource(), path)
+        db = SqliteOsmDatabase(path)
+        assert db.get_all_way_ids() == [10, 15, 20, 30, 50]
+        assert db.get_highway_way_ids().tolist() == [10, 15, 20, 30]
+        assert [array.tolist() for array in db.get_way_node_arrays()] == [
+            [10, 10, 10, 15, 15, 20, 20, 20, 30, 30, 50, 50], [1, 2, 3, 2, 1, 3, 4, 5, 5, 6, 7, 8]]
+        assert sorted(db.get_ways_by_nodes([1, 2, 3])) == [10, 15]
+        assert db.get_ways_by_nodes([3, 4, 100]) == [20]
+        assert db.get_ways_by_nodes([7, 8]) == [50]
+        counts = db.get_tag_counts_by_routes([[1, 2, 3], [3, 4, 5], []])
+        assert [vocabulary.to_dict(route_counts) for route_counts in counts] == [
+            {'highway=traffic_signals': 2, 'highway=primary': 2, 'maxspeed=50': 1},
+            {'highway=traffic_signals': 1, 'highway=secondary': 1, 'oneway=yes': 1},
+            {},
+        ]
+        # name=x is not in the vocabulary
+        assert db.get_all_tags_by_nodes([5, 6]) == {
+            vocabulary.ids['maxspeed=50']: 1, vocabulary.ids['highway=residential']: 1}
+        # node tags count once for each node of a way, tags that are not in the vocabulary are skipped
+        way_features = db.get_way_features()
+        assert way_features.way_ids.tolist() == [10, 15, 20, 30]
+        assert way_features.get(10) == {'highway=primary': 0.25, 'maxspeed=50': 0.25, 'highway=traffic_signals': 0.5}
+        assert way_features.get(15) == {'highway=primary': 0.5, 'highway=traffic_signals': 0.5}
+        assert way_features.get(20) == pytest.approx(
+            {'highway=secondary': 1 / 3, 'oneway=yes': 1 / 3, 'highway=traffic_signals': 1 / 3})
+        assert way_features.get(30) == {'highway=residential': 0.5, 'maxspeed=50': 0.5}
+        assert db.get_way_features((15, 30)).way_ids.tolist() == [15, 20]
+
+
+def test_stream_tags_of_all_ways():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'osm.sqlite')
+        SqliteOsmDatabase.build(_FakeSource(), path)
+        db = SqliteOsmDatabase(path)
+        rows = []
+        # other queries can run while the rows are fetched two at a time
+        for row in db.iterate_all_tags_of_all_ways(itersize=2):
+            rows.append(row)
+            assert sorted(db.get_ways_by_nodes([1, 2])) == [10, 15]
+        assert rows == db.get_all_tags_of_all_ways()
+        assert [way_id for way_id, _, _ in rows] == [10, 10, 10, 15, 15, 20, 20, 20, 30, 30]
@@ -0,0 +1,80 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import os
+import tempfile
+
+from osrmlearning import osrmcache
+from osrmlearning.osrmcache import OsrmRouteCache
+
+NODES = (1835029415, 2134103308, 1982053901)
+
+
+def _coordinates(i: int) -> str:
+    return '8.{:04d},53.1080;8.7859,53.0524'.format(i)
+
+
+def test_put_get():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'routes.sqlite')
+        cache = OsrmRouteCache('a', filename=filename, max_size_mb=1)
+        assert cache.get(_coordinates(0), profile='car') is None
+        cache.put(_coordinates(0), 61.5, NODES, profile='car')
+        travel_time, nodes = cache.get(_coordinates(0), profile='car')
+        assert travel_time == 61.5
+        assert tuple(nodes) == NODES
+        assert cache.get(_coordinates(0), profile='bike') is None
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert cache.hit_ratio == 1 / 3
+        cache.close()
+
+        cache = OsrmRouteCache('a', filename=filename, max_size_mb=1)
+        assert cache.contains(_coordinates(0), profile='car')
+        assert cache.get(_coordinates(0), profile='car')[0] == 61.5
+        cache.close()
+        # a new OSRM dataset does not see the routes of the old one
+        cache = OsrmRouteCache('b', filename=filename, max_size_mb=1)
+        assert not cache.contains(_coordinates(0), profile='car')
+        assert cache.get(_coordinates(0), profile='car') is None
+        assert cache.misses == 1
+        cache.close()
+
+
+def test_evict_least_recently_used(monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(osrmcache.time, 'time', lambda: next(clock))
+    with tempfile.TemporaryDirectory() as directory:
+        cache = OsrmRouteCache('a', filename=os.path.join(directory, 'routes.sqlite'), max_size_mb=1)
+        cache.put(_coordinates(0), 60.0, NODES, profile='car')
+        entry_size = cache.size
+        cache.close()
+
+        # room for 4 entries
+        cache = OsrmRouteCache('a', filename=os.path.join(directory, 'routes.sqlite'),
+                               max_size_mb=4.5 * entry_size / 1024 / 1024)
+        for i in range(1, 4):
+            cache.put(_coordinates(i), 60.0, NODES, profile='car')
+        assert cache.evictions == 0
+        # 0 is used again, 1 is the least recently used one now
+        assert cache.get(_coordinates(0), profile='car') is not None
+        cache.put(_coordinates(4), 60.0, NODES, profile='car')
+        assert cache.evictions == 1
+        assert cache.size == 4 * entry_size
+        assert not cache.contains(_coordinates(1), profile='car')
+        for i in (0, 2, 3, 4):
+            assert cache.contains(_coordinates(i), profile='car')
+        cache.close()
@@ -0,0 +1,68 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import math
+import urllib.parse
+
+from osrmlearning import osrmclient
+from osrmlearning.osrmclient import get_osrm_table_durations
+
+
+def _get_table(query: str, tables: list) -> bytes:
+    """Answer a table request like OSRM, the duration of a leg is the sum of the longitudes"""
+    path, _, query_string = query.partition('?')
+    locations = path.split('/')[-1].split(';')
+    parameters = dict(urllib.parse.parse_qsl(query_string))
+    sources = [int(source) for source in parameters['sources'].split(';')]
+    destinations = [int(destination) for destination in parameters['destinations'].split(';')]
+    tables.append((len(sources), len(destinations)))
+    return '{{"code": "Ok", "durations": {}}}'.format([
+        [None if locations[source] == locations[destination] else
+         float(locations[source].split(',')[0]) + float(locations[destination].split(',')[0])
+         for destination in destinations]
+        for source in sources
+    ]).replace('None', 'null').encode()
+
+
+def _lat_lon(longitude: int) -> str:
+    return '49.0,{}'.format(longitude)
+
+
+def test_table_durations(monkeypatch):
+    tables = []
+    monkeypatch.setattr(osrmclient, '_get', lambda query, host=None, port=None: _get_table(query, tables))
+    # one source with many destinations, distinct legs and an unreachable leg
+    coordinates_list = ['{};{}'.format(_lat_lon(1), _lat_lon(100 + i)) for i in range(30)]
+    coordinates_list += ['{};{}'.format(_lat_lon(200 + i), _lat_lon(300 + i)) for i in range(30)]
+    coordinates_list.insert(5, '{};{}'.format(_lat_lon(7), _lat_lon(7)))
+    durations = get_osrm_table_durations(coordinates_list, chunk_size=250, max_cells=100)
+    expected = [1 + 100 + i for i in range(30)] + [200 + i + 300 + i for i in range(30)]
+    expected.insert(5, None)
+    assert [None if math.isnan(duration) else duration for duration in durations] == expected
+    assert all(sources * destinations <= 100 for sources, destinations in tables)
+    # the legs of the first source share a row, instead of one 61 x 61 table
+    assert sum(sources * destinations for sources, destinations in tables) < 400
+    assert len(tables) < 10
+
+
+def test_table_chunk_size(monkeypatch):
+    tables = []
+    monkeypatch.setattr(osrmclient, '_get', lambda query, host=None, port=None: _get_table(query, tables))
+    coordinates_list = ['{};{}'.format(_lat_lon(1), _lat_lon(100 + i)) for i in range(10)]
+    assert get_osrm_table_durations(coordinates_list, chunk_size=4, max_cells=100) == [
+        1 + 100 + i for i in range(10)]
+    assert tables == [(1, 4), (1, 4), (1, 2)]
@@ -0,0 +1,488 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import socketserver
+import threading
+import time
+import urllib.error
+
+import aiohttp
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+from osrmlearning import asyncproxy, proxy
+from osrmlearning.asyncproxy import AsyncProxy, AsyncSingleFlight
+from osrmlearning.proxy import (
+    get_balancer,
+    get_batch_durations,
+    invalidate_time_window,
+    normalize_query,
+    parse_request,
+    ReplicaBalancer,
+    ResponseCache,
+    SingleFlight,
+)
+from osrmlearning.timewindow import (
+    get_default_time_window,
+    get_time_window_by_hour,
+    get_time_window_by_timestamp,
+    get_time_windows,
+)
+
+PATH = 'route/v1/driving/13.388860,52.517037;13.397634,52.529407'
+
+
+def test_parse_request_strips_timestamp():
+    query, timestamp = parse_request(PATH, 'overview=false&timestamp=2018-06-06T11%3A00%3A00.000Z&annotations=true')
+    assert query == '/' + PATH + '?overview=false&annotations=true'
+    assert timestamp == '2018-06-06T11:00:00.000Z'
+    assert get_time_window_by_timestamp(timestamp) is get_time_window_by_hour(11)
+
+
+def test_parse_request_without_parameters():
+    assert parse_request(PATH, '') == ('/' + PATH, None)
+    assert parse_request(PATH, 'timestamp=2018-06-06T11:00:00.000Z') == ('/' + PATH, '2018-06-06T11:00:00.000Z')
+    assert parse_request(PATH, 'overview=false&') == ('/' + PATH + '?overview=false', None)
+
+
+def test_normalize_query_sorts_parameters():
+    query_1, _ = parse_request(PATH, 'overview=false&annotations=true&timestamp=2018-06-06T11:00:00.000Z')
+    query_2, _ = parse_request(PATH, 'timestamp=2018-06-06T12:00:00.000Z&annotations=true&overview=false')
+    assert query_1 != query_2
+    assert normalize_query(query_1) == normalize_query(query_2) == '/' + PATH + '?annotations=true&overview=false'
+    assert normalize_query('/' + PATH) == '/' + PATH
+
+
+def test_invalid_timestamp():
+    for timestamp in ('tomorrow', '2018-06-06 11:00', '2018-06-06T25:00:00.000Z'):
+        _, parsed = parse_request(PATH, 'overview=false&timestamp={}'.format(timestamp))
+        with pytest.raises(ValueError):
+            get_time_window_by_timestamp(parsed)
+    _, parsed = parse_request(PATH, 'timestamp=')
+    assert get_time_window_by_timestamp(parsed) is get_default_time_window()
+
+
+def test_invalid_timestamp_returns_400():
+    from osrmlearning.api import app
+    url = '/{}?overview=false&timestamp=tomorrow'.format(PATH)
+    response = app.test_client().get(url)
+    assert response.status_code == 400
+    assert response.get_data() == b'Invalid timestamp tomorrow'
+
+    async def run():
+        async with TestClient(TestServer(AsyncProxy().app)) as client:
+            async_response = await client.get(url)
+            assert async_response.status == 400
+            assert await async_response.read() == b'Invalid timestamp tomorrow'
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_response_cache_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(proxy.time, 'time', clock.time)
+    cache = ResponseCache(max_size_mb=1, ttl=60)
+    time_window = get_time_windows()[0]
+    cache.put('/table?b=1&a=2', time_window, b'body')
+    clock.now += 59
+    assert cache.get('/table?a=2&b=1', time_window) == b'body'
+    clock.now += 2
+    assert cache.get('/table?a=2&b=1', time_window) is None
+    assert cache.size == 0
+    assert (cache.hits, cache.misses, cache.bytes_saved) == (1, 1, 4)
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_size_mb=100 / 1024 / 1024, ttl=60)
+    time_window = get_time_windows()[0]
+    for i in range(3):
+        cache.put('/route?i={}'.format(i), time_window, bytes(40))
+    # 0 was evicted when 2 was put
+    assert cache.size == 80
+    assert cache.get('/route?i=0', time_window) is None
+    assert cache.get('/route?i=1', time_window) is not None
+    cache.put('/route?i=3', time_window, bytes(40))
+    assert cache.get('/route?i=1', time_window) is not None
+    assert cache.get('/route?i=2', time_window) is None
+    # larger than the whole cache
+    cache.put('/route?i=4', time_window, bytes(101))
+    assert cache.get('/route?i=4', time_window) is None
+    assert cache.size == 80
+
+
+def test_response_cache_invalidate_time_window():
+    cache = ResponseCache(max_size_mb=1, ttl=60)
+    time_window, other_time_window = get_time_windows()[:2]
+    cache.put('/route', time_window, b'old')
+    cache.put('/route', other_time_window, b'other')
+    invalidate_time_window(time_window)
+    assert cache.get('/route', time_window) is None
+    assert cache.get('/route', other_time_window) == b'other'
+    cache.put('/route', time_window, b'new')
+    assert cache.get('/route', time_window) == b'new'
+
+
+def test_response_cache_encodings():
+    cache = ResponseCache(max_size_mb=1, ttl=60)
+    time_window = get_time_windows()[0]
+    cache.put('/route', time_window, b'plain')
+    assert cache.get('/route', time_window, 'gzip') is None
+    cache.put('/route', time_window, b'compressed', 'gzip')
+    assert cache.get('/route', time_window) == b'plain'
+    assert cache.get('/route', time_window, 'gzip') == b'compressed'
+    assert cache.statistics['entries'] == 2
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError()
+        time.sleep(0.001)
+
+
+def _run_coalesced_threads(single_flight: SingleFlight, function, count=5) -> list:
+    """Start count calls of the same key, the first one is the leader, return the threads and their results"""
+    results = [None] * count
+
+    def call(i):
+        try:
+            results[i] = single_flight.do('key', function)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    threads[0].start()
+    _wait_for(lambda: 'key' in single_flight._calls)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_for(lambda: single_flight.coalesced == count - 1)
+    return threads, results
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(True)
+        release.wait()
+        return b'body'
+
+    threads, results = _run_coalesced_threads(single_flight, function)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [b'body'] * 5
+    assert not single_flight._calls
+    # the next call after the leader finished is a new leader
+    assert single_flight.do('key', lambda: b'new') == b'new'
+    assert single_flight.coalesced == 4
+
+
+def test_single_flight_error():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def function():
+        release.wait()
+        raise ConnectionError('down')
+
+    threads, results = _run_coalesced_threads(single_flight, function)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert not single_flight._calls
+
+
+def test_async_single_flight():
+    single_flight = AsyncSingleFlight()
+    calls = []
+
+    async def function():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return b'body'
+
+    async def failing_function():
+        await asyncio.sleep(0.01)
+        raise ConnectionError('down')
+
+    async def run():
+        results = await asyncio.gather(*[single_flight.do('key', function) for _ in range(5)])
+        assert results == [b'body'] * 5
+        assert len(calls) == 1
+        assert single_flight.coalesced == 4
+        assert not single_flight._tasks
+        results = await asyncio.gather(*[single_flight.do('key', failing_function) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+        assert single_flight.coalesced == 6
+        assert not single_flight._tasks
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_balancer_least_outstanding():
+    balancer = ReplicaBalancer([5001, 5002, 5003], eject_seconds=10)
+    assert [balancer.acquire() for _ in range(4)] == [5001, 5002, 5003, 5001]
+    balancer.release(5002)
+    assert balancer.acquire() == 5002
+    assert balancer.outstanding == {5001: 2, 5002: 1, 5003: 1}
+    assert balancer.acquire(exclude=(5002, 5003)) == 5001
+    # all other replicas are excluded
+    assert balancer.acquire(exclude=(5001, 5002, 5003)) in (5001, 5002, 5003)
+
+
+def test_balancer_ejection(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(proxy.time, 'time', clock.time)
+    balancer = ReplicaBalancer([5001, 5002], eject_seconds=10)
+    balancer.release(balancer.acquire(), healthy=False)
+    assert balancer.ejected_ports == [5001]
+    assert [balancer.acquire() for _ in range(3)] == [5002] * 3
+    # the ejected replica is used if it is the only one left
+    assert balancer.acquire(exclude=(5002,)) == 5001
+    balancer.release(5001)
+    # re-admitted after eject_seconds
+    clock.now += 10.5
+    assert balancer.ejected_ports == []
+    assert balancer.acquire() == 5001
+    balancer.release(5001, healthy=False)
+    assert balancer.ejected_ports == [5001]
+    # or by a successful health check
+    balancer.set_healthy(5001)
+    assert balancer.ejected_ports == []
+    assert balancer.acquire() == 5001
+
+
+def test_balancer_all_ejected(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(proxy.time, 'time', clock.time)
+    balancer = ReplicaBalancer([5001, 5002], eject_seconds=10)
+    balancer.release(balancer.acquire(), healthy=False)
+    balancer.release(balancer.acquire(), healthy=False)
+    assert balancer.ejected_ports == [5001, 5002]
+    assert balancer.acquire() == 5001
+    assert balancer.acquire() == 5002
+
+
+def test_batch_durations(monkeypatch):
+    def get_osrm_table_durations(coordinates_list, port=None):
+        # lat,lon;lat,lon
+        return [float('nan') if coordinates.startswith('0') else float(len(coordinates))
+                for coordinates in coordinates_list]
+
+    monkeypatch.setattr(proxy, 'get_osrm_table_durations', get_osrm_table_durations)
+    legs = [
+        dict(coordinates='8.8473,53.1080;8.7859,53.0524', timestamp='2018-06-06T11:00:00.000Z'),
+        dict(coordinates='8.8,53.1;8.7,53.0'),
+        dict(coordinates='8.8,0;8.7,53.0', timestamp='2018-06-06T08:00:00.000Z'),
+    ]
+    assert get_batch_durations(legs) == [29.0, 17.0, None]
+
+
+def test_batch_invalid_coordinates(monkeypatch):
+    monkeypatch.setattr(proxy, 'get_osrm_table_durations', lambda *args, **kwargs: pytest.fail('OSRM was asked'))
+    for coordinates in ('abc,def;8.7,53.0', '8.8;8.7,53.0', '8.8,53.1,1;8.7,53.0', 'nan,53.1;8.7,53.0', '8.8,53.1'):
+        with pytest.raises(ValueError):
+            get_batch_durations([dict(coordinates=coordinates)])
+    with pytest.raises(ValueError):
+        get_batch_durations([dict(timestamp='2018-06-06T11:00:00.000Z')])
+
+
+def test_batch_replica_health(monkeypatch):
+    time_window = get_time_window_by_timestamp(None)
+    balancer = get_balancer(time_window)
+    legs = [dict(coordinates='8.8,53.1;8.7,53.0')]
+
+    def fail_with(error):
+        def get_osrm_table_durations(coordinates_list, port=None):
+            raise error
+        monkeypatch.setattr(proxy, 'get_osrm_table_durations', get_osrm_table_durations)
+
+    fail_with(urllib.error.HTTPError('url', 400, 'Bad Request', {}, None))
+    with pytest.raises(ValueError):
+        get_batch_durations(legs)
+    assert not balancer.ejected_ports
+    for error in (urllib.error.HTTPError('url', 503, 'Service Unavailable', {}, None), ConnectionRefusedError()):
+        fail_with(error)
+        with pytest.raises(OSError):
+            get_batch_durations(legs)
+        assert len(balancer.ejected_ports) == 1
+        balancer.set_healthy(balancer.ejected_ports[0])
+    assert not any(balancer.outstanding.values())
+
+
+class _OsrmHandler(BaseHTTPRequestHandler):
+    """Answers /<anything>?size=<bytes> with a body of that size, only 100 bytes of it with &truncate"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        size = int(self.path.partition('size=')[2].partition('&')[0] or 0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if 'truncate' in self.path:
+            # OSRM fails in the middle of the body
+            self.wfile.write(b'x' * 100)
+            self.close_connection = True
+        else:
+            self.wfile.write(b'x' * size)
+
+    def log_message(self, *args):
+        pass
+
+
+class _OsrmServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def osrm_port():
+    server = _OsrmServer(('127.0.0.1', 0), _OsrmHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_streamed_response_keeps_replica_busy(osrm_port):
+    from osrmlearning.api import _osrm_replica_request
+    balancer = ReplicaBalancer([osrm_port])
+    _, _, body = _osrm_replica_request(balancer, '/route?size=100')
+    assert body == b'x' * 100
+    assert balancer.outstanding[osrm_port] == 0
+    _, _, body = _osrm_replica_request(balancer, '/route?size=2000000')
+    assert balancer.outstanding[osrm_port] == 1
+    assert len(b''.join(body)) == 2000000
+    assert balancer.outstanding[osrm_port] == 0
+    # the client disconnected before the body was relayed
+    _, _, body = _osrm_replica_request(balancer, '/route?size=2000000')
+    assert balancer.outstanding[osrm_port] == 1
+    body.close()
+    assert balancer.outstanding[osrm_port] == 0
+    assert not balancer.ejected_ports
+
+
+def test_async_streamed_response_keeps_replica_busy(osrm_port):
+    async def run():
+        proxy = AsyncProxy()
+        proxy.session = aiohttp.ClientSession()
+        try:
+            balancer = ReplicaBalancer([osrm_port])
+            port = balancer.acquire()
+            _, _, body = await proxy._fetch_from_replica(balancer, port, '/route?size=100')
+            assert body == b'x' * 100
+            assert balancer.outstanding[osrm_port] == 0
+            port = balancer.acquire()
+            _, _, body = await proxy._fetch_from_replica(balancer, port, '/route?size=2000000')
+            assert balancer.outstanding[osrm_port] == 1
+            size = 0
+            async for chunk in body.iter_chunks():
+                size += len(chunk)
+            assert size == 2000000
+            assert balancer.outstanding[osrm_port] == 1
+            body.release()
+            body.release()
+            assert balancer.outstanding[osrm_port] == 0
+        finally:
+            await proxy.session.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_async_stream_fails_midway(osrm_port, monkeypatch):
+    balancer = ReplicaBalancer([osrm_port])
+    monkeypatch.setattr(asyncproxy, 'get_balancer', lambda time_window: balancer)
+
+    async def run():
+        client = TestClient(TestServer(AsyncProxy().app))
+        await client.start_server()
+        try:
+            response = await client.get('/route/v1/driving/x?size=2000000')
+            assert len(await response.read()) == 2000000
+            assert balancer.outstanding[osrm_port] == 0
+            # the headers were already relayed, so the client connection is aborted instead of answering 502
+            response = await client.get('/route/v1/driving/x?size=2000000&truncate=1',
+                                        timeout=aiohttp.ClientTimeout(total=10))
+            assert response.status == 200
+            with pytest.raises(aiohttp.ClientPayloadError):
+                await response.read()
+            assert balancer.outstanding[osrm_port] == 0
+            assert balancer.ejected_ports == [osrm_port]
+        finally:
+            await client.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_async_single_flight_discards_result_of_cancelled_leader():
+    single_flight = AsyncSingleFlight()
+    discarded = []
+
+    async def function():
+        await asyncio.sleep(0.01)
+        return b'unread'
+
+    async def run():
+        leader = asyncio.ensure_future(single_flight.do('key', function, discard=discarded.append))
+        follower = asyncio.ensure_future(single_flight.do('key', function, discard=discarded.append))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == b'unread'
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        await asyncio.sleep(0)
+        assert discarded == [b'unread']
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -0,0 +1,35 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from osrmlearning.tagvocabulary import TagVocabulary
+
+TAGS = ['oneway=yes', 'highway=primary', 'maxspeed=30', 'highway=primary']
+
+
+def test_ids():
+    vocabulary = TagVocabulary(TAGS)
+    assert vocabulary.tags == ['highway=primary', 'maxspeed=30', 'oneway=yes']
+    assert vocabulary.ids['maxspeed=30'] == 1
+    assert vocabulary.keys == ['highway', 'maxspeed', 'oneway']
+    assert vocabulary.values == ['primary', '30', 'yes']
+    assert vocabulary.hash == TagVocabulary(reversed(TAGS)).hash
+
+
+def test_counts():
+    vocabulary = TagVocabulary(TAGS)
+    counts = vocabulary.to_counts({'oneway=yes': 2, 'name=x': 7})
+    assert counts.tolist() == [0, 0, 2]
+    assert vocabulary.to_dict(counts) == {'oneway=yes': 2}
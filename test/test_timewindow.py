@@ -0,0 +1,56 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+
+from osrmlearning.route import Route
+from osrmlearning.timewindow import (
+    get_time_window_by_hour,
+    get_time_window_by_route,
+    get_time_windows,
+    set_time_windows,
+    TimeWindow,
+)
+
+
+def test_lookup_table_matches_filter_routes():
+    original_time_windows = get_time_windows()
+    try:
+        set_time_windows([
+            TimeWindow(7, 10, 5001),
+            TimeWindow(10, 13, 5002),
+            TimeWindow(16, 19, 5003),
+            TimeWindow(19, 7, 5000),
+        ])
+        for start_hour in range(24):
+            for end_hour in range(24):
+                route = Route(
+                    coordinates='0.0,0.0;0.0,0.0',
+                    start_timestamp=datetime.datetime(year=2018, month=1, day=1, hour=start_hour),
+                    end_timestamp=datetime.datetime(year=2018, month=1, day=1, hour=end_hour),
+                )
+                matching = [
+                    time_window
+                    for time_window in get_time_windows()
+                    if time_window.filter_routes([route], log=False)
+                ]
+                if not matching:
+                    continue
+                assert get_time_window_by_route(route) is matching[0]
+                if start_hour == end_hour:
+                    assert get_time_window_by_hour(start_hour) is matching[0]
+    finally:
+        set_time_windows(original_time_windows)
@@ -0,0 +1,70 @@
+# mFund TransData
+# Copyright (C) 2020 XTL Kommunikationssysteme GmbH <info@xtl-gmbh.de>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from osrmlearning.wayfeatures import WayFeatureMatrix
+
+TAGS = ['highway=primary', 'maxspeed=30', 'oneway=yes']
+# (way_id, tag_id, counter)
+ROWS = [
+    (1, 0, 2),
+    (1, 2, 2),
+    (5, 1, 1),
+    (9, 0, 1),
+    (9, 1, 3),
+]
+
+
+def test_ratios():
+    matrix = WayFeatureMatrix.from_rows(ROWS, TAGS).normalize(binary_tags=False)
+    assert matrix.way_ids.tolist() == [1, 5, 9]
+    assert np.allclose(matrix.to_dense(), [[0.5, 0, 0.5], [0, 1, 0], [0.25, 0.75, 0]])
+    assert np.allclose(matrix.to_dense(1, 2), [[0, 1, 0]])
+    assert matrix.get(9) == {'highway=primary': 0.25, 'maxspeed=30': 0.75}
+    assert matrix.get(2) == {}
+
+
+def test_from_arrays():
+    matrix = WayFeatureMatrix.from_rows(ROWS, TAGS)
+    way_ids, tag_ids, counters = np.array(ROWS, dtype=np.int64).T
+    from_arrays = WayFeatureMatrix.from_arrays(way_ids, tag_ids, counters, TAGS)
+    assert from_arrays.way_ids.tolist() == matrix.way_ids.tolist()
+    assert from_arrays.indptr.tolist() == matrix.indptr.tolist()
+    assert np.array_equal(from_arrays.to_dense(), matrix.to_dense())
+    assert len(WayFeatureMatrix.from_arrays(way_ids[:0], tag_ids[:0], counters[:0], TAGS)) == 0
+
+
+def test_binary_tags():
+    matrix = WayFeatureMatrix.from_rows(ROWS, TAGS).normalize(binary_tags=True)
+    assert np.array_equal(matrix.to_dense(), [[1, 0, 1], [0, 1, 0], [1, 1, 0]])
+
+
+def test_concatenate():
+    matrix = WayFeatureMatrix.from_rows(ROWS, TAGS)
+    parts = [WayFeatureMatrix.from_rows(ROWS[3:], TAGS), WayFeatureMatrix.from_rows(ROWS[:3], TAGS)]
+    joined = WayFeatureMatrix.concatenate(parts)
+    assert joined.way_ids.tolist() == matrix.way_ids.tolist()
+    assert np.array_equal(joined.to_dense(), matrix.to_dense())
+
+
+def test_unique():
+    rows = ROWS + [(11, 0, 1), (11, 1, 3), (12, 2, 5), (13, 1, 2)]
+    matrix = WayFeatureMatrix.from_rows(rows, TAGS).normalize(binary_tags=False)
+    for chunk_size in (None, 2):
+        unique, inverse = matrix.unique(chunk_size)
+        assert len(unique) == 4
+        assert np.array_equal(unique[inverse], matrix.to_dense())